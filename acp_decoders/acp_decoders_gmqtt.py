@@ -1,11 +1,11 @@
-import simplejson as json
+import acp_json as json
 
 import asyncio
 import os
 import sys
 import signal
+import threading
 import time
-import importlib
 from datetime import datetime, timezone
 
 from gmqtt import Client as MQTTClient
@@ -14,6 +14,11 @@ from gmqtt.mqtt.constants import MQTTv311
 # gmqtt compatible with uvloop
 import uvloop
 
+from decode_pool import DecodePool
+from decoder_loader import DecoderLoader
+from decoder_watcher import DecoderWatcher
+from uplink_dedup import UplinkDedup
+
 DEBUG = False
 
 #import logging
@@ -38,6 +43,19 @@ class DecoderManager():
         self.settings = {}
         self.settings["decoders"] = []
 
+        self.decode_pool = None
+        self.uplink_dedup = None
+
+        # imports the decoders, see import_decoders()
+        self.decoder_loader = DecoderLoader()
+        # reload() (SIGALRM or the DecoderWatcher) requests a reload, made by the
+        # decoder_reload thread, see reload_loop()
+        self.reload_requested = threading.Event()
+        self.reload_lock = threading.Lock()
+        self.reload_thread = None
+        self.reload_stopping = False
+        self.decoder_watcher = None
+
     #####################################
     # Signal handler for SIGINT, SIGTERM
     #####################################
@@ -45,10 +63,31 @@ class DecoderManager():
         self.STOP.set()
 
     #####################################
-    # Signal handler for SIGALRM
+    # Signal handler for SIGALRM, also called by the DecoderWatcher thread
+    # Only requests the reload, so the MQTT network loop is not blocked
+    # while the decoders are imported
     #####################################
     def reload(self,*args):
-        self.load_decoders_file()
+        self.reload_requested.set()
+
+    # decoder_reload thread, reloads the decoders after each reload() request
+    # (requests made during a reload give one more reload)
+    def reload_loop(self):
+        while True:
+            self.reload_requested.wait()
+            if self.reload_stopping:
+                return
+            self.reload_requested.clear()
+            try:
+                self.reload_decoders()
+            except Exception as e:
+                print("{} reload exception {}".format(self.ts_string(), repr(e)),file=sys.stderr,flush=True)
+
+    def reload_decoders(self):
+        with self.reload_lock:
+            self.load_decoders_file()
+            if self.decode_pool is not None:
+                self.decode_pool.reload()
 
     #####################################
     # Return current timestamp as string
@@ -68,6 +107,26 @@ class DecoderManager():
         # load settings.json into self.settings
         self.read_settings()
 
+        # Optionally drop repeated copies of TTN uplinks before decoding (see uplink_dedup.py)
+        if "dedup" in self.settings:
+            self.uplink_dedup = UplinkDedup(self.settings["dedup"])
+
+        # Optionally decode in settings["decode_processes"] worker processes
+        if "decode_processes" in self.settings and self.settings["decode_processes"] > 0:
+            print("{} decoding in {} processes".format(self.ts_string(), self.settings["decode_processes"]),
+                  file=sys.stderr,flush=True)
+            self.decode_pool = DecodePool(self.settings, self.settings["decode_processes"], self.publish_decoded)
+            self.decode_pool.start()
+
+        self.reload_thread = threading.Thread(target=self.reload_loop, name="decoder_reload", daemon=True)
+        self.reload_thread.start()
+
+        # Optional reload of the decoders when decoders/*.py or the decoders_file change
+        if "watch_decoders" in self.settings:
+            self.decoder_watcher = DecoderWatcher("decoders", self.settings["decoders_file"],
+                                                  self.reload, self.settings["watch_decoders"])
+            self.decoder_watcher.start()
+
         # Connect input and output MQTT brokers (which can be same or different)
         await self.connect_output_mqtt()
         # Note we start output connection FIRST and await it,
@@ -124,6 +183,13 @@ class DecoderManager():
             # parse file
         self.settings = json.loads(settings_data)
 
+        # select JSON backend for DecoderManager and decoders
+        if "json_backend" in self.settings:
+            json_backend = json.set_backend(self.settings["json_backend"])
+        else:
+            json_backend = json.set_backend()
+        print("{} using JSON backend {}".format(self.ts_string(), json_backend),file=sys.stderr,flush=True)
+
         self.load_decoders_file()
 
     def load_decoders_file(self):
@@ -144,35 +210,40 @@ class DecoderManager():
         self.import_decoders(self.settings["decoders"])
 
     # import a list of decoder names
+    # Only new or changed decoder modules are (re)imported (see decoder_loader.py), and
+    # the new decoder list is built aside and then swapped in
     def import_decoders(self, new_decoders):
-        self.decoders = []
-        for decoder_name in new_decoders:
-            self.import_decoder(decoder_name)
-
-    # import a decoder, given name
-    # Will add { "name": , "decoder": } to self.decoders list
-    def import_decoder(self, decoder_name):
-        print("loading Decoder {}".format(decoder_name), flush=True)
-        module_name = 'decoders.'+decoder_name
-        # A new module can be imported with importlib.import_module()
-        # BUT an already loaded module must use importlib.reload for update to work.
-        if module_name in sys.modules:
-            module = sys.modules[module_name]
-            importlib.reload(module)
-        else:
-            module = importlib.import_module(module_name)
-        # now we have the refreshed/new module, so put Decoder on list self.decoders
-        decoder = module.Decoder(self.settings)
-        print("    loaded Decoder {}".format(decoder_name), flush=True)
-        self.decoders.append({"name": decoder_name, "decoder": decoder })
+        decoders = self.decoder_loader.load(new_decoders, self.settings)
+        for decoder_name in self.decoder_loader.loaded:
+            print("    loaded Decoder {}".format(decoder_name), flush=True)
+        for decoder_name, e in self.decoder_loader.failed:
+            print("{} Decoder {} failed to load, {}: {}".format(
+                self.ts_string(),
+                decoder_name,
+                "keeping previous version" if decoder_name in self.decoder_loader.decoders else "not loaded",
+                repr(e)), file=sys.stderr, flush=True)
+        self.decoders = decoders
 
     ###############################################################
     # Sensor data message handler for incoming messages
     ###############################################################
 
     def handle_input_message(self, topic, msg_bytes, testing=False):
+        decoded = self.decode_message(topic, msg_bytes)
+
+        # testing=True will bypass MQTT and return the decoded message
+        if testing:
+            if decoded is not None:
+                return decoded
+            else:
+                print("Message not decoded")
+        else:
+            self.publish_decoded(topic, msg_bytes, decoded)
+
+    # Return message decoded by the first matching decoder, or None
+    # (also called in the DecodePool worker processes)
+    def decode_message(self, topic, msg_bytes):
         acp_ts = self.ts_string()
-        msg_is_decoded = False
         for decoder in self.decoders:
             try:
                 if decoder["decoder"].test(topic, msg_bytes):
@@ -188,24 +259,20 @@ class DecoderManager():
                             decoder["name"]), flush=True)
                     #debug testing timeout, disabled send:
                     #self.send_output_message(topic, decoded)
-                    msg_is_decoded = True
-                    break # terminate the loop through decoders when first is found
+                    return decoded # terminate the loop through decoders when first is found
             except:
                 print("{} acp_decoders.py exception from decoder {}:".format(acp_ts, decoder["name"]),
                       file=sys.stderr,
                       flush=True)
+        return None
 
-        # testing=True will bypass MQTT and return the decoded message
-        if testing:
-            if msg_is_decoded:
-                return decoded
-            else:
-                print("Message not decoded")
-        elif msg_is_decoded:
+    # Publish decoded message, or log if not decoded (decoded is None)
+    def publish_decoded(self, topic, msg_bytes, decoded):
+        if decoded is not None:
             self.send_output_message(topic, decoded)
         else:
             print("{} Incoming message not decoded\n{}\n".format(
-                acp_ts,
+                self.ts_string(),
                 msg_bytes), file=sys.stderr, flush=True)
 
     ##########################################################################
@@ -253,7 +320,15 @@ class DecoderManager():
                     self.ts_string(),
                     topic,
                     msg_bytes), flush=True)
-            self.handle_input_message(topic, msg_bytes)
+            if self.uplink_dedup is not None and self.uplink_dedup.is_duplicate(topic, msg_bytes):
+                if DEBUG:
+                    print("{} acp_decoders skipping duplicate: {}".format(
+                        self.ts_string(),
+                        topic), flush=True)
+            elif self.decode_pool is not None:
+                self.decode_pool.put(topic, msg_bytes)
+            else:
+                self.handle_input_message(topic, msg_bytes)
         else:
             if DEBUG:
                 print("{} acp_decoders skipping decoded: {}".format(
@@ -307,7 +382,16 @@ class DecoderManager():
         print("{} DecoderManager interrupted - disconnecting\n".format(
             self.ts_string()),file=sys.stderr,flush=True)
         await self.input_client.disconnect()
+        if self.decode_pool is not None:
+            # publish the messages still being decoded
+            await self.decode_pool.stop()
         await self.output_client.disconnect()
+        if self.decoder_watcher is not None:
+            self.decoder_watcher.stop()
+        if self.reload_thread is not None:
+            self.reload_stopping = True
+            self.reload_requested.set()
+            self.reload_thread.join()
 
 
 ###################################################################
@@ -337,6 +421,8 @@ if __name__ == '__main__':
 
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-    loop = asyncio.get_event_loop()
+    # newer Python / uvloop no longer create a loop in get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
     loop.run_until_complete(async_main())
@@ -5,27 +5,51 @@
 # Dynamically loads multiple Decoder classes, each providing
 #     .test(topic,msg_bytes)
 #     .decode(topic, msg_bytes)
+# and optionally
+#     .topics
+#     .decode_json(topic, msg_bytes, msg_dict)
+#     .decode_many(items)
 #
-# Iterates through each incoming message and testing
-# against each decoder. On first successful .test() will call
-# .decode() - see handle_input_message() - and then
-# re-publish the decoded message.
+# Decoders may declare MQTT-style topic patterns in .topics, which
+# are compiled into a TopicRouter trie. Each incoming message is
+# routed via the trie, with .test() only called for decoders that
+# declare no topics. The first matching decoder will have
+# .decode() called - see handle_input_message() - and then
+# the decoded message is re-published. A list of messages can be
+# decoded with handle_input_batch(), which calls .decode_many()
+# once for each decoder, if it has one.
 #
 # Uses 'settings.json' for required input/output connect info.
 #
+# Logging is via acp_log, which writes the log lines in batches from
+# a background thread, with a log level per category (input, decode,
+# publish, connection) - see settings["log"].
+#
 ##################################################################
 ##################################################################
 
-import simplejson as json
+import acp_json as json
+import acp_log as log
 
+import argparse
 import asyncio
 import os
 import sys
 import signal
+import threading
 import time
-import importlib
+from collections import deque
 from datetime import datetime, timezone
 
+from topic_router import TopicRouter, subscription_filters, filter_covers
+from output_queue import OutputQueue
+from output_spool import OutputSpool
+from uplink_dedup import UplinkDedup
+from decoder_stats import DecoderStats
+from decoder_loader import DecoderLoader
+from decoder_watcher import DecoderWatcher
+from metrics_server import MetricsServer, Metrics
+
 from gmqtt import Client as MQTTClient
 from gmqtt.mqtt.constants import MQTTv311
 
@@ -34,7 +58,15 @@ import paho.mqtt.client as mqtt
 # gmqtt compatible with uvloop
 import uvloop
 
-log_level = 2 # 3=default, 2=info, 1=debug
+log_level = 2 # 3=default, 2=info, 1=debug (default for each acp_log category, see settings["log"]["levels"])
+
+ROUTE_CACHE_SIZE = 4096 # default max topics in route cache, settings["route_cache_size"]
+
+SHARE_GROUP = "acp_decoders" # default shared subscription group for workers, settings["input_mqtt"]["share_group"]
+
+METRICS_RATE_WINDOW = 60 # seconds over which the metrics messages per second are averaged
+
+METRICS_QUANTILES = [ ("0.5", "p50_us"), ("0.9", "p90_us"), ("0.99", "p99_us"), ("0.999", "p99.9_us") ] # see DecoderStats
 
 #import logging
 #logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
@@ -51,13 +83,55 @@ class DecoderManager():
     ###################
     # Sync class init
     ###################
-    def __init__(self):
+    # worker is the index of this process in a multi-worker group (see run.sh), or None
+    def __init__(self, worker=None):
         print("acp_decoders_paho.py DecoderManager __init__", flush=True)
-        print("{} acp_decoders_paho.py initialized\n".format(self.ts_string()),file=sys.stderr,flush=True)
+        print("{} acp_decoders_paho.py initialized{}\n".format(
+            self.ts_string(),
+            "" if worker is None else " worker {}".format(worker)),file=sys.stderr,flush=True)
+
+        self.worker = worker
+
+        # input subscriptions, see update_subscriptions()
+        self.input_connected = False
+        self.subscriptions = []
+
+        # route cache counters, see route_decoders()
+        self.route_cache_hits = 0
+        self.route_cache_misses = 0
+
+        # per-decoder test()/decode() latencies and counters, see decoder_stats()
+        self.decoder_stats = DecoderStats()
+
+        # counters for the metrics endpoint, see metrics()
+        self.start_time = time.time()
+        self.messages_in = 0
+        self.last_message_time = None
+        self.reload_count = 0
+        self.rate_samples = deque() # (time, messages_in, messages_out, spool drained) at each metrics() call
+        self.rate_samples_lock = threading.Lock() # metrics() may be called by overlapping requests
+        self.metrics_server = None
+        self.output_spool = None
+
+        # imports the decoders, see import_decoders()
+        self.decoder_loader = DecoderLoader()
+        # reload() (SIGALRM or the DecoderWatcher) requests a reload, made by the
+        # decoder_reload thread, see reload_loop()
+        self.reload_requested = threading.Event()
+        self.reload_lock = threading.Lock()
+        self.reload_thread = None
+        self.reload_stopping = False
+        self.decoder_watcher = None
 
         # load settings.json into self.settings
         self.read_settings()
 
+        # Optionally drop repeated copies of TTN uplinks before decoding, see is_duplicate()
+        if "dedup" in self.settings:
+            self.uplink_dedup = UplinkDedup(self.settings["dedup"])
+        else:
+            self.uplink_dedup = None
+
 
     #####################################
     # Signal handler for SIGINT, SIGTERM
@@ -66,10 +140,33 @@ class DecoderManager():
         self.STOP.set()
 
     #####################################
-    # Signal handler for SIGALRM
+    # Signal handler for SIGALRM, also called by the DecoderWatcher thread
+    # Only requests the reload, so the MQTT network loop is not blocked
+    # while the decoders are imported
     #####################################
     def reload(self,*args):
-        self.load_decoders_file()
+        self.reload_requested.set()
+
+    # decoder_reload thread, reloads the decoders after each reload() request
+    # (requests made during a reload give one more reload)
+    def reload_loop(self):
+        while True:
+            self.reload_requested.wait()
+            if self.reload_stopping:
+                return
+            self.reload_requested.clear()
+            try:
+                self.reload_decoders()
+            except Exception as e:
+                log.error(log.DECODE, "{} reload exception {}", self.ts_string(), repr(e))
+
+    def reload_decoders(self):
+        with self.reload_lock:
+            self.reload_count += 1
+            self.load_decoders_file()
+            # subscriptions may have changed with the decoders' topics
+            if self.input_connected:
+                self.update_subscriptions()
 
     #####################################
     # Return current timestamp as string
@@ -82,18 +179,99 @@ class DecoderManager():
     ###############################################################
     def start(self):
         print("{} acp_decoders started\n".format(self.ts_string()),file=sys.stderr,flush=True)
+
+        # From here log records are written by the acp_log thread
+        log.start()
+
         # Define async events for exit and reload (will set via signals)
         #self.STOP = asyncio.Event()
         #self.RELOAD = asyncio.Event()
 
-        self.client = mqtt.Client("acp_decoders_paho"+str(log_level)+"_"+datetime.now().strftime("%Y-%m-%d"))
+        client_id = "acp_decoders_paho"+str(log_level)+"_"+datetime.now().strftime("%Y-%m-%d")
+        # Each worker in a group needs its own client id
+        if self.worker is not None:
+            client_id += "_w"+str(self.worker)
+
+        # Separate MQTT clients for input (subscribe) and output (publish), so publishing
+        # never stalls the input connection, and the brokers can be on different hosts.
+        # settings["input_mqtt"]["protocol"] = 5 selects MQTT v5 for the input connection.
+        self.mqtt_v5 = "protocol" in self.settings["input_mqtt"] and self.settings["input_mqtt"]["protocol"] == 5
+        if self.mqtt_v5:
+            self.client = mqtt.Client(client_id, protocol=mqtt.MQTTv5)
+        else:
+            self.client = mqtt.Client(client_id)
+        self.output_client = mqtt.Client(client_id+"_output")
+        self.output_connected = False
+
+        # Decoded messages are queued and published in batches by the OutputQueue thread
+        if "output_queue" in self.settings:
+            self.output_queue = OutputQueue(self.publish_output_message, self.settings["output_queue"])
+        else:
+            self.output_queue = OutputQueue(self.publish_output_message)
+        self.output_queue.start()
+
+        # Optionally spool decoded messages to disk while the output broker is not connected,
+        # each worker in its own directory
+        if "output_spool" in self.settings:
+            spool_settings = dict(self.settings["output_spool"])
+            if self.worker is not None:
+                spool_settings["directory"] = spool_settings.get("directory", "spool")+"_w"+str(self.worker)
+            self.output_spool = OutputSpool(self.publish_spooled_message, spool_settings)
+            self.output_spool.start()
+
+        # Optional HTTP metrics endpoint, each worker on its own port (port + worker)
+        if "metrics" in self.settings:
+            metrics_settings = dict(self.settings["metrics"])
+            if self.worker is not None and "port" in metrics_settings:
+                metrics_settings["port"] += self.worker
+            self.metrics_server = MetricsServer(self.metrics, metrics_settings)
+            self.metrics_server.start()
+
+        self.reload_thread = threading.Thread(target=self.reload_loop, name="decoder_reload", daemon=True)
+        self.reload_thread.start()
+
+        # Optional reload of the decoders when decoders/*.py or the decoders_file change
+        if "watch_decoders" in self.settings:
+            self.decoder_watcher = DecoderWatcher("decoders", self.settings["decoders_file"],
+                                                  self.reload, self.settings["watch_decoders"])
+            self.decoder_watcher.start()
 
         # Connect input and output MQTT brokers (which can be same or different)
+        # Note we start output connection FIRST,
+        # otherwise we risk getting an input and failing on publish.
+        # The output client connects (and reconnects) in its own network loop thread, so
+        # the decoders keep running while the output broker is down, including at startup,
+        # with messages spooled (settings["output_spool"]) until output_on_connect()
+        self.connect_output_mqtt()
+        self.output_client.loop_start()
+
         self.connect_mqtt()
 
         self.client.loop_forever()
 
 
+    def connect_output_mqtt(self):
+        print("\n{} connecting to OUTPUT MQTT {}:{} as {}".format(
+            self.ts_string(),
+            self.settings["output_mqtt"]["host"],
+            self.settings["output_mqtt"]["port"],
+            self.settings["output_mqtt"]["user"],
+            ),file=sys.stderr,flush=True)
+
+        self.output_client.on_connect = self.output_on_connect
+        self.output_client.on_message = self.output_on_message
+        self.output_client.on_disconnect = self.output_on_disconnect
+        self.output_client.on_subscribe = self.output_on_subscribe
+
+        user = self.settings["output_mqtt"]["user"]
+        password = self.settings["output_mqtt"]["password"]
+        host = self.settings["output_mqtt"]["host"]
+        port = self.settings["output_mqtt"]["port"]
+
+        self.output_client.username_pw_set(user, password=password)
+
+        self.output_client.connect_async(host, port, keepalive=60)
+
     def connect_mqtt(self):
         print("\n{} connecting to MQTT {}:{} as {}".format(
             self.ts_string(),
@@ -116,46 +294,205 @@ class DecoderManager():
 
         self.client.connect(host, port, keepalive=30)
 
+    ###############################################################
+    # Route cache
+    #
+    # Returns the list of decoders matching topic, i.e. with a topic
+    # pattern matching or .test() True, in decoders.json order.
+    # Results are kept in an LRU cache keyed by topic, so .test() is
+    # assumed to depend only on the topic. The cache belongs to the
+    # current TopicRouter, so is discarded with it on reload.
+    ###############################################################
+
+    def route_decoders(self, topic, msg_bytes):
+        router = self.router
+        cache = router.cache
+        decoders = cache.get(topic)
+        if decoders is not None:
+            self.route_cache_hits += 1
+            cache.move_to_end(topic)
+            return decoders
+
+        self.route_cache_misses += 1
+        decoders = []
+        for decoder, needs_test in router.route(topic):
+            if not needs_test:
+                decoders.append(decoder)
+                continue
+            start_time = time.perf_counter()
+            try:
+                matched = decoder["decoder"].test(topic, msg_bytes)
+            except Exception as e:
+                self.decoder_stats.test_error(decoder["name"])
+                log.error(log.DECODE, "{} acp_decoders.py exception from decoder test {} on {}: {}",
+                    self.ts_string(), decoder["name"], topic, repr(e))
+                continue
+            self.decoder_stats.test_time(decoder["name"], time.perf_counter() - start_time)
+            if matched:
+                decoders.append(decoder)
+
+        cache[topic] = decoders
+        if len(cache) > self.route_cache_size:
+            cache.popitem(last=False) # discard least recently used
+        return decoders
+
+    # Return the route cache counters as a dictionary
+    def route_cache_stats(self):
+        return { "hits": self.route_cache_hits,
+                 "misses": self.route_cache_misses,
+                 "size": len(self.router.cache),
+                 "max_size": self.route_cache_size
+               }
+
     ###############################################################
     # Sensor data message handler for incoming messages
     ###############################################################
 
+    # Return True if settings["dedup"] is given and the message is a copy of a
+    # TTN uplink already received (e.g. via another bridge), see uplink_dedup.py
+    def is_duplicate(self, topic, msg_bytes):
+        if self.uplink_dedup is None or not self.uplink_dedup.is_duplicate(topic, msg_bytes):
+            return False
+        log.info(log.INPUT, "{} acp_decoders skipping duplicate INPUT MSG: {}", self.ts_string(), topic)
+        return True
+
+    # Return the dedup counters as a dictionary (None if not deduplicating)
+    def dedup_stats(self):
+        return None if self.uplink_dedup is None else self.uplink_dedup.stats()
+
     def handle_input_message(self, topic, msg_bytes, testing=False):
         acp_ts = self.ts_string()
-        msg_is_decoded = False
-        for decoder in self.decoders:
-            try:
-                if decoder["decoder"].test(topic, msg_bytes):
-                    decoded = decoder["decoder"].decode(topic, msg_bytes)
-                    # If no acp_ts from decoder, insert from server time
-                    if not "acp_ts" in decoded:
-                        decoded["acp_ts"] = acp_ts
-
-                    if log_level < 3:
-                        print("{} {} decoded by {}".format(
-                            acp_ts,
-                            decoded["acp_id"],
-                            decoder["name"]), flush=True)
-
-                    msg_is_decoded = True
-                    break # terminate the loop through decoders when first is found
-            except:
-                print("{} acp_decoders.py exception from decoder {}:".format(acp_ts, decoder["name"]),
-                      file=sys.stderr,
-                      flush=True)
+        decoded = self.decode_input(self.route_decoders(topic, msg_bytes), topic, msg_bytes, acp_ts)
 
         # testing=True will bypass MQTT and return the decoded message
         if testing:
-            if msg_is_decoded:
+            if decoded is not None:
                 return decoded
             else:
                 print("Message not decoded")
-        elif msg_is_decoded:
+        else:
+            self.send_decoded(topic, msg_bytes, decoded, acp_ts)
+
+    # Decode the message with the first of decoders which succeeds,
+    # returning the decoded dictionary or None
+    def decode_input(self, decoders, topic, msg_bytes, acp_ts):
+        msg_dict = None # JSON payload parsed on demand for decode_json()
+        for decoder in decoders:
+            start_time = time.perf_counter()
+            try:
+                if hasattr(decoder["decoder"], "decode_json"):
+                    if msg_dict is None:
+                        msg_dict = json.loads(msg_bytes)
+                    # The decoder may modify msg_dict, so if it raises an exception
+                    # any later decode_json() decoder gets a freshly parsed copy
+                    parsed_dict = msg_dict
+                    msg_dict = None
+                    decoded = decoder["decoder"].decode_json(topic, msg_bytes, parsed_dict)
+                else:
+                    decoded = decoder["decoder"].decode(topic, msg_bytes)
+                # If no acp_ts from decoder, insert from server time
+                if not "acp_ts" in decoded:
+                    decoded["acp_ts"] = acp_ts
+
+                self.decoder_stats.decode_time(decoder["name"], time.perf_counter() - start_time)
+                log.info(log.DECODE, "{} {} decoded by {}", acp_ts, decoded["acp_id"], decoder["name"])
+
+                return decoded # the first decoder to succeed is used
+            except Exception as e:
+                self.decoder_stats.decode_error(decoder["name"])
+                log.error(log.DECODE, "{} acp_decoders.py exception from decoder {} on {}: {}",
+                    acp_ts, decoder["name"], topic, repr(e))
+        return None
+
+    # Publish the decoded message, or count and log it as not decoded if decoded is None
+    def send_decoded(self, topic, msg_bytes, decoded, acp_ts):
+        if decoded is not None:
             self.send_output_message(topic, decoded)
         else:
-            print("{} Incoming message not decoded\n{}\n".format(
-                acp_ts,
-                msg_bytes), file=sys.stderr, flush=True)
+            self.decoder_stats.undecoded()
+            log.error(log.DECODE, "{} Incoming message not decoded\n{}\n", acp_ts, msg_bytes)
+
+    ###############################################################
+    # Batch decoding
+    #
+    # handle_input_batch(messages) decodes and publishes a list of
+    # (topic, msg_bytes), in order, as handle_input_message() would.
+    # It is not used by on_message(), which decodes each message as it
+    # arrives, but by benchmarks/decoder_bench.py --batch to measure
+    # decode_many() (and by any caller with messages already queued).
+    # The messages are grouped by the first decoder they are routed
+    # to, and each group decoded with one call of the decoder's
+    # optional decode_many(items), items being the list of
+    # (topic, msg_bytes, msg_dict), which returns the list of decoded
+    # dictionaries (or None if not decoded) in the same order.
+    # Decoders without decode_many() are called for each message as
+    # usual. If decode_many() raises an exception, or a message is
+    # not JSON, those messages are decoded one by one, with the later
+    # routed decoders tried too.
+    #
+    # As in decode_input(), the decode time recorded for each message
+    # includes parsing its JSON.
+    ###############################################################
+
+    def handle_input_batch(self, messages):
+        acp_ts = self.ts_string()
+        if self.uplink_dedup is not None:
+            messages = [ message for message in messages if not self.is_duplicate(*message) ]
+        routes = [ self.route_decoders(topic, msg_bytes) for topic, msg_bytes in messages ]
+
+        # first routed decoder name -> (decoder, list of message indexes)
+        groups = {}
+        for index, decoders in enumerate(routes):
+            if decoders:
+                groups.setdefault(decoders[0]["name"], (decoders[0], []))[1].append(index)
+
+        results = [ None ] * len(messages)
+        for decoder, indexes in groups.values():
+            if hasattr(decoder["decoder"], "decode_many"):
+                self.decode_group(decoder, messages, indexes, results, acp_ts)
+
+        for index, (topic, msg_bytes) in enumerate(messages):
+            decoded = results[index]
+            if decoded is None:
+                decoded = self.decode_input(routes[index], topic, msg_bytes, acp_ts)
+            self.send_decoded(topic, msg_bytes, decoded, acp_ts)
+
+    # Decode messages[indexes] with one decoder.decode_many() call, setting results[indexes]
+    def decode_group(self, decoder, messages, indexes, results, acp_ts):
+        start_time = time.perf_counter()
+        items = []
+        item_indexes = []
+        for index in indexes:
+            topic, msg_bytes = messages[index]
+            try:
+                items.append((topic, msg_bytes, json.loads(msg_bytes)))
+            except Exception:
+                continue # left for decode_input() to report
+            item_indexes.append(index)
+        if not items:
+            return
+
+        try:
+            decoded_list = decoder["decoder"].decode_many(items)
+            if len(decoded_list) != len(items):
+                raise ValueError("decode_many() returned {} results for {} messages".format(len(decoded_list), len(items)))
+        except Exception as e:
+            self.decoder_stats.decode_error(decoder["name"])
+            log.error(log.DECODE, "{} acp_decoders.py exception from decoder {} decode_many() on {} messages: {}",
+                acp_ts, decoder["name"], len(items), repr(e))
+            return
+        # each message is counted with the mean time per message, parsing included
+        message_time = (time.perf_counter() - start_time) / len(items)
+
+        for index, decoded in zip(item_indexes, decoded_list):
+            if decoded is None:
+                continue # left for decode_input()
+            # If no acp_ts from decoder, insert from server time
+            if not "acp_ts" in decoded:
+                decoded["acp_ts"] = acp_ts
+            self.decoder_stats.decode_time(decoder["name"], message_time)
+            log.info(log.DECODE, "{} {} decoded by {}", acp_ts, decoded["acp_id"], decoder["name"])
+            results[index] = decoded
 
     ##########################################################################
     # Publish decoded message to output topic.
@@ -173,93 +510,341 @@ class DecoderManager():
         else:
             output_topic += "unknown_id/"
         output_topic += topic_in
-        if log_level < 3:
-            print("{} Publishing topic {}".format(
-                self.ts_string(),
-                output_topic), flush=True)
+        log.info(log.PUBLISH, "{} Publishing topic {}", self.ts_string(), output_topic)
 
         # Publish output message
         msg_bytes = json.dumps(decoded_dict)
-        if log_level < 2:
-            print("{} publishing {}".format(self.ts_string(),msg_bytes), flush=True)
+        log.debug(log.PUBLISH, "{} publishing {}", self.ts_string(), msg_bytes)
+
+        if not self.output_queue.put(output_topic, msg_bytes):
+            log.error(log.PUBLISH, "{} output queue full, dropped {}", self.ts_string(), output_topic)
+
+    # Called from the OutputQueue thread to publish each queued message,
+    # returns False if the output client did not accept it (e.g. not connected)
+    # With settings["output_spool"], messages are spooled while the output broker is not
+    # connected, and until the spool has drained, so they are published in order
+    # (returning True, the spool counting them as spooled, drained or dropped)
+    def publish_output_message(self, output_topic, msg_bytes):
+        if self.output_spool is not None and (not self.output_connected or self.output_spool.depth() > 0):
+            if not self.output_spool.put(output_topic, msg_bytes):
+                log.error(log.PUBLISH, "{} output spool full, dropped {}", self.ts_string(), output_topic)
+            return True
+        return self.output_client.publish(output_topic, msg_bytes, qos=0).rc == mqtt.MQTT_ERR_SUCCESS
+
+    # Called from the OutputSpool thread to publish each spooled message,
+    # returns False if not published
+    def publish_spooled_message(self, output_topic, msg_bytes):
+        if not self.output_connected:
+            return False
+        return self.output_client.publish(output_topic, msg_bytes, qos=0).rc == mqtt.MQTT_ERR_SUCCESS
+
+    # Return the output queue depth and counters as a dictionary
+    def output_queue_stats(self):
+        return self.output_queue.stats()
+
+    # Return the output spool depth, size and counters as a dictionary (None if not spooling)
+    def output_spool_stats(self):
+        return None if self.output_spool is None else self.output_spool.stats()
+
+    # Return the acp_log queue depth and counters as a dictionary
+    def log_stats(self):
+        return log.stats()
+
+    # Return the per-decoder test()/decode() latencies (microseconds) and
+    # match/error counts, plus the count of undecoded messages, as a dictionary
+    def decoder_stats_summary(self):
+        return self.decoder_stats.stats()
+
+    # Return the payload cache counters of each decoder with a payload
+    # cache (see payload_cache.py) as a dictionary, by decoder name
+    def payload_cache_stats(self):
+        return { decoder["name"]: decoder["decoder"].payload_cache.stats()
+                 for decoder in self.decoders
+                 if getattr(decoder["decoder"], "payload_cache", None) is not None }
+
+    ###############################################################
+    # Metrics for the MetricsServer (called in its request thread)
+    # Returns a Metrics object with the current values, for GET /metrics
+    ###############################################################
+
+    def metrics(self):
+        # the samples are taken and added to rate_samples under the lock, so
+        # overlapping calls keep rate_samples in time order
+        with self.rate_samples_lock:
+            now = time.time()
+            messages_in = self.messages_in
+            output_stats = self.output_queue_stats()
+            messages_out = output_stats["published"]
+            spool_stats = self.output_spool_stats()
+            if spool_stats is not None:
+                # messages the OutputQueue passed to the spool are published when drained
+                messages_out += spool_stats["drained"] - spool_stats["spooled"] - spool_stats["dropped"]
+                spool_drained = spool_stats["drained"]
+            else:
+                spool_drained = 0
+
+            # messages per second since the oldest sample within METRICS_RATE_WINDOW
+            # (or since start if this is the first call)
+            rate_samples = self.rate_samples
+            rate_samples.append((now, messages_in, messages_out, spool_drained))
+            while len(rate_samples) > 2 and now - rate_samples[1][0] >= METRICS_RATE_WINDOW:
+                rate_samples.popleft()
+            if len(rate_samples) > 1:
+                since, messages_in_since, messages_out_since, spool_drained_since = rate_samples[0]
+            else:
+                since, messages_in_since, messages_out_since, spool_drained_since = self.start_time, 0, 0, 0
+        elapsed = max(now - since, 0.001)
+
+        metrics = Metrics()
+        metrics.add("acp_decoders_messages_in_total", "counter",
+                    "Messages received on the input connection.", messages_in)
+        metrics.add("acp_decoders_messages_out_total", "counter",
+                    "Decoded messages published on the output connection.", messages_out)
+        metrics.add("acp_decoders_messages_in_per_second", "gauge",
+                    "Input messages per second over the last {} seconds.".format(METRICS_RATE_WINDOW),
+                    round((messages_in - messages_in_since) / elapsed, 3))
+        metrics.add("acp_decoders_messages_out_per_second", "gauge",
+                    "Published messages per second over the last {} seconds.".format(METRICS_RATE_WINDOW),
+                    round((messages_out - messages_out_since) / elapsed, 3))
+        metrics.add("acp_decoders_messages_dropped_total", "counter",
+                    "Decoded messages dropped with the output queue full.", output_stats["dropped"])
+        metrics.add("acp_decoders_messages_failed_total", "counter",
+                    "Decoded messages not accepted by the output connection (e.g. not connected).",
+                    output_stats["failed"])
+        metrics.add("acp_decoders_output_queue_depth", "gauge",
+                    "Decoded messages waiting to be published.", output_stats["depth"])
+        if spool_stats is not None:
+            metrics.add("acp_decoders_output_spool_depth", "gauge",
+                        "Decoded messages in the output spool.", spool_stats["depth"])
+            metrics.add("acp_decoders_output_spool_bytes", "gauge",
+                        "Bytes of decoded messages in the output spool.", spool_stats["bytes"])
+            metrics.add("acp_decoders_output_spool_spooled_total", "counter",
+                        "Decoded messages written to the output spool.", spool_stats["spooled"])
+            metrics.add("acp_decoders_output_spool_drained_total", "counter",
+                        "Spooled messages published.", spool_stats["drained"])
+            metrics.add("acp_decoders_output_spool_dropped_total", "counter",
+                        "Decoded messages dropped with the output spool full.", spool_stats["dropped"])
+            metrics.add("acp_decoders_output_spool_drained_per_second", "gauge",
+                        "Spooled messages published per second over the last {} seconds.".format(METRICS_RATE_WINDOW),
+                        round((spool_drained - spool_drained_since) / elapsed, 3))
+            metrics.add("acp_decoders_output_spool_drain_rate", "gauge",
+                        "Maximum spooled messages published per second.", spool_stats["drain_rate"])
+
+        dedup_stats = self.dedup_stats()
+        if dedup_stats is not None:
+            metrics.add("acp_decoders_duplicates_total", "counter",
+                        "Input messages dropped as copies of a TTN uplink already received.", dedup_stats["duplicates"])
+            metrics.add("acp_decoders_dedup_keys", "gauge",
+                        "TTN uplink keys held for deduplication.", dedup_stats["size"])
+
+        decoder_stats = self.decoder_stats_summary()
+        metrics.add("acp_decoders_undecoded_total", "counter",
+                    "Messages not decoded by any decoder.", decoder_stats["undecoded"])
+        decoders = decoder_stats["decoders"]
+        metrics.add("acp_decoders_decoded_total", "counter", "Messages decoded, by decoder.",
+                    [ ({ "decoder": name }, stats["matches"]) for name, stats in decoders.items() ])
+        metrics.add("acp_decoders_decode_errors_total", "counter", "Exceptions from decode(), by decoder.",
+                    [ ({ "decoder": name }, stats["decode_errors"]) for name, stats in decoders.items() ])
+        metrics.add_summary("acp_decoders_decode_latency_seconds", "Time taken by decode(), by decoder.",
+                    [ ({ "decoder": name },
+                       { quantile: seconds(stats["decode"][key]) for quantile, key in METRICS_QUANTILES },
+                       seconds(stats["decode"]["total_us"]),
+                       stats["decode"]["count"])
+                      for name, stats in decoders.items() ])
+        payload_caches = self.payload_cache_stats()
+        metrics.add("acp_decoders_payload_cache_hits_total", "counter",
+                    "decodePayload() results returned from the payload cache, by decoder.",
+                    [ ({ "decoder": name }, stats["hits"]) for name, stats in payload_caches.items() ])
+        metrics.add("acp_decoders_payload_cache_misses_total", "counter",
+                    "decodePayload() calls not found in the payload cache, by decoder.",
+                    [ ({ "decoder": name }, stats["misses"]) for name, stats in payload_caches.items() ])
+
+        metrics.add("acp_decoders_connected", "gauge", "1 if the MQTT connection is up.",
+                    [ ({ "connection": "input" }, self.input_connected),
+                      ({ "connection": "output" }, self.output_connected) ])
+        metrics.add("acp_decoders_reloads_total", "counter",
+                    "Decoder reloads (SIGALRM or watch_decoders).", self.reload_count)
+        metrics.add("acp_decoders_seconds_since_last_message", "gauge",
+                    "Seconds since the last input message (since start if none).",
+                    round(now - (self.last_message_time or self.start_time), 3))
+        return metrics
 
-        self.client.publish(output_topic, msg_bytes, qos=0)
+    #####################################
+    # Signal handler for SIGUSR1 (see stats.sh)
+    # Logs the current stats as JSON, without stopping the process
+    #####################################
+    def write_stats(self, *args):
+        stats = { "decoders": self.decoder_stats_summary(),
+                  "route_cache": self.route_cache_stats(),
+                  "payload_cache": self.payload_cache_stats(),
+                  "output_queue": self.output_queue_stats(),
+                  "output_spool": self.output_spool_stats(),
+                  "dedup": self.dedup_stats(),
+                  "log": self.log_stats()
+                }
+        log.notice(log.DECODE, "{} acp_decoders stats {}", self.ts_string(), json.simplejson_dumps(stats))
 
     ###############################################################
     # MQTT INPUT
     ###############################################################
 
-    def on_connect(self, client, userdata, flags, rc):
+    # properties is given for MQTT v5 connections
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         if rc==0:
-            print('{} Connected to {} as {}'.format(
+            self.input_connected = True
+            log.notice(log.CONNECTION, '{} Connected to {} as {}',
                 self.ts_string(),
                 self.settings["input_mqtt"]["host"],
-                self.settings["input_mqtt"]["user"]),file=sys.stderr, flush=True)
-            print('{} Subscribing to {}'.format(
-                self.ts_string(),
-                self.settings["input_mqtt"]["topic"]),file=sys.stderr, flush=True)
-            self.client.subscribe('#',1) # default is qos=0
+                self.settings["input_mqtt"]["user"], stderr=True)
+            # (re)subscribe to all current filters
+            self.subscriptions = []
+            self.update_subscriptions()
         else:
-            print("Bad connection Returned code=",rc)
-            print('{} Connect FAILED to {} as {} rc={}'.format(
+            log.notice(log.CONNECTION, "Bad connection Returned code={}", rc)
+            log.error(log.CONNECTION, '{} Connect FAILED to {} as {} rc={}',
                 self.ts_string(),
                 self.settings["input_mqtt"]["host"],
-                self.settings["input_mqtt"]["user"]),
-                rc,
-                file=sys.stderr, flush=True)
+                self.settings["input_mqtt"]["user"],
+                rc)
+
+    ###############################################################
+    # Input subscriptions
+    #
+    # Subscribes to settings["input_mqtt"]["topics"] if given (a list of
+    # MQTT filters), otherwise to the minimal set of filters covering the
+    # topics declared by the decoders, with settings["input_mqtt"]["topic"]
+    # (default '#') used for any decoder without declared topics.
+    #
+    # If settings["input_mqtt"]["share_group"] is given, or this is a
+    # worker in a group (see run.sh), the filters are subscribed to as
+    # shared subscriptions '$share/<group>/<filter>' so the broker
+    # load-balances messages across the worker group.
+    #
+    # With MQTT v5 the subscriptions use 'no local' so messages published
+    # on the input connection are not sent back to it. Decoded messages
+    # are published on the output connection though, so it is the filters
+    # not covering the output topic_prefix that stop our own output being
+    # received (if they do, on_message() discards those messages).
+    ###############################################################
+
+    # Return the list of MQTT filters to subscribe to
+    def subscription_filters(self):
+        input_settings = self.settings["input_mqtt"]
+        if "topics" in input_settings:
+            return list(input_settings["topics"])
+        if "topic" in input_settings:
+            default_filter = input_settings["topic"]
+        else:
+            default_filter = '#'
+        return subscription_filters(self.decoders, default_filter)
+
+    # Return the shared subscription group name, or None
+    def share_group(self):
+        if "share_group" in self.settings["input_mqtt"]:
+            return self.settings["input_mqtt"]["share_group"]
+        if self.worker is not None:
+            return SHARE_GROUP
+        return None
+
+    # Return the topic to subscribe to for MQTT filter
+    def subscription_topic(self, topic_filter):
+        share_group = self.share_group()
+        if share_group is None:
+            return topic_filter
+        return "$share/"+share_group+"/"+topic_filter
+
+    # Subscribe / unsubscribe the input client so it matches subscription_filters()
+    def update_subscriptions(self):
+        filters = self.subscription_filters()
+
+        output_topic = self.settings["output_mqtt"]["topic_prefix"]+"acp_id/topic"
+        for topic_filter in filters:
+            if filter_covers(topic_filter, output_topic):
+                log.error(log.CONNECTION, '{} WARNING subscription {} includes output topic {}',
+                    self.ts_string(),
+                    topic_filter,
+                    self.settings["output_mqtt"]["topic_prefix"])
+
+        removed = [ topic_filter for topic_filter in self.subscriptions if not topic_filter in filters ]
+        added = [ topic_filter for topic_filter in filters if not topic_filter in self.subscriptions ]
+
+        # subscribe to new filters before unsubscribing, so no messages are missed
+        if added:
+            log.notice(log.CONNECTION, '{} Subscribing to {}', self.ts_string(), added, stderr=True)
+            if self.mqtt_v5:
+                # 'no local' is a protocol error on shared subscriptions
+                options = mqtt.SubscribeOptions(qos=1, noLocal=self.share_group() is None)
+            else:
+                options = 1 # qos
+            self.client.subscribe([ (self.subscription_topic(topic_filter), options) for topic_filter in added ])
+        if removed:
+            log.notice(log.CONNECTION, '{} Unsubscribing from {}', self.ts_string(), removed, stderr=True)
+            self.client.unsubscribe([ self.subscription_topic(topic_filter) for topic_filter in removed ])
+
+        self.subscriptions = filters
 
     def on_message(self, client, userdata, message):
+        self.messages_in += 1
+        self.last_message_time = time.time()
+        # paho decodes message.topic from bytes on every access, so it is read once,
+        # and message.payload is passed on as the received bytes, not copied
+        topic = message.topic
+        msg_bytes = message.payload
         # IMPORTANT! We avoid a loop by ignoring input messages with the output prefix
-        if not message.topic.startswith(self.settings["output_mqtt"]["topic_prefix"]):
-            if log_level < 2:
-                print("{} acp_decoders INPUT MSG: {}\n{}".format(
+        if not topic.startswith(self.settings["output_mqtt"]["topic_prefix"]):
+            if log.enabled(log.INPUT, log.DEBUG):
+                log.debug(log.INPUT, "{} acp_decoders INPUT MSG: {}\n{}",
                     self.ts_string(),
-                    message.topic,
-                    message.payload),file=sys.stderr, flush=True)
-            elif log_level < 3:
-                print("{} acp_decoders INPUT MSG: {}".format(
-                    self.ts_string(),
-                    message.topic), flush=True)
-            self.handle_input_message(message.topic, message.payload)
-        elif log_level < 3:
-            print("{} acp_decoders skipping INPUT MSG on output topic: {}".format(
-                self.ts_string(),
-                message.topic),flush=True)
+                    topic,
+                    msg_bytes, stderr=True)
+            else:
+                log.info(log.INPUT, "{} acp_decoders INPUT MSG: {}", self.ts_string(), topic)
+            if not self.is_duplicate(topic, msg_bytes):
+                self.handle_input_message(topic, msg_bytes)
+        else:
+            log.info(log.INPUT, "{} acp_decoders skipping INPUT MSG on output topic: {}", self.ts_string(), topic)
 
-    def on_disconnect(self,client, userdata, rc):
-        print("\n{} acp_decoders INPUT Disconnected".format(
-            self.ts_string()),file=sys.stderr,flush=True)
+    def on_disconnect(self,client, userdata, rc, properties=None):
+        self.input_connected = False
+        log.notice(log.CONNECTION, "\n{} acp_decoders INPUT Disconnected", self.ts_string(), stderr=True)
 
-    def on_subscribe(self, client, userdata, mid, granted_qos):
-        print('{} acp_decoders INPUT SUBSCRIBED to {}'.format(
-            self.ts_string(),
-            self.settings["input_mqtt"]["topic"]),file=sys.stderr, flush=True)
+    def on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
+        log.notice(log.CONNECTION, '{} acp_decoders INPUT SUBSCRIBED to {}', self.ts_string(), self.subscriptions, stderr=True)
 
     ###############################################################
     # MQTT OUTPUT
     ###############################################################
 
-    def output_on_connect(self, client, flags, rc, properties):
-        # Log a connection statement to stdout and stderr
-        print('OUTPUT Connected to {} as {}'.format(
-            self.settings["output_mqtt"]["host"],
-            self.settings["output_mqtt"]["user"]), flush=True)
-        print('{} INPUT Connected to {} as {}'.format(
-            self.ts_string(),
-            self.settings["output_mqtt"]["host"],
-            self.settings["output_mqtt"]["user"]),file=sys.stderr,flush=True)
+    def output_on_connect(self, client, userdata, flags, rc):
+        if rc==0:
+            self.output_connected = True
+            # Log a connection statement to stdout and stderr
+            log.notice(log.CONNECTION, 'OUTPUT Connected to {} as {}',
+                self.settings["output_mqtt"]["host"],
+                self.settings["output_mqtt"]["user"])
+            log.notice(log.CONNECTION, '{} OUTPUT Connected to {} as {}',
+                self.ts_string(),
+                self.settings["output_mqtt"]["host"],
+                self.settings["output_mqtt"]["user"], stderr=True)
+        else:
+            log.error(log.CONNECTION, '{} OUTPUT Connect FAILED to {} as {} rc={}',
+                self.ts_string(),
+                self.settings["output_mqtt"]["host"],
+                self.settings["output_mqtt"]["user"],
+                rc)
 
-    def output_on_disconnect(self, client, packet, exc=None):
-        print('OUTPUT Disconnected', flush=True)
-        print("{} OUTPUT Disconnected\n".format(self.ts_string()),file=sys.stderr,flush=True)
+    def output_on_disconnect(self, client, userdata, rc):
+        self.output_connected = False
+        log.notice(log.CONNECTION, 'OUTPUT Disconnected')
+        log.notice(log.CONNECTION, "{} OUTPUT Disconnected rc={}\n", self.ts_string(), rc, stderr=True)
 
-    # These GMQTT methods here for completeness although not used
+    # These methods here for completeness although not used (no output subscriptions)
 
-    def output_on_message(self, client, topic, msg_bytes, qos, properties):
-        print('OUTPUT RECV MSG?:', msg_bytes, flush=True)
+    def output_on_message(self, client, userdata, message):
+        log.notice(log.CONNECTION, 'OUTPUT RECV MSG?: {}', message.payload)
 
-    def output_on_subscribe(self, client, mid, qos, properties):
-        print('{} OUTPUT SUBSCRIBED?'.format(self.ts_string()), flush=True)
+    def output_on_subscribe(self, client, userdata, mid, granted_qos):
+        log.notice(log.CONNECTION, '{} OUTPUT SUBSCRIBED?', self.ts_string())
 
     ###############################################################
     # Settings, including loading enabled decoders
@@ -274,6 +859,20 @@ class DecoderManager():
 
             # parse file
         self.settings = json.loads(settings_data)
+
+        # select JSON backend for DecoderManager and decoders
+        if "json_backend" in self.settings:
+            json_backend = json.set_backend(self.settings["json_backend"])
+        else:
+            json_backend = json.set_backend()
+        print("{} using JSON backend {}".format(self.ts_string(), json_backend),file=sys.stderr,flush=True)
+
+        # set the acp_log category levels, sampling and batching
+        if "log" in self.settings:
+            log.configure(self.settings["log"], log_level)
+        else:
+            log.configure(log_level=log_level)
+
         self.load_decoders_file()
         print("{} settings.json loaded".format(self.ts_string()),file=sys.stderr,flush=True)
 
@@ -295,27 +894,36 @@ class DecoderManager():
         self.import_decoders(self.settings["decoders"])
 
     # import a list of decoder names
+    # Only new or changed decoder modules are (re)imported (see decoder_loader.py), and
+    # the new decoder list and router are built aside and then swapped in, so messages
+    # arriving during a reload are routed with either the old or the new decoders
     def import_decoders(self, new_decoders):
-        self.decoders = []
-        for decoder_name in new_decoders:
-            self.import_decoder(decoder_name)
-
-    # import a decoder, given name
-    # Will add { "name": , "decoder": } to self.decoders list
-    def import_decoder(self, decoder_name):
-        print("loading Decoder {}".format(decoder_name), flush=True)
-        module_name = 'decoders.'+decoder_name
-        # A new module can be imported with importlib.import_module()
-        # BUT an already loaded module must use importlib.reload for update to work.
-        if module_name in sys.modules:
-            module = sys.modules[module_name]
-            importlib.reload(module)
+        decoders = self.decoder_loader.load(new_decoders, self.settings)
+        for decoder_name in self.decoder_loader.loaded:
+            log.notice(log.DECODE, "    loaded Decoder {}", decoder_name)
+        for decoder_name, e in self.decoder_loader.failed:
+            log.error(log.DECODE, "{} Decoder {} failed to load, {}: {}",
+                self.ts_string(),
+                decoder_name,
+                "keeping previous version" if decoder_name in self.decoder_loader.decoders else "not loaded",
+                repr(e))
+
+        # compile the topic patterns declared by the decoders
+        # (this also replaces the route cache, see route_decoders())
+        if "route_cache_size" in self.settings:
+            route_cache_size = self.settings["route_cache_size"]
         else:
-            module = importlib.import_module(module_name)
-        # now we have the refreshed/new module, so put Decoder on list self.decoders
-        decoder = module.Decoder(self.settings)
-        print("    loaded Decoder {}".format(decoder_name), flush=True)
-        self.decoders.append({"name": decoder_name, "decoder": decoder })
+            route_cache_size = ROUTE_CACHE_SIZE
+        if (hasattr(self, "router") and decoders == self.decoders and
+            route_cache_size == self.route_cache_size):
+            log.notice(log.DECODE, "{} decoders unchanged", self.ts_string())
+            return
+        router = TopicRouter(decoders)
+        if hasattr(self, "router"):
+            log.notice(log.DECODE, "{} route cache flushed {}", self.ts_string(), self.route_cache_stats())
+        self.route_cache_size = route_cache_size
+        self.decoders = decoders
+        self.router = router
 
     ###############################################################
     # CLEANUP on EXIT SIGNAL (SIGINT or SIGTERM)
@@ -323,23 +931,60 @@ class DecoderManager():
 
     def finish(self):
         #await self.STOP.wait()
-        print("\nDecoderManager interrupted, closing MQTT clients", flush=True)
-        print("{} DecoderManager interrupted - disconnecting\n".format(
-            self.ts_string()),file=sys.stderr,flush=True)
-        #await self.input_client.disconnect()
-        #await self.output_client.disconnect()
+        log.notice(log.CONNECTION, "\nDecoderManager interrupted, closing MQTT clients")
+        log.notice(log.CONNECTION, "{} DecoderManager interrupted - disconnecting\n", self.ts_string(), stderr=True)
+        # publish any queued decoded messages
+        self.output_queue.stop()
+        # leave any spooled messages on disk for the next start
+        if self.output_spool is not None:
+            self.output_spool.stop()
+        self.client.disconnect()
+        self.output_client.disconnect()
+        self.output_client.loop_stop()
+        if self.decoder_watcher is not None:
+            self.decoder_watcher.stop()
+        if self.reload_thread is not None:
+            self.reload_stopping = True
+            self.reload_requested.set()
+            self.reload_thread.join()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        # write any queued log records
+        log.stop()
+
+
+# Convert microseconds (from DecoderStats) to seconds for the metrics
+def seconds(microseconds):
+    return None if microseconds is None else microseconds / 1000000
 
+###################################################################
+# Set up argument parsing
+###################################################################
+
+def parse_init():
+    parser = argparse.ArgumentParser(description='Decode MQTT sensor messages and re-publish on the acp/ topic.')
+    parser.add_argument('--worker', type=int, default=None,
+                        help='Index of this process in a group of workers sharing the input subscriptions (see run.sh).')
+
+    return parser
 
 ###################################################################
 # Program main
-# Sets up asyncio, runs async_main()
 ###################################################################
 if __name__ == '__main__':
 
+    parser = parse_init()
+    args = parser.parse_args()
+
     print(f'acp_decoders_paho loaded')
 
     # Instantiate a DecoderManager
-    decoder_manager = DecoderManager()
+    decoder_manager = DecoderManager(worker=args.worker)
+
+    # kill -SIGUSR1 <pid> logs the decoder stats (see stats.sh)
+    signal.signal(signal.SIGUSR1, decoder_manager.write_stats)
+    # kill -SIGALRM <pid> reloads the decoders (see reload.sh)
+    signal.signal(signal.SIGALRM, decoder_manager.reload)
 
     # Add signal handlers for EXIT and RELOAD
     #loop.add_signal_handler(signal.SIGINT, decoder_manager.ask_exit)
@@ -0,0 +1,97 @@
+##################################################################
+##################################################################
+# acp_json
+#
+# Pluggable JSON backend used by DecoderManager and the decoders:
+#
+#    import acp_json as json
+#    msg_dict = json.loads(msg_bytes)
+#    msg_out = json.dumps(msg_dict) # str or bytes, either can be published
+#
+# The backend is selected with set_backend(name), name from the
+# settings.json "json_backend" property:
+#     "simplejson": simplejson for loads() and dumps() (default)
+#     "orjson":     orjson (C-backed, much faster) if installed
+#     "auto":       orjson if installed, otherwise simplejson
+#
+# Where orjson cannot parse a document (e.g. NaN, integers > 64 bits)
+# the simplejson result is returned instead, so the backends accept the
+# same input and a failed parse always raises acp_json.JSONDecodeError.
+#
+# The orjson dumps() output is not byte-identical to simplejson: it is
+# compact (no spaces after ',' and ':'), writes non-ASCII characters
+# as UTF-8 rather than \u escapes, and writes NaN and Infinity as null
+# where simplejson raises ValueError. So orjson is only used when
+# selected in settings.json.
+##################################################################
+##################################################################
+
+import simplejson
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSONDecodeError = simplejson.JSONDecodeError
+
+DEFAULT_BACKEND = "simplejson"
+
+###############################################################
+# simplejson backend
+###############################################################
+
+def simplejson_loads(msg):
+    return simplejson.loads(msg)
+
+def simplejson_dumps(obj):
+    return simplejson.dumps(obj)
+
+###############################################################
+# orjson backend
+###############################################################
+
+# simplejson serializes bytes as utf-8 strings, so orjson does too
+def orjson_default(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return str(obj, 'utf-8')
+    raise TypeError
+
+def orjson_loads(msg):
+    try:
+        return orjson.loads(msg)
+    except orjson.JSONDecodeError:
+        return simplejson.loads(msg)
+
+def orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        return simplejson.dumps(obj)
+
+BACKENDS = { "simplejson": (simplejson_loads, simplejson_dumps) }
+
+if orjson is not None:
+    BACKENDS["orjson"] = (orjson_loads, orjson_dumps)
+
+###############################################################
+# Backend selection
+###############################################################
+
+backend = None
+
+# Select backend by name, returning the name of the backend in use
+def set_backend(name=None):
+    global backend, loads, dumps
+    if name is None:
+        name = DEFAULT_BACKEND
+    if name == "auto":
+        name = "orjson" if "orjson" in BACKENDS else "simplejson"
+    elif not name in BACKENDS:
+        print("acp_json backend {} not available, using simplejson".format(name), flush=True)
+        name = "simplejson"
+    backend = name
+    loads, dumps = BACKENDS[name]
+    return backend
+
+set_backend(DEFAULT_BACKEND)
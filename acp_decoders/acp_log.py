@@ -0,0 +1,214 @@
+##################################################################
+##################################################################
+# acp_log
+#
+# Buffered logging for DecoderManager, so the per-message log lines
+# are not each a blocking write on the MQTT message handling path.
+#
+#    import acp_log as log
+#    log.configure(settings["log"], log_level)
+#    log.start()
+#    ...
+#    log.info(log.DECODE, "{} {} decoded by {}", acp_ts, acp_id, decoder_name)
+#    log.error(log.DECODE, "{} exception from decoder {}", acp_ts, decoder_name)
+#    ...
+#    log.stop() # writes remaining records
+#
+# Records are put on a queue with their format string and arguments
+# (formatted later, only if written), and a background thread writes
+# them to stdout/stderr in batches, with one flush per batch.
+# Before start() (e.g. in test scripts) records are written
+# immediately.
+#
+# Each category (INPUT, DECODE, PUBLISH, CONNECTION) has its own log
+# level, as for log_level in DecoderManager: 3=default, 2=info, 1=debug.
+# notice() records are written if the category level is 3 or less
+# (i.e. by default), info() records if it is 2 or less, debug() records
+# if it is 1, and error() records always (to stderr).
+#
+# Settings (all optional), e.g.
+#     "log": { "levels": { "input": 3, "decode": 2, "publish": 3, "connection": 2 },
+#              "sample": { "decode": 100 },
+#              "batch_size": 1000,
+#              "batch_interval": 0.2,
+#              "max_size": 100000
+#            }
+# "sample" writes only 1-in-N of the info/debug records in a category
+# (e.g. the "decoded by" lines under load). If "max_size" records are
+# waiting, new records are dropped (and counted) rather than blocking.
+##################################################################
+##################################################################
+
+import sys
+import threading
+from collections import deque
+
+# Categories
+INPUT = "input"
+DECODE = "decode"
+PUBLISH = "publish"
+CONNECTION = "connection"
+
+CATEGORIES = [ INPUT, DECODE, PUBLISH, CONNECTION ]
+
+# Levels
+DEBUG = 1
+INFO = 2
+NOTICE = 3
+
+# default settings, override with settings["log"]
+LOG_SETTINGS = { "batch_size": 1000,
+                 "batch_interval": 0.2,
+                 "max_size": 100000
+               }
+
+levels = { category: NOTICE for category in CATEGORIES } # category -> level
+sample = {} # category -> N
+sample_counts = {} # category -> count of records seen
+
+batch_size = LOG_SETTINGS["batch_size"]
+batch_interval = LOG_SETTINGS["batch_interval"]
+max_size = LOG_SETTINGS["max_size"]
+
+queue = deque() # (file, format_string, args)
+condition = threading.Condition()
+running = False
+thread = None
+
+# counters for stats()
+written = 0
+dropped = 0
+sampled_out = 0
+max_depth = 0
+
+# Set the category levels (default log_level) and options from settings["log"]
+def configure(log_settings=None, log_level=NOTICE):
+    global batch_size, batch_interval, max_size
+
+    if log_settings is None:
+        log_settings = {}
+    for category in CATEGORIES:
+        levels[category] = log_level
+    if "levels" in log_settings:
+        levels.update(log_settings["levels"])
+
+    sample.clear()
+    sample_counts.clear()
+    if "sample" in log_settings:
+        sample.update({ category: n for category, n in log_settings["sample"].items() if n > 1 })
+
+    options = dict(LOG_SETTINGS)
+    options.update(log_settings)
+    batch_size = options["batch_size"]
+    batch_interval = options["batch_interval"]
+    max_size = options["max_size"]
+
+# True if records at level in category will be written (before sampling),
+# for callers to skip building expensive arguments
+def enabled(category, level):
+    return levels[category] <= level
+
+def debug(category, format_string, *args, stderr=False):
+    if levels[category] <= DEBUG:
+        log(category, format_string, args, sys.stderr if stderr else sys.stdout, True)
+
+def info(category, format_string, *args, stderr=False):
+    if levels[category] <= INFO:
+        log(category, format_string, args, sys.stderr if stderr else sys.stdout, True)
+
+def notice(category, format_string, *args, stderr=False):
+    if levels[category] <= NOTICE:
+        log(category, format_string, args, sys.stderr if stderr else sys.stdout, False)
+
+def error(category, format_string, *args):
+    log(category, format_string, args, sys.stderr, False)
+
+# Queue a record, or write it if the writer thread is not running
+def log(category, format_string, args, file, sampled):
+    global dropped, sampled_out, max_depth
+
+    if sampled and category in sample:
+        count = sample_counts.get(category, 0)
+        sample_counts[category] = count + 1
+        if count % sample[category] != 0:
+            sampled_out += 1
+            return
+
+    if not running:
+        write([ (file, format_string, args) ])
+        return
+
+    with condition:
+        depth = len(queue)
+        if depth >= max_size:
+            dropped += 1
+            return
+        queue.append((file, format_string, args))
+        if depth + 1 > max_depth:
+            max_depth = depth + 1
+        if depth == 0 or depth + 1 >= batch_size:
+            condition.notify()
+
+def start():
+    global running, thread
+    running = True
+    thread = threading.Thread(target=run, name="acp_log", daemon=True)
+    thread.start()
+
+# Stop the writer thread after writing the waiting records
+def stop():
+    global running, thread
+    with condition:
+        running = False
+        condition.notify()
+    if thread is not None:
+        thread.join()
+        thread = None
+
+def stats():
+    return { "depth": len(queue),
+             "max_depth": max_depth,
+             "written": written,
+             "dropped": dropped,
+             "sampled_out": sampled_out
+           }
+
+###############################################################
+# Writer thread
+###############################################################
+
+def run():
+    while True:
+        with condition:
+            while running and not queue:
+                condition.wait()
+            # collect records for up to batch_interval, or until a full batch
+            if running and len(queue) < batch_size:
+                condition.wait(batch_interval)
+
+            if not queue:
+                return # stopped and queue is empty
+            batch = [ queue.popleft() for i in range(min(batch_size, len(queue))) ]
+
+        write(batch)
+
+# Write the records, with one write and flush per file
+def write(batch):
+    global written
+
+    lines = { sys.stdout: [], sys.stderr: [] }
+    for file, format_string, args in batch:
+        try:
+            text = format_string.format(*args) if args else format_string
+        except Exception as e:
+            text = "acp_log format error {} {}".format(repr(format_string), e)
+        lines.setdefault(file, []).append(text)
+
+    for file, file_lines in lines.items():
+        if file_lines:
+            try:
+                file.write("\n".join(file_lines)+"\n")
+                file.flush()
+            except Exception:
+                pass
+    written += len(batch)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+####################################################################
+# decoder_bench.py
+#
+# Throughput benchmark of DecoderManager.handle_input_message(),
+# replaying synthesised mixed sensor traffic in-process (no MQTT).
+#
+# Message templates are read from decoder_tests/*.json (TTN v3
+# uplinks, topic v3/<application_id>@ttn/devices/<device_id>/up)
+# and data/elsys.txt, data/adeunis.txt (TTN v2 '<topic> <json>'
+# lines, which the v3 decoders do not decode, so these measure the
+# undecoded path). Each template is a sensor type, e.g. "elsys-co2",
+# "v2-elsys-ems", and is replayed as --devices devices, each with
+# its own device_id and frame counter.
+#
+# Decoded messages go through send_output_message() to an
+# OutputQueue whose publish() discards them.
+#
+# Reports, per sensor type, messages/sec and p50/p99 latency of
+# handle_input_message(), and allocated bytes per message (from a
+# separate tracemalloc pass, so it does not slow the timed run),
+# plus per decoder the decode() latency from DecoderStats.
+#
+# --batch N replays the messages N at a time through
+# DecoderManager.handle_input_batch() instead, with each message's
+# latency the mean per message of its batch.
+#
+# Usage (from the acp_decoders directory):
+#     python3 benchmarks/decoder_bench.py [--messages N] [--devices N]
+#         [--mix elsys-co2:4,elsys-ems:2,rad-ath:1] [--batch N] [--json results.json]
+#
+# --json writes the results as JSON (use '-' for stdout) so runs can
+# be compared over time.
+####################################################################
+
+import argparse
+import contextlib
+import copy
+import gc
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+ACP_DECODERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ACP_DECODERS_DIR)
+
+import acp_json as json
+import acp_log as log
+from decoder_stats import DecoderStats, LatencyHistogram
+from output_queue import OutputQueue
+
+V2_DATA_FILES = [ "data/elsys.txt", "data/adeunis.txt" ]
+
+####################################################################
+# Message templates
+####################################################################
+
+# Return the sensor type and device_id prefix for a device_id,
+# e.g. "elsys-co2-0460ec" -> "elsys-co2", "elsys-co2-"
+def device_type(device_id):
+    prefix = device_id.rsplit("-", 1)[0]
+    return prefix, prefix+"-"
+
+# Return dictionary of sensor type -> template
+# template is { "version": 2 or 3, "msg": dict, "topic_format": str, "device_prefix": str }
+def load_templates():
+    templates = {}
+
+    for file_name in sorted(os.listdir("decoder_tests")):
+        if not file_name.endswith(".json") or "cooked" in file_name:
+            continue
+        with open(os.path.join("decoder_tests", file_name), "r") as json_file:
+            msg = json.loads(json_file.read())
+        if not "end_device_ids" in msg:
+            continue
+        sensor_type, device_prefix = device_type(msg["end_device_ids"]["device_id"])
+        application_id = msg["end_device_ids"]["application_ids"]["application_id"]
+        templates[sensor_type] = { "version": 3,
+                                   "msg": msg,
+                                   "topic_format": "v3/"+application_id+"@ttn/devices/{}/up",
+                                   "device_prefix": device_prefix
+                                 }
+
+    for file_name in V2_DATA_FILES:
+        with open(file_name, "r") as data_file:
+            for line in data_file:
+                line = line.strip()
+                if not line:
+                    continue
+                topic, msg_text = line.split(" ", 1)
+                msg = json.loads(msg_text)
+                sensor_type, device_prefix = device_type(msg["dev_id"])
+                sensor_type = "v2-"+sensor_type
+                if sensor_type in templates:
+                    continue # first message of each type
+                templates[sensor_type] = { "version": 2,
+                                           "msg": msg,
+                                           "topic_format": topic.replace(msg["dev_id"], "{}"),
+                                           "device_prefix": device_prefix
+                                         }
+    return templates
+
+# Return list of (sensor_type, topic, msg_bytes) for count messages from
+# devices devices of each type in mix (sensor_type -> weight)
+def build_messages(templates, mix, devices, count, rng):
+    sensor_types = list(mix)
+    weights = [ mix[sensor_type] for sensor_type in sensor_types ]
+
+    device_ids = { sensor_type: [ "{}{:06x}".format(templates[sensor_type]["device_prefix"], n)
+                                  for n in range(devices) ]
+                   for sensor_type in sensor_types }
+    counters = {}
+
+    messages = []
+    for sensor_type in rng.choices(sensor_types, weights=weights, k=count):
+        template = templates[sensor_type]
+        device_id = rng.choice(device_ids[sensor_type])
+        counter = counters.get(device_id, 0) + 1
+        counters[device_id] = counter
+
+        msg = copy.deepcopy(template["msg"])
+        if template["version"] == 3:
+            msg["end_device_ids"]["device_id"] = device_id
+            msg["uplink_message"]["f_cnt"] = counter
+        else:
+            msg["dev_id"] = device_id
+            msg["counter"] = counter
+        msg_bytes = json.dumps(msg)
+        if isinstance(msg_bytes, str):
+            msg_bytes = msg_bytes.encode("utf-8")
+        messages.append((sensor_type, template["topic_format"].format(device_id), msg_bytes))
+    return messages
+
+# Parse --mix "type:weight,..." into dictionary, default all v3 types weight 1
+def parse_mix(mix_arg, templates):
+    if mix_arg is None:
+        return { sensor_type: 1 for sensor_type, template in templates.items() if template["version"] == 3 }
+    mix = {}
+    for item in mix_arg.split(","):
+        sensor_type, _, weight = item.partition(":")
+        if not sensor_type in templates:
+            print("ERROR unknown sensor type {}, available: {}".format(sensor_type, ", ".join(templates)))
+            exit(1)
+        mix[sensor_type] = float(weight) if weight else 1
+    return mix
+
+####################################################################
+# Benchmark
+####################################################################
+
+def make_decoder_manager():
+    from acp_decoders import DecoderManager
+
+    # startup messages to stderr, so --json - gives just the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        decoder_manager = DecoderManager()
+    # only errors and notices, not a "decoded by" line per message
+    log.configure(log_level=log.NOTICE)
+    return decoder_manager
+
+# Replay messages, returning elapsed seconds and sensor_type -> LatencyHistogram
+def run_timed(decoder_manager, messages, batch):
+    if batch:
+        return run_timed_batch(decoder_manager, messages, batch)
+    histograms = {}
+    perf_counter = time.perf_counter
+    handle_input_message = decoder_manager.handle_input_message
+
+    gc.collect()
+    start_time = perf_counter()
+    for sensor_type, topic, msg_bytes in messages:
+        message_start = perf_counter()
+        handle_input_message(topic, msg_bytes)
+        message_time = perf_counter() - message_start
+        histogram = histograms.get(sensor_type)
+        if histogram is None:
+            histogram = histograms[sensor_type] = LatencyHistogram()
+        histogram.record(message_time)
+    elapsed = perf_counter() - start_time
+    return elapsed, histograms
+
+# As run_timed(), replaying batch messages at a time with handle_input_batch()
+def run_timed_batch(decoder_manager, messages, batch):
+    histograms = {}
+    perf_counter = time.perf_counter
+    handle_input_batch = decoder_manager.handle_input_batch
+    batches = [ messages[index:index+batch] for index in range(0, len(messages), batch) ]
+    batch_inputs = [ [ (topic, msg_bytes) for sensor_type, topic, msg_bytes in batch_messages ]
+                     for batch_messages in batches ]
+
+    gc.collect()
+    start_time = perf_counter()
+    for batch_messages, batch_input in zip(batches, batch_inputs):
+        batch_start = perf_counter()
+        handle_input_batch(batch_input)
+        message_time = (perf_counter() - batch_start) / len(batch_input)
+        for sensor_type, topic, msg_bytes in batch_messages:
+            histogram = histograms.get(sensor_type)
+            if histogram is None:
+                histogram = histograms[sensor_type] = LatencyHistogram()
+            histogram.record(message_time)
+    elapsed = perf_counter() - start_time
+    return elapsed, histograms
+
+# Return sensor_type -> mean bytes allocated (traced peak) per message
+def run_allocations(decoder_manager, messages):
+    totals = {}
+    counts = {}
+    tracemalloc.start()
+    for sensor_type, topic, msg_bytes in messages:
+        tracemalloc.reset_peak()
+        before, peak = tracemalloc.get_traced_memory()
+        decoder_manager.handle_input_message(topic, msg_bytes)
+        after, peak = tracemalloc.get_traced_memory()
+        totals[sensor_type] = totals.get(sensor_type, 0) + peak - before
+        counts[sensor_type] = counts.get(sensor_type, 0) + 1
+    tracemalloc.stop()
+    return { sensor_type: round(totals[sensor_type] / counts[sensor_type]) for sensor_type in totals }
+
+def run(args):
+    os.chdir(ACP_DECODERS_DIR)
+
+    rng = random.Random(args.seed)
+    templates = load_templates()
+    mix = parse_mix(args.mix, templates)
+
+    decoder_manager = make_decoder_manager()
+    # publish() discards the messages, but they are still serialized and queued
+    decoder_manager.output_queue = OutputQueue(lambda topic, msg_bytes: True, { "max_size": args.messages+1 })
+    decoder_manager.output_queue.start()
+
+    warmup = build_messages(templates, mix, args.devices, args.warmup, rng)
+    messages = build_messages(templates, mix, args.devices, args.messages, rng)
+
+    for sensor_type, topic, msg_bytes in warmup:
+        decoder_manager.handle_input_message(topic, msg_bytes)
+    # decoder stats for the timed run only
+    decoder_manager.decoder_stats = DecoderStats()
+
+    elapsed, histograms = run_timed(decoder_manager, messages, args.batch)
+    decoder_stats = decoder_manager.decoder_stats_summary()
+
+    allocations = run_allocations(decoder_manager, messages[:args.alloc_messages])
+
+    decoder_manager.output_queue.stop()
+
+    results = { "timestamp": time.time(),
+                "python": platform.python_version(),
+                "json_backend": json.backend,
+                "config": { "messages": args.messages,
+                            "devices": args.devices,
+                            "warmup": args.warmup,
+                            "seed": args.seed,
+                            "batch": args.batch,
+                            "mix": mix
+                          },
+                "total": { "messages": len(messages),
+                           "seconds": round(elapsed, 6),
+                           "messages_per_sec": round(len(messages) / elapsed, 1),
+                           "undecoded": decoder_stats["undecoded"]
+                         },
+                "types": {},
+                "decoders": {}
+              }
+
+    for sensor_type, histogram in sorted(histograms.items()):
+        stats = histogram.stats()
+        results["types"][sensor_type] = { "messages": stats["count"],
+                                          "messages_per_sec": round(stats["count"] / (stats["total_us"] / 1e6), 1)
+                                                              if stats["total_us"] else None,
+                                          "p50_us": stats["p50_us"],
+                                          "p99_us": stats["p99_us"],
+                                          "alloc_bytes_per_msg": allocations.get(sensor_type)
+                                        }
+
+    for decoder_name, stats in sorted(decoder_stats["decoders"].items()):
+        decode = stats["decode"]
+        results["decoders"][decoder_name] = { "messages": stats["matches"],
+                                              "decode_errors": stats["decode_errors"],
+                                              "messages_per_sec": round(decode["count"] / (decode["total_us"] / 1e6), 1)
+                                                                  if decode["total_us"] else None,
+                                              "p50_us": decode["p50_us"],
+                                              "p99_us": decode["p99_us"]
+                                            }
+    return results
+
+def print_results(results):
+    total = results["total"]
+    print("\n{} messages in {:.3f}s: {:.0f} messages/sec ({} undecoded, JSON backend {})".format(
+        total["messages"], total["seconds"], total["messages_per_sec"], total["undecoded"], results["json_backend"]))
+
+    print("\nhandle_input_message() by sensor type:")
+    print("  {:<20} {:>9} {:>12} {:>8} {:>8} {:>12}".format("type", "messages", "msgs/sec", "p50 us", "p99 us", "alloc B/msg"))
+    for sensor_type, stats in results["types"].items():
+        print("  {:<20} {:>9} {:>12} {:>8} {:>8} {:>12}".format(
+            sensor_type, stats["messages"], str(stats["messages_per_sec"]),
+            stats["p50_us"], stats["p99_us"], str(stats["alloc_bytes_per_msg"])))
+
+    print("\ndecode() by decoder:")
+    print("  {:<20} {:>9} {:>12} {:>8} {:>8} {:>8}".format("decoder", "messages", "msgs/sec", "p50 us", "p99 us", "errors"))
+    for decoder_name, stats in results["decoders"].items():
+        print("  {:<20} {:>9} {:>12} {:>8} {:>8} {:>8}".format(
+            decoder_name, stats["messages"], str(stats["messages_per_sec"]),
+            str(stats["p50_us"]), str(stats["p99_us"]), stats["decode_errors"]))
+
+####################################################################
+# Set up argument parsing
+####################################################################
+
+def parse_init():
+    parser = argparse.ArgumentParser(description='Benchmark DecoderManager.handle_input_message() with synthesised mixed sensor traffic.')
+    parser.add_argument('--messages', type=int, default=20000, help='Number of messages timed (default 20000).')
+    parser.add_argument('--warmup', type=int, default=1000, help='Number of messages decoded before timing (default 1000).')
+    parser.add_argument('--devices', type=int, default=100, help='Number of devices of each sensor type (default 100).')
+    parser.add_argument('--mix', default=None,
+                        help='Sensor type weights, e.g. "elsys-co2:4,elsys-ems:2,rad-ath:1" (default all v3 types equally).')
+    parser.add_argument('--alloc-messages', type=int, default=2000,
+                        help='Number of messages replayed under tracemalloc for alloc B/msg (default 2000).')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='Replay the messages this many at a time with handle_input_batch() (default 0, one at a time).')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the traffic mix (default 1).')
+    parser.add_argument('--json', default=None, help='Write results as JSON to this file (- for stdout).')
+    parser.add_argument('--list', action='store_true', help='List the available sensor types and exit.')
+
+    return parser
+
+####################################################################
+#
+# Main
+#
+####################################################################
+
+if __name__ == '__main__':
+
+    parser = parse_init()
+    args = parser.parse_args()
+
+    if args.list:
+        os.chdir(ACP_DECODERS_DIR)
+        for sensor_type, template in load_templates().items():
+            print("{:<20} TTN v{}".format(sensor_type, template["version"]))
+        exit(0)
+
+    results = run(args)
+
+    if args.json == "-":
+        print(json.simplejson_dumps(results))
+    else:
+        print_results(results)
+        if args.json is not None:
+            with open(args.json, "w") as json_file:
+                json_file.write(json.simplejson_dumps(results))
+            print("\nresults written to {}".format(args.json))
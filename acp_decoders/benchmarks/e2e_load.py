@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+####################################################################
+# e2e_load.py
+#
+# End-to-end load test of acp_decoders through an MQTT broker:
+#     publish -> broker -> on_message -> decode -> publish -> broker -> acp/#
+#
+# Starts a local broker (mosquitto if installed, otherwise the
+# pure-Python stand-in benchmarks/mqtt_broker.py) on a free port,
+# and an acp_decoders process (acp_decoders.py (paho) or
+# acp_decoders_gmqtt.py) with a temporary settings.json pointing at
+# it. Then publishes synthesised sensor messages (as
+# decoder_bench.py) at --rate messages/sec for --duration seconds,
+# each with an embedded "acp_load": { "seq": n, "ts": send time },
+# and subscribes to the output acp/# topics to measure the
+# end-to-end latency of every decoded message that comes back.
+#
+# Reports messages sent and received, drops (sent but not received
+# within --drain seconds of the end), duplicates, and latency
+# percentiles, optionally as JSON.
+#
+# Usage (from the acp_decoders directory):
+#     python3 benchmarks/e2e_load.py [--decoders paho|gmqtt] [--broker auto|mosquitto|python]
+#         [--rate 500] [--duration 10] [--json results.json]
+####################################################################
+
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ACP_DECODERS_DIR = os.path.abspath(os.path.join(BENCHMARKS_DIR, '..'))
+
+sys.path.insert(0, ACP_DECODERS_DIR)
+
+import paho.mqtt.client as mqtt
+
+import acp_json as json
+from decoder_stats import LatencyHistogram
+from decoder_bench import load_templates, build_messages, parse_mix
+
+DECODERS_SCRIPTS = { "paho": "acp_decoders.py",
+                     "gmqtt": "acp_decoders_gmqtt.py"
+                   }
+
+PROBE_TIMEOUT = 30 # seconds to wait for acp_decoders to start decoding
+
+####################################################################
+# Broker and acp_decoders processes
+####################################################################
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Return broker Popen listening on port, writing its log in work_dir
+def start_broker(broker, port, work_dir):
+    if broker == "auto":
+        broker = "mosquitto" if shutil.which("mosquitto") else "python"
+    log_file = open(os.path.join(work_dir, "broker.log"), "w")
+    if broker == "mosquitto":
+        config_file = os.path.join(work_dir, "mosquitto.conf")
+        with open(config_file, "w") as config:
+            config.write("listener {} 127.0.0.1\nallow_anonymous true\n".format(port))
+        command = [ "mosquitto", "-c", config_file ]
+    else:
+        command = [ sys.executable, os.path.join(BENCHMARKS_DIR, "mqtt_broker.py"), "--port", str(port) ]
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+    wait_for_port(port)
+    return broker, process
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("broker did not start on port {}".format(port))
+
+# Write settings.json for acp_decoders in work_dir, connecting to the broker on port
+def write_settings(work_dir, port, decode_processes):
+    with open(os.path.join(ACP_DECODERS_DIR, "settings.json"), "r") as settings_file:
+        settings = json.loads(settings_file.read())
+
+    broker_settings = { "user": "acp_load", "password": "acp_load", "host": "127.0.0.1", "port": port }
+    settings["input_mqtt"] = dict(settings["input_mqtt"], **broker_settings)
+    settings["input_mqtt"].pop("protocol", None) # the python broker is MQTT 3.1.1 only
+    settings["input_mqtt"].pop("share_group", None)
+    settings["output_mqtt"] = dict(settings["output_mqtt"], **broker_settings)
+    settings["decoders_file"] = os.path.join(ACP_DECODERS_DIR, settings["decoders_file"])
+    settings["decode_processes"] = decode_processes
+    settings.pop("metrics", None)
+    settings.pop("workers", None)
+
+    with open(os.path.join(work_dir, "settings.json"), "w") as settings_file:
+        settings_file.write(json.simplejson_dumps(settings))
+    return settings
+
+# Return acp_decoders Popen, run in work_dir (for its settings.json), logging to work_dir
+def start_decoders(decoders, work_dir):
+    stdout = open(os.path.join(work_dir, "acp_decoders.log"), "w")
+    stderr = open(os.path.join(work_dir, "acp_decoders.err"), "w")
+    command = [ sys.executable, os.path.join(ACP_DECODERS_DIR, DECODERS_SCRIPTS[decoders]) ]
+    return subprocess.Popen(command, cwd=work_dir, stdout=stdout, stderr=stderr)
+
+def stop_process(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+####################################################################
+# Load generator and latency probe
+####################################################################
+
+class LatencyProbe():
+
+    def __init__(self, port, topic_prefix):
+        self.histogram = LatencyHistogram()
+        self.received = set() # seq of received messages
+        self.duplicates = 0
+        self.probes = 0
+        self.lock = threading.Lock()
+
+        self.client = mqtt.Client("acp_load_probe")
+        self.client.on_connect = lambda client, userdata, flags, rc: client.subscribe(topic_prefix+"#", qos=0)
+        self.client.on_message = self.on_message
+        self.client.connect("127.0.0.1", port, keepalive=30)
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, message):
+        receive_time = time.time()
+        try:
+            acp_load = json.loads(message.payload)["acp_load"]
+        except Exception:
+            return # not one of ours
+        with self.lock:
+            seq = acp_load["seq"]
+            if seq < 0:
+                self.probes += 1
+            elif seq in self.received:
+                self.duplicates += 1
+            else:
+                self.received.add(seq)
+                self.histogram.record(receive_time - acp_load["ts"])
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+# Return msg_bytes with "acp_load" inserted as its first property
+def load_message(msg_bytes, seq):
+    return b'{"acp_load":{"seq":%d,"ts":%.6f},' % (seq, time.time()) + msg_bytes[1:]
+
+# Publish probe messages until acp_decoders returns one, return seconds waited
+def wait_for_decoders(publisher, probe, messages, decoders_process):
+    start_time = time.monotonic()
+    while probe.probes == 0:
+        if decoders_process.poll() is not None:
+            raise RuntimeError("acp_decoders exited with {}".format(decoders_process.returncode))
+        if time.monotonic() - start_time > PROBE_TIMEOUT:
+            raise RuntimeError("no decoded messages received within {} seconds".format(PROBE_TIMEOUT))
+        sensor_type, topic, msg_bytes = messages[0]
+        publisher.publish(topic, load_message(msg_bytes, -1), qos=0)
+        time.sleep(0.2)
+    return time.monotonic() - start_time
+
+# Publish messages at rate per second for duration seconds, return (sent, seconds)
+def publish_load(publisher, messages, rate, duration):
+    count = int(rate * duration)
+    start_time = time.monotonic()
+    for seq in range(count):
+        send_time = start_time + seq / rate
+        delay = send_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        sensor_type, topic, msg_bytes = messages[seq % len(messages)]
+        publisher.publish(topic, load_message(msg_bytes, seq), qos=0)
+    return count, time.monotonic() - start_time
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix="acp_load_")
+    port = free_port()
+    broker_process = None
+    decoders_process = None
+    probe = None
+    publisher = None
+    try:
+        os.chdir(ACP_DECODERS_DIR)
+        templates = load_templates()
+        mix = parse_mix(args.mix, templates)
+        messages = build_messages(templates, mix, args.devices, min(int(args.rate * args.duration), 100000),
+                                  random.Random(args.seed))
+
+        broker, broker_process = start_broker(args.broker, port, work_dir)
+        settings = write_settings(work_dir, port, args.decode_processes)
+        decoders_process = start_decoders(args.decoders, work_dir)
+
+        probe = LatencyProbe(port, settings["output_mqtt"]["topic_prefix"])
+        publisher = mqtt.Client("acp_load_publisher")
+        publisher.connect("127.0.0.1", port, keepalive=30)
+        publisher.loop_start()
+
+        startup = wait_for_decoders(publisher, probe, messages, decoders_process)
+        print("acp_decoders ({}) decoding after {:.1f}s, {} broker on port {}, logs in {}".format(
+            args.decoders, startup, broker, port, work_dir), file=sys.stderr)
+
+        sent, seconds = publish_load(publisher, messages, args.rate, args.duration)
+
+        # wait for the last messages, up to args.drain seconds
+        deadline = time.monotonic() + args.drain
+        while len(probe.received) < sent and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+        with probe.lock:
+            received = len(probe.received)
+            latency = probe.histogram.stats()
+            duplicates = probe.duplicates
+
+        return { "timestamp": time.time(),
+                 "decoders": args.decoders,
+                 "broker": broker,
+                 "config": { "rate": args.rate,
+                             "duration": args.duration,
+                             "devices": args.devices,
+                             "decode_processes": args.decode_processes,
+                             "mix": mix
+                           },
+                 "sent": sent,
+                 "send_rate": round(sent / seconds, 1),
+                 "received": received,
+                 "dropped": sent - received,
+                 "duplicates": duplicates,
+                 "latency_us": { key: latency[key] for key in
+                                 ("min_us", "mean_us", "p50_us", "p90_us", "p99_us", "p99.9_us", "max_us") }
+               }
+    finally:
+        if publisher is not None:
+            publisher.loop_stop()
+            publisher.disconnect()
+        if probe is not None:
+            probe.stop()
+        if decoders_process is not None:
+            stop_process(decoders_process)
+        if broker_process is not None:
+            stop_process(broker_process)
+        if not args.keep_logs:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def print_results(results):
+    print("\n{} sent at {:.0f}/sec, {} received, {} dropped, {} duplicates ({} acp_decoders, {} broker)".format(
+        results["sent"], results["send_rate"], results["received"], results["dropped"], results["duplicates"],
+        results["decoders"], results["broker"]))
+    print("\nend-to-end latency (us):")
+    for key, value in results["latency_us"].items():
+        print("  {:<8} {}".format(key[:-3], value))
+
+####################################################################
+# Set up argument parsing
+####################################################################
+
+def parse_init():
+    parser = argparse.ArgumentParser(description='End-to-end load test of acp_decoders through a local MQTT broker.')
+    parser.add_argument('--decoders', choices=list(DECODERS_SCRIPTS), default='paho',
+                        help='acp_decoders.py (paho, default) or acp_decoders_gmqtt.py (gmqtt).')
+    parser.add_argument('--broker', choices=['auto', 'mosquitto', 'python'], default='auto',
+                        help='Broker to start: mosquitto, the python stand-in, or auto (mosquitto if installed).')
+    parser.add_argument('--rate', type=float, default=500, help='Messages published per second (default 500).')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to publish for (default 10).')
+    parser.add_argument('--drain', type=float, default=5,
+                        help='Seconds to wait for outstanding messages after publishing (default 5).')
+    parser.add_argument('--devices', type=int, default=100, help='Number of devices of each sensor type (default 100).')
+    parser.add_argument('--mix', default=None, help='Sensor type weights, as decoder_bench.py --mix.')
+    parser.add_argument('--decode-processes', type=int, default=0,
+                        help='settings "decode_processes" for --decoders gmqtt (default 0).')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the traffic mix (default 1).')
+    parser.add_argument('--keep-logs', action='store_true', help='Keep the temporary directory with the logs.')
+    parser.add_argument('--json', default=None, help='Write results as JSON to this file (- for stdout).')
+
+    return parser
+
+####################################################################
+#
+# Main
+#
+####################################################################
+
+if __name__ == '__main__':
+
+    parser = parse_init()
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.json == "-":
+        print(json.simplejson_dumps(results))
+    else:
+        print_results(results)
+        if args.json is not None:
+            with open(args.json, "w") as json_file:
+                json_file.write(json.simplejson_dumps(results))
+            print("\nresults written to {}".format(args.json))
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+####################################################################
+# mqtt_broker.py
+#
+# Minimal pure-Python MQTT 3.1.1 broker, a local stand-in for
+# mosquitto when load testing acp_decoders (see e2e_load.py).
+#
+# Supports CONNECT (any user/password accepted), PUBLISH at QoS 0,
+# 1 and 2 (acknowledged to the publisher, always delivered to
+# subscribers at QoS 0), SUBSCRIBE / UNSUBSCRIBE with '+' and '#'
+# wildcards and '$share/<group>/<filter>' shared subscriptions
+# (round-robin within the group), PINGREQ and DISCONNECT.
+# Not supported: retained messages, wills, sessions, MQTT v5
+# (a v5 CONNECT is refused with return code 1).
+#
+# Usage (from the acp_decoders directory):
+#     python3 benchmarks/mqtt_broker.py [--host 127.0.0.1] [--port 1883]
+####################################################################
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from topic_router import filter_covers
+
+# MQTT control packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+####################################################################
+# Packet encoding
+####################################################################
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+def encode_string(text):
+    encoded = text.encode("utf-8")
+    return len(encoded).to_bytes(2, "big") + encoded
+
+def packet(packet_type, flags, body):
+    return bytes([ (packet_type << 4) | flags ]) + encode_length(len(body)) + body
+
+def publish_packet(topic, payload):
+    return packet(PUBLISH, 0, encode_string(topic) + payload)
+
+# Return (string, offset after string) from data at offset
+def decode_string(data, offset):
+    length = int.from_bytes(data[offset:offset+2], "big")
+    return data[offset+2:offset+2+length].decode("utf-8"), offset+2+length
+
+####################################################################
+# Broker
+####################################################################
+
+class Subscription():
+
+    def __init__(self, topic_filter):
+        self.share_group = None
+        if topic_filter.startswith("$share/"):
+            _, self.share_group, topic_filter = topic_filter.split("/", 2)
+        self.topic_filter = topic_filter
+
+class Broker():
+
+    def __init__(self):
+        self.clients = {} # ClientConnection -> { subscription topic: Subscription }
+        self.share_next = {} # (share group, filter) -> count, for round-robin delivery
+
+        # counters
+        self.received = 0
+        self.delivered = 0
+
+    # Deliver a published message to the matching subscribers
+    def publish(self, topic, payload):
+        self.received += 1
+        shared = {} # (group, filter) -> list of clients
+        message = None
+        for client, subscriptions in self.clients.items():
+            matched = False
+            for subscription in subscriptions.values():
+                if not filter_covers(subscription.topic_filter, topic):
+                    continue
+                if subscription.share_group is not None:
+                    shared.setdefault((subscription.share_group, subscription.topic_filter), []).append(client)
+                else:
+                    matched = True
+            if matched:
+                if message is None:
+                    message = publish_packet(topic, payload)
+                client.send(message)
+                self.delivered += 1
+
+        for share_key, clients in shared.items():
+            count = self.share_next.get(share_key, 0)
+            self.share_next[share_key] = count + 1
+            if message is None:
+                message = publish_packet(topic, payload)
+            clients[count % len(clients)].send(message)
+            self.delivered += 1
+
+    async def handle_client(self, reader, writer):
+        client = ClientConnection(self, reader, writer)
+        try:
+            await client.run()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(client, None)
+            writer.close()
+
+class ClientConnection():
+
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, data):
+        self.writer.write(data)
+
+    async def read_packet(self):
+        header = await self.reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await self.reader.readexactly(length) if length else b""
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    async def run(self):
+        packet_type, flags, body = await self.read_packet()
+        if packet_type != CONNECT:
+            return
+        protocol_name, offset = decode_string(body, 0)
+        protocol_level = body[offset]
+        if protocol_level != 4 and protocol_level != 3:
+            self.send(packet(CONNACK, 0, bytes([ 0, 1 ]))) # unacceptable protocol version
+            await self.writer.drain()
+            return
+        self.send(packet(CONNACK, 0, bytes([ 0, 0 ])))
+        self.broker.clients[self] = {}
+
+        while True:
+            packet_type, flags, body = await self.read_packet()
+
+            if packet_type == PUBLISH:
+                qos = (flags >> 1) & 3
+                topic, offset = decode_string(body, 0)
+                if qos > 0:
+                    packet_id = body[offset:offset+2]
+                    offset += 2
+                    self.send(packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+                self.broker.publish(topic, body[offset:])
+
+            elif packet_type == PUBREL:
+                self.send(packet(PUBCOMP, 0, body[:2]))
+
+            elif packet_type == SUBSCRIBE:
+                packet_id = body[:2]
+                offset = 2
+                granted = bytearray()
+                while offset < len(body):
+                    topic_filter, offset = decode_string(body, offset)
+                    offset += 1 # requested qos, we deliver at qos 0
+                    self.broker.clients[self][topic_filter] = Subscription(topic_filter)
+                    granted.append(0)
+                self.send(packet(SUBACK, 0, packet_id + bytes(granted)))
+
+            elif packet_type == UNSUBSCRIBE:
+                packet_id = body[:2]
+                offset = 2
+                while offset < len(body):
+                    topic_filter, offset = decode_string(body, offset)
+                    self.broker.clients[self].pop(topic_filter, None)
+                self.send(packet(UNSUBACK, 0, packet_id))
+
+            elif packet_type == PINGREQ:
+                self.send(packet(PINGRESP, 0, b""))
+
+            elif packet_type == DISCONNECT:
+                return
+
+            await self.writer.drain()
+
+####################################################################
+# Set up argument parsing
+####################################################################
+
+def parse_init():
+    parser = argparse.ArgumentParser(description='Minimal MQTT 3.1.1 broker for acp_decoders load tests.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default 127.0.0.1).')
+    parser.add_argument('--port', type=int, default=1883, help='Port to listen on (default 1883).')
+
+    return parser
+
+async def serve(host, port):
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle_client, host, port)
+    print("{:.6f} mqtt_broker listening on {}:{}".format(time.time(), host, port), flush=True)
+    async with server:
+        await server.serve_forever()
+
+####################################################################
+#
+# Main
+#
+####################################################################
+
+if __name__ == '__main__':
+
+    parser = parse_init()
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
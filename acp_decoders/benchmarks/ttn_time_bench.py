@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+####################################################################
+# ttn_time_bench.py
+#
+# Microbenchmark of ttn_time.parse_acp_ts() against the
+# datetime.strptime() code previously used by each TTN decoder
+# to compute acp_ts from "received_at", after checking both give
+# the same acp_ts for TIMESTAMPS and raise ValueError for
+# BAD_TIMESTAMPS.
+#
+# Usage (from the acp_decoders directory):
+#     python3 benchmarks/ttn_time_bench.py [--count N]
+####################################################################
+
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ttn_time import parse_acp_ts
+
+TIMESTAMPS = [ "2021-03-14T15:05:56.731354231Z",
+               "2021-02-16T09:05:53.742555356Z",
+               "2021-03-14T15:05:57.000000001Z",
+               "2021-03-15T00:00:00.123456789Z",
+               "2020-02-29T12:00:00.000000000Z",
+               "2000-02-29T12:00:00.000000000Z"
+             ]
+
+# Timestamps with an invalid date, e.g. day past the end of the month
+BAD_TIMESTAMPS = [ "2021-02-31T15:05:56.731354231Z",
+                   "2021-02-29T15:05:56.731354231Z",
+                   "1900-02-29T15:05:56.731354231Z",
+                   "2021-04-31T15:05:56.731354231Z",
+                   "2021-13-01T15:05:56.731354231Z",
+                   "2021-01-00T15:05:56.731354231Z"
+                 ]
+
+# The previous decoder implementation (truncated to microseconds)
+def strptime_acp_ts(datetime_string):
+    date_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+    epoch_start = datetime(1970, 1, 1)
+    # trim off the nanoseconds
+    return str((datetime.strptime(datetime_string[:-4]+"Z", date_format) - epoch_start).total_seconds())
+
+####################################################################
+# Set up argument parsing
+####################################################################
+
+def parse_init():
+    parser = argparse.ArgumentParser(description='Benchmark ttn_time.parse_acp_ts() against datetime.strptime().')
+    parser.add_argument('--count', type=int, default=100000, help='Number of timestamps parsed per run (default 100000).')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs, best is reported (default 5).')
+
+    return parser
+
+# Return best time per call in nanoseconds
+def bench(parse, count, repeat):
+    def run():
+        for i in range(count // len(TIMESTAMPS)):
+            for timestamp in TIMESTAMPS:
+                parse(timestamp)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return best / (count // len(TIMESTAMPS) * len(TIMESTAMPS)) * 1e9
+
+####################################################################
+#
+# Main
+#
+####################################################################
+
+if __name__ == '__main__':
+
+    parser = parse_init()
+    args = parser.parse_args()
+
+    for timestamp in TIMESTAMPS:
+        print("{}  strptime {:<20} parse_acp_ts {}".format(
+            timestamp,
+            strptime_acp_ts(timestamp),
+            parse_acp_ts(timestamp)))
+        if not parse_acp_ts(timestamp).startswith(strptime_acp_ts(timestamp).rstrip('0').rstrip('.')):
+            print("ERROR parse_acp_ts differs from strptime")
+            exit(1)
+
+    for timestamp in BAD_TIMESTAMPS:
+        for parse in (strptime_acp_ts, parse_acp_ts):
+            try:
+                parse(timestamp)
+            except ValueError:
+                continue
+            print("ERROR {} accepted bad timestamp {}".format(parse.__name__, timestamp))
+            exit(1)
+    print("{} bad timestamps rejected".format(len(BAD_TIMESTAMPS)))
+
+    strptime_ns = bench(strptime_acp_ts, args.count, args.repeat)
+    parse_ns = bench(parse_acp_ts, args.count, args.repeat)
+
+    print("\nstrptime:     {:8.0f} ns/timestamp".format(strptime_ns))
+    print("parse_acp_ts: {:8.0f} ns/timestamp".format(parse_ns))
+    print("speedup:      {:8.1f}x".format(strptime_ns / parse_ns))
@@ -0,0 +1,236 @@
+##################################################################
+##################################################################
+# DecodePool
+#
+# Optional process pool for the gmqtt DecoderManager, so CPU-heavy
+# decodes run in worker processes rather than blocking the asyncio
+# event loop that receives the input messages.
+#
+#    decode_pool = DecodePool(settings, processes, publish)
+#    decode_pool.start()               # from within the event loop
+#    decode_pool.put(topic, msg_bytes)
+#    ...
+#    decode_pool.reload()              # on SIGALRM
+#    await decode_pool.stop()          # publishes remaining messages
+#
+# where publish(topic, msg_bytes, decoded) is called in the event
+# loop with the decoded message dictionary (None if not decoded).
+#
+# publish() is called in the order the messages were put(), so the
+# messages for each acp_id are published in arrival order (the
+# acp_id is only known after decoding, so the whole stream is kept in
+# order, with a slow decode holding back the messages behind it).
+#
+# Each worker process loads the decoders once, in init_worker().
+# reload() increments a generation number passed with every message,
+# and a worker reloads its decoders when it sees a new generation.
+#
+# At most settings["decode_queue_size"] messages (default
+# DECODE_QUEUE_SIZE) wait to be decoded or published, beyond which
+# put() drops the message, so an overload does not grow memory
+# without limit.
+#
+# If a worker process dies (e.g. killed by the OOM killer or crashed
+# by a decoder) the pool is broken, so it is replaced by a new one,
+# and the messages it had not decoded are submitted again to the new
+# pool. A message which breaks the new pool as well is counted as
+# lost.
+#
+# An exception decoding or publishing a message is logged and counted
+# in "errors", and the following messages are still published.
+##################################################################
+##################################################################
+
+import asyncio
+import multiprocessing
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+DECODE_QUEUE_SIZE = 10000 # default max messages waiting to be decoded or published
+MAX_ATTEMPTS = 2          # times a message is submitted to a pool before it is counted as lost
+
+# The DecoderManager in each worker process, set by init_worker()
+worker_manager = None
+worker_generation = None
+
+###############################################################
+# Worker process functions
+###############################################################
+
+# Initialize worker process, loading the decoders
+def init_worker(settings, generation):
+    global worker_manager, worker_generation
+
+    # SIGINT (e.g. Ctrl-C) is handled by the parent process, which shuts down the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import acp_json
+    from acp_decoders_gmqtt import DecoderManager
+
+    if "json_backend" in settings:
+        acp_json.set_backend(settings["json_backend"])
+    else:
+        acp_json.set_backend()
+
+    worker_manager = DecoderManager()
+    worker_manager.settings = dict(settings)
+    worker_manager.load_decoders_file()
+    worker_generation = generation
+
+# Decode message in worker process, returning decoded dictionary or None
+def worker_decode(generation, topic, msg_bytes):
+    global worker_generation
+
+    if generation != worker_generation:
+        worker_manager.load_decoders_file()
+        worker_generation = generation
+
+    return worker_manager.decode_message(topic, msg_bytes)
+
+###############################################################
+# DecodePool, used in the DecoderManager process
+###############################################################
+
+class DecodePool():
+
+    def __init__(self, settings, processes, publish):
+        self.settings = settings
+        self.processes = processes
+        self.publish = publish
+
+        if "decode_queue_size" in settings:
+            self.queue_size = settings["decode_queue_size"]
+        else:
+            self.queue_size = DECODE_QUEUE_SIZE
+
+        self.generation = 0
+        self.loop = None
+        self.executor = None
+        self.pending = None # queue of (topic, msg_bytes, future, executor, attempts) in arrival order
+        self.task = None
+
+        # counters for stats()
+        self.errors = 0
+        self.dropped = 0
+        self.lost = 0
+        self.restarts = 0
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.pending = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = self.new_executor()
+        self.task = self.loop.create_task(self.run())
+
+    def new_executor(self):
+        # 'spawn' so workers do not inherit the event loop and MQTT connections
+        return ProcessPoolExecutor(max_workers=self.processes,
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_worker,
+                                   initargs=(self.settings, self.generation))
+
+    # Replace executor with a new pool, if it is still the current one (i.e. not already replaced)
+    def restart(self, executor):
+        if executor is not self.executor:
+            return
+        self.restarts += 1
+        print("{:.6f} DecodePool worker process died, restarting the pool".format(time.time()),
+              file=sys.stderr,
+              flush=True)
+        executor.shutdown(wait=False)
+        self.executor = self.new_executor()
+
+    # Return (future, executor) decoding message in the current pool, replacing the pool if broken
+    def submit(self, topic, msg_bytes):
+        executor = self.executor
+        try:
+            future = self.loop.run_in_executor(executor, worker_decode, self.generation, topic, msg_bytes)
+        except BrokenProcessPool:
+            self.restart(executor)
+            executor = self.executor
+            future = self.loop.run_in_executor(executor, worker_decode, self.generation, topic, msg_bytes)
+        return future, executor
+
+    # Send message to be decoded by a worker process, return False if it was dropped
+    def put(self, topic, msg_bytes):
+        if self.pending.full():
+            self.dropped += 1
+            print("{:.6f} DecodePool queue full, dropped {}".format(time.time(), topic),
+                  file=sys.stderr,
+                  flush=True)
+            return False
+        future, executor = self.submit(topic, msg_bytes)
+        self.pending.put_nowait((topic, msg_bytes, future, executor, 1))
+        return True
+
+    # Reload the decoders in every worker, before it decodes its next message
+    def reload(self):
+        self.generation += 1
+
+    # Number of messages waiting to be decoded or published
+    def depth(self):
+        return self.pending.qsize()
+
+    def stats(self):
+        return { "depth": self.pending.qsize(),
+                 "max_size": self.queue_size,
+                 "errors": self.errors,
+                 "dropped": self.dropped,
+                 "lost": self.lost,
+                 "restarts": self.restarts
+               }
+
+    # Publish remaining messages, then shut down the worker processes
+    async def stop(self):
+        await self.pending.put((None, None, None, None, None)) # waits for space if full
+        await self.task
+        self.executor.shutdown()
+
+    ###############################################################
+    # Publish decoded messages in arrival order
+    ###############################################################
+
+    async def run(self):
+        while True:
+            topic, msg_bytes, future, executor, attempts = await self.pending.get()
+            if future is None:
+                return # stop()
+
+            try:
+                decoded = await self.decoded(topic, msg_bytes, future, executor, attempts)
+            except BrokenProcessPool:
+                self.lost += 1
+                print("{:.6f} DecodePool lost {}, worker process died decoding it {} times".format(
+                          time.time(), topic, MAX_ATTEMPTS),
+                      file=sys.stderr,
+                      flush=True)
+                continue
+            except Exception as e:
+                self.errors += 1
+                print("{:.6f} DecodePool exception decoding {}: {}".format(time.time(), topic, repr(e)),
+                      file=sys.stderr,
+                      flush=True)
+                continue
+
+            # an exception from publish() (e.g. an unserializable decoded message) must not end this task
+            try:
+                self.publish(topic, msg_bytes, decoded)
+            except Exception as e:
+                self.errors += 1
+                print("{:.6f} DecodePool exception publishing {}: {}".format(time.time(), topic, repr(e)),
+                      file=sys.stderr,
+                      flush=True)
+
+    # Return the decoded message from future, submitting it again to a new pool if its pool broke
+    async def decoded(self, topic, msg_bytes, future, executor, attempts):
+        while True:
+            try:
+                return await future
+            except BrokenProcessPool:
+                self.restart(executor)
+                if attempts >= MAX_ATTEMPTS:
+                    raise
+                attempts += 1
+                future, executor = self.submit(topic, msg_bytes)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+####################################################################
+# decode_pool_test.py
+#
+# Checks DecodePool (see decode_pool.py) keeps publishing after the
+# publish() callback raises an exception, in arrival order, counting
+# the failed message in its "errors".
+#
+# Usage: ./decode_pool_test.py
+#
+# Exit status 0 if the test passes, 1 otherwise.
+####################################################################
+
+import asyncio
+import io
+import sys
+from contextlib import redirect_stderr
+
+from decode_pool import DecodePool
+
+TEST_TOPIC = "v3/cambridge-net-3@ttn/devices/elsys-co2-0460ec/up"
+TEST_FILE = "decoder_tests/elsys-co2-v3.json"
+MESSAGES = 5
+RAISE_AT = 1 # index of the message whose publish() raises
+TIMEOUT = 30 # seconds
+
+async def run_pool(msg_bytes):
+    published = []
+
+    def publish(topic, msg_bytes, decoded):
+        index = len(published)
+        published.append(decoded is not None)
+        if index == RAISE_AT:
+            raise ValueError("test publish exception")
+
+    pool = DecodePool({ "decoders_file": "decoders.json" }, 1, publish)
+    pool.start()
+    for i in range(MESSAGES):
+        pool.put(TEST_TOPIC, msg_bytes)
+    await asyncio.wait_for(pool.stop(), TIMEOUT)
+    return published, pool.stats()
+
+####################################################################
+#
+# Main
+#
+####################################################################
+
+if __name__ == '__main__':
+
+    with open(TEST_FILE, 'rb') as test_file:
+        msg_bytes = test_file.read()
+
+    log = io.StringIO()
+    with redirect_stderr(log):
+        published, stats = asyncio.run(run_pool(msg_bytes))
+
+    errors = []
+    if len(published) != MESSAGES:
+        errors.append("{} messages published, expected {}".format(len(published), MESSAGES))
+    if not all(published):
+        errors.append("messages not decoded: {}".format(published))
+    if stats["errors"] != 1:
+        errors.append("{} errors counted, expected 1".format(stats["errors"]))
+    if "DecodePool exception publishing" not in log.getvalue():
+        errors.append("publish exception not logged")
+
+    for error in errors:
+        print(error)
+
+    print("{} messages, publish() raising at message {}: {}".format(
+        MESSAGES,
+        RAISE_AT,
+        "FAIL" if errors else "OK"))
+
+    exit(1 if errors else 0)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+####################################################################
+# decoder_fields_test.py
+#
+# Checks decoders decode each payload in decoder_tests/fields/<decoder>.json
+# to exactly the expected properties, including their order.
+#
+# Each file is a list of cases
+#     { "description": ..., "device_id": ..., "frm_payload": <base64>,
+#       "expected": { "payload_cooked": ..., [ "acp_event": ... ] },
+#       [ "settings": { ... } ] }
+# decoded as a TTN v3 uplink from device_id by decoders/<decoder>.py
+# (instantiated with the case "settings", if given), with every property
+# in "expected" compared with the decoded message.
+#
+# Usage: ./decoder_fields_test.py [--verbose] [decoder ...]
+#
+# Exit status 0 if all cases match, 1 otherwise.
+####################################################################
+
+import argparse
+import glob
+import importlib
+import io
+import os
+from contextlib import redirect_stdout, redirect_stderr
+
+import acp_json
+
+FIELDS_DIR = "decoder_tests/fields"
+
+####################################################################
+# Set up argument parsing
+####################################################################
+
+def parse_init():
+    parser = argparse.ArgumentParser(description='Check decoders against the expected output in decoder_tests/fields/*.json.')
+    parser.add_argument('--verbose', action='store_true', help='Print each case.')
+    parser.add_argument('decoders', nargs='*', help='Decoders to test, e.g. elsys-v3 (default all with a fields file).')
+
+    return parser
+
+# Decode case with decoder, returning the decoded message
+def decode_case(decoder, case):
+    msg_dict = { "end_device_ids": { "device_id": case["device_id"],
+                                     "application_ids": { "application_id": "cambridge-net-3" } },
+                 "received_at": "2021-03-14T15:05:56.943862548Z",
+                 "uplink_message": { "frm_payload": case["frm_payload"],
+                                     "received_at": "2021-03-14T15:05:56.943862548Z" }
+               }
+    topic = "v3/cambridge-net-3@ttn/devices/{}/up".format(case["device_id"])
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        return decoder.decode_json(topic, acp_json.dumps(msg_dict), msg_dict)
+
+# Return list of error strings for the cases of decoder_name
+def test_decoder(decoder_name, verbose):
+    with open(os.path.join(FIELDS_DIR, decoder_name+".json"), "r") as fields_file:
+        cases = acp_json.loads(fields_file.read())
+
+    with redirect_stdout(io.StringIO()):
+        module = importlib.import_module("decoders."+decoder_name)
+        decoder = module.Decoder()
+
+    errors = []
+    for case in cases:
+        if "settings" in case:
+            with redirect_stdout(io.StringIO()):
+                decoded = decode_case(module.Decoder(case["settings"]), case)
+        else:
+            decoded = decode_case(decoder, case)
+        for key, expected in case["expected"].items():
+            # compare as JSON text so the property order and number formatting must match
+            expected_json = acp_json.simplejson_dumps(expected)
+            decoded_json = acp_json.simplejson_dumps(decoded.get(key))
+            if decoded_json != expected_json:
+                errors.append("{} {}: {} is\n    {}\n  expected\n    {}".format(
+                    decoder_name, case["description"], key, decoded_json, expected_json))
+        if verbose:
+            print("{} {}: {}".format(decoder_name, case["description"], acp_json.simplejson_dumps(case["expected"])))
+
+    print("{}: {} cases".format(decoder_name, len(cases)))
+    return errors
+
+####################################################################
+#
+# Main
+#
+####################################################################
+
+if __name__ == '__main__':
+
+    parser = parse_init()
+    args = parser.parse_args()
+
+    decoder_names = args.decoders
+    if not decoder_names:
+        decoder_names = [ os.path.basename(filename)[:-len(".json")]
+                          for filename in sorted(glob.glob(os.path.join(FIELDS_DIR, "*.json"))) ]
+
+    errors = []
+    for decoder_name in decoder_names:
+        errors += test_decoder(decoder_name, args.verbose)
+
+    for error in errors:
+        print(error)
+
+    print("{}: {}".format(", ".join(decoder_names), "FAIL" if errors else "OK"))
+
+    exit(1 if errors else 0)
@@ -0,0 +1,122 @@
+##################################################################
+##################################################################
+# DecoderLoader
+#
+# Incremental (re)loading of the decoders listed in decoders.json,
+# used by DecoderManager.import_decoders():
+#
+#    decoder_loader = DecoderLoader()
+#    ...
+#    decoders = decoder_loader.load(decoder_names, settings)
+#
+# returns a new list of { "name":, "decoder": } entries, built
+# without changing the current list, so the caller can swap it in
+# with one assignment and routing never sees a partial list.
+#
+# A decoder module is only re-imported if its file has changed since
+# it was last loaded, by (mtime, size) and then by content hash, so
+# a file touched but not changed is not reloaded. Unchanged decoders
+# keep their Decoder instance (and e.g. its payload cache).
+#
+# A changed module is executed as a new module object, and replaces
+# the previous one in sys.modules only once it has imported and its
+# Decoder has been instantiated without an exception. If either
+# fails, the previous version of the decoder is kept (or, for a
+# decoder not loaded before, it is left out).
+#
+# After load(), decoder_loader.loaded, .kept and .failed are the
+# lists of decoder names (re)imported, unchanged and failed (with the
+# exception, as (name, exception)) for the caller to log.
+##################################################################
+##################################################################
+
+import hashlib
+import importlib
+import importlib.util
+import os
+import sys
+
+import payload_cache
+
+DECODERS_PACKAGE = "decoders"
+
+class LoadedDecoder():
+
+    def __init__(self, entry, module, stat_key, content_hash):
+        self.entry = entry               # { "name":, "decoder": } in the DecoderManager list
+        self.module = module
+        self.stat_key = stat_key         # (mtime_ns, size) of the module file
+        self.content_hash = content_hash # sha1 of the module file
+
+class DecoderLoader():
+
+    def __init__(self):
+        self.decoders = {} # decoder name -> LoadedDecoder
+
+        # results of the last load()
+        self.loaded = []
+        self.kept = []
+        self.failed = []
+
+    # Return the list of { "name":, "decoder": } for decoder_names,
+    # importing only new or changed decoder modules
+    def load(self, decoder_names, settings):
+        self.loaded = []
+        self.kept = []
+        self.failed = []
+
+        # so decoder files added since the last load are found
+        importlib.invalidate_caches()
+
+        decoders = []
+        for decoder_name in decoder_names:
+            try:
+                loaded_decoder = self.load_decoder(decoder_name, settings)
+            except Exception as e:
+                self.failed.append((decoder_name, e))
+                loaded_decoder = self.decoders.get(decoder_name)
+                if loaded_decoder is None:
+                    continue
+            decoders.append(loaded_decoder.entry)
+
+        # forget decoders no longer listed, so they are imported afresh if listed again
+        for decoder_name in list(self.decoders):
+            if not decoder_name in decoder_names:
+                del self.decoders[decoder_name]
+
+        return decoders
+
+    # Return the LoadedDecoder for decoder_name, importing its module if new or changed
+    def load_decoder(self, decoder_name, settings):
+        module_name = DECODERS_PACKAGE+"."+decoder_name
+        spec = importlib.util.find_spec(module_name)
+        if spec is None or spec.origin is None:
+            raise ImportError("decoder module {} not found".format(module_name))
+
+        stat = os.stat(spec.origin)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        previous = self.decoders.get(decoder_name)
+        if previous is not None and previous.stat_key == stat_key:
+            self.kept.append(decoder_name)
+            return previous
+
+        with open(spec.origin, "rb") as module_file:
+            content_hash = hashlib.sha1(module_file.read()).hexdigest()
+        if previous is not None and previous.content_hash == content_hash:
+            previous.stat_key = stat_key
+            self.kept.append(decoder_name)
+            return previous
+
+        # execute the module as a new module object, so a failure leaves the current one intact
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        decoder = module.Decoder(settings)
+        # memoise its decodePayload if settings["payload_cache"] is given and it is marked pure
+        if "payload_cache" in settings:
+            payload_cache.install(decoder, settings["payload_cache"])
+
+        sys.modules[module_name] = module
+        loaded_decoder = LoadedDecoder({ "name": decoder_name, "decoder": decoder }, module, stat_key, content_hash)
+        self.decoders[decoder_name] = loaded_decoder
+        self.loaded.append(decoder_name)
+        return loaded_decoder
@@ -0,0 +1,131 @@
+##################################################################
+##################################################################
+# DecoderStats
+#
+# Per-decoder timing and counters for the DecoderManager, so the
+# cost of each decoder can be seen while acp_decoders is running.
+#
+#    decoder_stats = DecoderStats()
+#    ...
+#    decoder_stats.test_time(decoder_name, seconds)
+#    decoder_stats.decode_time(decoder_name, seconds)
+#    decoder_stats.test_error(decoder_name)
+#    decoder_stats.decode_error(decoder_name)
+#    decoder_stats.undecoded()
+#    ...
+#    decoder_stats.stats() # dictionary, e.g. for json.dumps()
+#
+# decode_time() counts a match (a decoder returning a decoded
+# message), decode_error() a decoder raising an exception.
+#
+# The test() and decode() times are kept in LatencyHistograms, an
+# HDR-style histogram of microsecond values: each value is rounded
+# down to SIGNIFICANT_BITS significant bits, so the counts are kept
+# in a few hundred buckets with under 2% error at any magnitude,
+# and recording a value is a dictionary increment.
+##################################################################
+##################################################################
+
+SIGNIFICANT_BITS = 7 # precision of LatencyHistogram buckets (1 in 2**(SIGNIFICANT_BITS-1))
+
+PERCENTILES = [ 50, 90, 99, 99.9 ]
+
+class LatencyHistogram():
+
+    def __init__(self):
+        self.buckets = {} # bucket lower bound (microseconds) -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    # Record a latency given in seconds
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - SIGNIFICANT_BITS
+        bucket = value if shift <= 0 else (value >> shift) << shift
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    # Return the value (microseconds) at or below which percentile % of values were recorded
+    def percentile(self, percentile):
+        if self.count == 0:
+            return None
+        target = self.count * percentile / 100
+        seen = 0
+        buckets = dict(self.buckets)
+        for bucket in sorted(buckets):
+            seen += buckets[bucket]
+            if seen >= target:
+                return bucket
+        return self.max
+
+    # Return the summary of the histogram (times in microseconds) as a dictionary
+    def stats(self):
+        summary = { "count": self.count,
+                    "min_us": self.min,
+                    "max_us": self.max,
+                    "mean_us": round(self.total / self.count, 1) if self.count else None,
+                    "total_us": self.total
+                  }
+        for percentile in PERCENTILES:
+            summary["p{}_us".format(percentile)] = self.percentile(percentile)
+        return summary
+
+class DecoderStats():
+
+    def __init__(self):
+        self.decoders = {} # decoder name -> counters and histograms
+        self.undecoded_count = 0
+
+    # Return the stats entry for decoder_name, creating it if needed
+    def decoder(self, decoder_name):
+        entry = self.decoders.get(decoder_name)
+        if entry is None:
+            entry = { "test": LatencyHistogram(),
+                      "decode": LatencyHistogram(),
+                      "matches": 0,
+                      "test_errors": 0,
+                      "decode_errors": 0
+                    }
+            self.decoders[decoder_name] = entry
+        return entry
+
+    def test_time(self, decoder_name, seconds):
+        self.decoder(decoder_name)["test"].record(seconds)
+
+    def decode_time(self, decoder_name, seconds):
+        entry = self.decoder(decoder_name)
+        entry["decode"].record(seconds)
+        entry["matches"] += 1
+
+    def test_error(self, decoder_name):
+        self.decoder(decoder_name)["test_errors"] += 1
+
+    def decode_error(self, decoder_name):
+        self.decoder(decoder_name)["decode_errors"] += 1
+
+    # Count a message not decoded by any decoder
+    def undecoded(self):
+        self.undecoded_count += 1
+
+    # Return all the counters and histogram summaries as a dictionary
+    # (may be called from another thread, e.g. the MetricsServer, so iterates over copies)
+    def stats(self):
+        decoders = {}
+        for decoder_name, entry in list(self.decoders.items()):
+            decoders[decoder_name] = { "matches": entry["matches"],
+                                       "test_errors": entry["test_errors"],
+                                       "decode_errors": entry["decode_errors"],
+                                       "test": entry["test"].stats(),
+                                       "decode": entry["decode"].stats()
+                                     }
+        return { "decoders": decoders, "undecoded": self.undecoded_count }
@@ -0,0 +1,235 @@
+##################################################################
+##################################################################
+# DecoderWatcher
+#
+# Watches the decoders directory and the decoders.json file, and
+# calls on_change() from its own thread once the files have stopped
+# changing, so DecoderManager can reload the decoders (incrementally,
+# see decoder_loader.py) without a SIGALRM. DecoderManager.reload()
+# only requests the reload, made by its decoder_reload thread:
+#
+#    decoder_watcher = DecoderWatcher("decoders", "decoders.json", on_change, settings)
+#    decoder_watcher.start()
+#    ...
+#    decoder_watcher.stop()
+#
+# Uses Linux inotify (via ctypes, no extra packages) if available,
+# otherwise polls the modification times of decoders/*.py and
+# decoders.json. A burst of file events (e.g. an editor saving, or a
+# git pull) is debounced into one on_change() call, made when no
+# further event has arrived for "debounce" seconds.
+#
+# Settings (settings["watch_decoders"], all optional), e.g.
+#     "watch_decoders": { "method": "auto", "debounce": 1.0, "poll_interval": 2.0 }
+# "method" is "inotify", "poll" or "auto" (inotify if available).
+##################################################################
+##################################################################
+
+import ctypes
+import ctypes.util
+import glob
+import os
+import select
+import struct
+import threading
+import time
+
+import acp_log as log
+
+# default settings, override with settings["watch_decoders"]
+WATCHER_SETTINGS = { "method": "auto",
+                     "debounce": 1.0,
+                     "poll_interval": 2.0
+                   }
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+INOTIFY_EVENT = struct.Struct("iIII") # wd, mask, cookie, name length
+
+STOP_CHECK_INTERVAL = 1.0 # max seconds between checks of stop() while waiting for events
+
+###############################################################
+# inotify, via the C library
+###############################################################
+
+class Inotify():
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("C library not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify not supported")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {}".format(path))
+        return wd
+
+    # Return list of (wd, mask, name) events, waiting up to timeout seconds
+    def read_events(self, timeout):
+        readable, _, _ = select.select([ self.fd ], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset+name_length].rstrip(b"\0").decode("utf-8", "replace")
+            offset += name_length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+###############################################################
+# DecoderWatcher
+###############################################################
+
+class DecoderWatcher():
+
+    def __init__(self, decoders_dir, decoders_file, on_change, settings=None):
+        self.decoders_dir = decoders_dir
+        self.decoders_file = decoders_file
+        self.on_change = on_change
+
+        options = dict(WATCHER_SETTINGS)
+        if settings is not None:
+            options.update(settings)
+        self.method = options["method"]
+        self.debounce = options["debounce"]
+        self.poll_interval = options["poll_interval"]
+
+        self.inotify = None
+        self.watches = {} # inotify wd -> None (any .py file) or the file name to watch in that directory
+        self.poll_state = None
+
+        self.stopping = threading.Event()
+        self.thread = None
+
+        # counters
+        self.changes = 0
+        self.reloads = 0
+
+    def start(self):
+        if self.method != "poll":
+            try:
+                self.start_inotify()
+            except OSError as e:
+                if self.method == "inotify":
+                    raise
+                log.notice(log.DECODE, "DecoderWatcher inotify not available ({}), polling", e)
+                self.inotify = None
+        if self.inotify is None:
+            self.method = "poll"
+            self.poll_state = self.poll_files()
+        else:
+            self.method = "inotify"
+
+        self.thread = threading.Thread(target=self.run, name="decoder_watcher", daemon=True)
+        self.thread.start()
+        log.notice(log.DECODE, "DecoderWatcher watching {} and {} ({})",
+            self.decoders_dir, self.decoders_file, self.method, stderr=True)
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    # Watch the decoders directory for .py files, and the directory of decoders_file for
+    # that file (editors often save by renaming a new file over the old one)
+    def start_inotify(self):
+        self.inotify = Inotify()
+        self.watches[self.inotify.add_watch(self.decoders_dir, WATCH_MASK)] = None
+        decoders_file_dir = os.path.dirname(os.path.abspath(self.decoders_file))
+        self.watches[self.inotify.add_watch(decoders_file_dir, WATCH_MASK)] = os.path.basename(self.decoders_file)
+
+    # Return True if any inotify event is for a watched file, waiting up to timeout seconds
+    def wait_inotify(self, timeout):
+        changed = False
+        for wd, mask, name in self.inotify.read_events(timeout):
+            watched_name = self.watches.get(wd, False)
+            if watched_name is None and name.endswith(".py"):
+                changed = True
+            elif watched_name and name == watched_name:
+                changed = True
+        return changed
+
+    # Return { path: (mtime_ns, size) } for the watched files
+    def poll_files(self):
+        files = {}
+        for path in glob.glob(os.path.join(self.decoders_dir, "*.py")) + [ self.decoders_file ]:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # e.g. deleted since the glob
+            files[path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    # Return True if the watched files have changed, after waiting up to timeout seconds
+    def wait_poll(self, timeout):
+        if self.stopping.wait(timeout):
+            return False
+        files = self.poll_files()
+        changed = files != self.poll_state
+        self.poll_state = files
+        return changed
+
+    def run(self):
+        last_change = None # time of the last change not yet reloaded
+        while not self.stopping.is_set():
+            if last_change is None:
+                timeout = STOP_CHECK_INTERVAL if self.method == "inotify" else self.poll_interval
+            else:
+                timeout = max(0, last_change + self.debounce - time.monotonic())
+                if self.method == "poll":
+                    timeout = min(timeout, self.poll_interval)
+
+            if self.method == "inotify":
+                changed = self.wait_inotify(timeout)
+            else:
+                changed = self.wait_poll(timeout)
+
+            if changed:
+                self.changes += 1
+                last_change = time.monotonic()
+            elif last_change is not None and time.monotonic() - last_change >= self.debounce:
+                last_change = None
+                self.reloads += 1
+                log.notice(log.DECODE, "{:.6f} DecoderWatcher decoders changed, reloading", time.time())
+                try:
+                    self.on_change()
+                except Exception as e:
+                    log.error(log.DECODE, "{:.6f} DecoderWatcher reload exception {}", time.time(), repr(e))
+
+    # Return the watcher counters as a dictionary
+    def stats(self):
+        return { "method": self.method,
+                 "changes": self.changes,
+                 "reloads": self.reloads
+               }
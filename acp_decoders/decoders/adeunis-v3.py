@@ -1,6 +1,8 @@
 import base64
-import simplejson as json
-from datetime import datetime
+import binascii
+import acp_json as json
+from ttn_time import parse_acp_ts
+import payload_cache
 
 DEBUG = False
 
@@ -10,6 +12,9 @@ class Decoder(object):
 
         self.name = "adeunis"
 
+        # MQTT topic patterns routed to this decoder by DecoderManager
+        self.topics = [ "v3/+/devices/adeunis-test-+/#" ]
+
         if settings is not None and "decoded_property" in settings:
             self.decoded_property = settings["decoded_property"]
         else:
@@ -41,14 +46,11 @@ class Decoder(object):
 
 
     def decode(self, topic, message_bytes):
-        ttn_version = 3 if topic.startswith("v3/") else 2
-
-        inc_msg = str(message_bytes,'utf-8')
+        return self.decode_json(topic, message_bytes, json.loads(message_bytes))
 
-        if DEBUG:
-            print("Adeunis decode str {}".format(inc_msg))
-
-        msg_dict = json.loads(inc_msg)
+    # As decode(), but with message_bytes already parsed into msg_dict (by DecoderManager)
+    def decode_json(self, topic, message_bytes, msg_dict):
+        ttn_version = 3 if topic.startswith("v3/") else 2
 
         if DEBUG:
             print("\nAdeunis decode() DECODED:\n")
@@ -84,10 +86,7 @@ class Decoder(object):
                 datetime_string = msg_dict["metadata"]["time"]
             else:
                 datetime_string = msg_dict["uplink_message"]["received_at"]
-            date_format = '%Y-%m-%dT%H:%M:%S.%fZ'
-            epoch_start = datetime(1970, 1, 1)
-            # trim off the nanoseconds
-            acp_ts = str((datetime.strptime(datetime_string[:-4]+"Z", date_format) - epoch_start).total_seconds())
+            acp_ts = parse_acp_ts(datetime_string)
             # add acp_ts to original message
             msg_dict["acp_ts"] = acp_ts
         except Exception as e:
@@ -121,8 +120,10 @@ class Decoder(object):
     def b64toBytes(self,b64):
         if DEBUG:
             print("Adeunis b64toBytes() {}".format(b64))
-        return base64.b64decode(b64)
+        # straight from the ASCII str, without base64.b64decode() first copying it to bytes
+        return binascii.a2b_base64(b64)
 
+    @payload_cache.pure
     def decodePayload(self,bytes):
         if DEBUG:
             print("Adeunis decodePayload() bytes[{}] {}".format(bytes,len(bytes)))
@@ -8,18 +8,29 @@
 #    where:
 #       settings["decoded_property"] contains property name to contain decoded message
 #       e.g. settings["decoded_property"] = "payload_cooked" (default if settings=None)
+#       settings["grideye_encoding"] = "list" (default) or "base64", see decode_grideye_base64()
 #
 # Implements:
+#    topics: list of MQTT topic patterns this decoder will handle
 #    test(topic, message_bytes): returns true|false whether this decoder will handle message
 #    decode(topic, message_bytes): returns Python dictionary of original message + decoded_property.
+#    decode_json(topic, message_bytes, msg_dict): as decode() with message_bytes already parsed as msg_dict
+#    decode_many(items): decode_json() of each (topic, message_bytes, msg_dict) in list items, returns list
 #
 
 DEBUG = False
 
 import base64
-import simplejson as json
+import binascii
+import struct
+import acp_json as json
 import traceback
-from datetime import datetime
+from ttn_time import parse_acp_ts
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 TYPE_TEMP         = 0x01 #temp 2 bytes -3276.8°C -->3276.7°C
 TYPE_RH           = 0x02 #Humidity 1 byte  0-100%
@@ -50,17 +61,176 @@ TYPE_EXT_DIGITAL2 = 0x1A     # 1bytes value 1 or 0
 TYPE_EXT_ANALOG_UV= 0x1B     # 4 bytes signed int (uV)
 TYPE_DEBUG        = 0x3D     # 4bytes debug
 
+###############################################################
+# Field spec
+#
+# Each TLV field in the payload is a type byte followed by the
+# field's values, as given by this table:
+#     type code, bytes per value, signed, divisor (or None), output names
+# i.e. a field of type code is len(names) values of the given size,
+# each stored in the decoded message as value/divisor.
+###############################################################
+
+ELSYS_FIELDS = [
+    ( TYPE_TEMP,          2, True,  10,   [ "temperature" ] ),
+    ( TYPE_RH,            1, False, None, [ "humidity" ] ),
+    ( TYPE_ACC,           1, True,  None, [ "x", "y", "z" ] ),
+    ( TYPE_LIGHT,         2, False, None, [ "light" ] ),
+    ( TYPE_MOTION,        1, False, None, [ "motion" ] ),
+    ( TYPE_CO2,           2, False, None, [ "co2" ] ),
+    ( TYPE_VDD,           2, False, None, [ "vdd" ] ),
+    ( TYPE_ANALOG1,       2, False, None, [ "analog1" ] ),
+    ( TYPE_GPS,           3, False, None, [ "lat", "lng" ] ),
+    ( TYPE_PULSE1,        2, False, None, [ "pulse1" ] ),
+    ( TYPE_PULSE1_ABS,    4, False, None, [ "pulseAbs" ] ),
+    ( TYPE_EXT_TEMP1,     2, True,  10,   [ "externalTemperature" ] ),
+    ( TYPE_EXT_DIGITAL,   1, False, None, [ "digital" ] ),
+    ( TYPE_EXT_DISTANCE,  2, False, None, [ "distance" ] ),
+    ( TYPE_ACC_MOTION,    1, False, None, [ "accMotion" ] ),
+    ( TYPE_IR_TEMP,       2, True,  10,   [ "irInternalTemperature", "irExternalTemperature" ] ),
+    ( TYPE_OCCUPANCY,     1, False, None, [ "occupancy" ] ),
+    ( TYPE_WATERLEAK,     1, False, None, [ "waterleak" ] ),
+    ( TYPE_PRESSURE,      4, False, 1000, [ "pressure" ] ),
+    ( TYPE_SOUND,         1, False, None, [ "soundPeak", "soundAvg" ] ),
+    ( TYPE_PULSE2,        2, False, None, [ "pulse2" ] ),
+    ( TYPE_PULSE2_ABS,    4, False, None, [ "pulseAbs2" ] ),
+    ( TYPE_ANALOG2,       2, False, None, [ "analog2" ] ),
+    ( TYPE_EXT_TEMP2,     2, True,  10,   [ "externalTemperature2" ] ),
+    ( TYPE_EXT_DIGITAL2,  1, False, None, [ "digital2" ] ),
+    ( TYPE_EXT_ANALOG_UV, 4, False, None, [ "analogUv" ] ),
+    ( TYPE_DEBUG,         4, False, None, [] ) # skipped
+]
+
+GRIDEYE_SIZE = 64 # TYPE_GRIDEYE pixels
+
+# struct format character for (bytes per value, signed)
+STRUCT_FORMATS = { (1, False): "B", (1, True): "b",
+                   (2, False): "H", (2, True): "h",
+                   (4, False): "I", (4, True): "i"
+                 }
+
+# 8x8 IR Grideye data
+# data[offset] is the reference 'temperature base' for the pixels
+# data[offset+1..offset+64] = a list of the 64 IR pixels as (degrees C * 10) offset from base
+def decode_grideye(obj, msg_dict, data, offset):
+    grideye_ref = data[offset]                # this is the 'base' temperature
+    # actual temperature of pixel is (base temp) + (pixel value)/10
+    if numpy is not None:
+        pixels = numpy.frombuffer(data, numpy.uint8, GRIDEYE_SIZE, offset+1)
+        obj["grideye"] = (grideye_ref + pixels / 10.0).tolist()
+    else:
+        obj["grideye"] = list(map(grideye_temperatures(grideye_ref).__getitem__, data[offset+1:offset+1+GRIDEYE_SIZE]))
+    obj["grideye_ref"] = grideye_ref
+
+# Return the tuple of the 256 pixel temperatures for grideye_ref, cached
+# so each pixel is a lookup rather than a division and an addition
+GRIDEYE_TEMPERATURES = {}
+
+def grideye_temperatures(grideye_ref):
+    temperatures = GRIDEYE_TEMPERATURES.get(grideye_ref)
+    if temperatures is None:
+        temperatures = tuple(grideye_ref + (pixel/10.0) for pixel in range(256))
+        GRIDEYE_TEMPERATURES[grideye_ref] = temperatures
+    return temperatures
+
+# As decode_grideye(), with settings["grideye_encoding"] = "base64": the 64 pixels
+# are published as the base64 of their bytes, i.e. the (degrees C * 10) offsets
+# from grideye_ref, row by row, rather than as a list of 64 temperatures
+def decode_grideye_base64(obj, msg_dict, data, offset):
+    obj["grideye_b64"] = base64.b64encode(data[offset+1:offset+1+GRIDEYE_SIZE]).decode("ascii")
+    obj["grideye_ref"] = data[offset]
+
+# Digital input, for an elsys-ems short payload this is a door open/close event
+def decode_digital_event(obj, msg_dict, data, offset):
+    if len(data) < 5 and msg_dict.get("acp_type_id") == "elsys-ems":
+        msg_dict["acp_event"] = "openclose"
+        msg_dict["acp_event_value"] = "open" if obj["digital"] == 0 else "close"
+
+# Distance sensor input (with the debug property the decoder has always added)
+def decode_distance_debug(obj, msg_dict, data, offset):
+    obj["JBJB"]="my debug here"
+
+# Fields decoded by a function rather than ELSYS_FIELDS values:
+#     type code -> (field length after type byte, function(obj, msg_dict, data, offset))
+ELSYS_FUNCTION_FIELDS = { TYPE_GRIDEYE: (1 + GRIDEYE_SIZE, decode_grideye) }
+
+# Functions called after the ELSYS_FIELDS values are decoded for these types
+ELSYS_FIELD_HOOKS = { TYPE_EXT_DIGITAL: decode_digital_event,
+                      TYPE_EXT_DISTANCE: decode_distance_debug
+                    }
+
+# Return function(data, offset) returning the tuple of count values
+def compile_unpacker(size, signed, count):
+    if (size, signed) in STRUCT_FORMATS:
+        return struct.Struct(">"+STRUCT_FORMATS[(size, signed)]*count).unpack_from
+    # e.g. 3 byte GPS values, which struct has no format for
+    def unpack_from(data, offset):
+        return tuple(int.from_bytes(data[offset+n*size:offset+(n+1)*size], "big", signed=signed)
+                     for n in range(count))
+    return unpack_from
+
+# Return function(obj, msg_dict, data, offset) decoding the values of a field into obj
+def compile_field(size, signed, divisor, names, hook):
+    unpack_from = compile_unpacker(size, signed, len(names))
+    if len(names) == 1:
+        name = names[0]
+        if divisor is None:
+            def decode_field(obj, msg_dict, data, offset):
+                obj[name] = unpack_from(data, offset)[0]
+        else:
+            def decode_field(obj, msg_dict, data, offset):
+                obj[name] = unpack_from(data, offset)[0] / divisor
+    else:
+        def decode_field(obj, msg_dict, data, offset):
+            values = unpack_from(data, offset)
+            for index, name in enumerate(names):
+                obj[name] = values[index] if divisor is None else values[index] / divisor
+    if hook is None:
+        return decode_field
+    def decode_field_hook(obj, msg_dict, data, offset):
+        decode_field(obj, msg_dict, data, offset)
+        hook(obj, msg_dict, data, offset)
+    return decode_field_hook
+
+# Return the dispatch table, a list indexed by type byte of
+# (field length after type byte, function(obj, msg_dict, data, offset)) or None
+def compile_fields():
+    table = [ None ] * 256
+    for type_code, size, signed, divisor, names in ELSYS_FIELDS:
+        if names:
+            decode_field = compile_field(size, signed, divisor, names, ELSYS_FIELD_HOOKS.get(type_code))
+        else:
+            decode_field = None
+        table[type_code] = (size * max(len(names), 1), decode_field)
+    for type_code, field in ELSYS_FUNCTION_FIELDS.items():
+        table[type_code] = field
+    return table
+
+ELSYS_FIELD_TABLE = compile_fields()
+
 class Decoder(object):
     def __init__(self,settings=None):
         print("    Elsys init()")
 
         self.name = "elsys"
 
+        # MQTT topic patterns routed to this decoder by DecoderManager
+        self.topics = [ "v3/+/devices/elsys-+/#" ]
+
         if settings is not None and "decoded_property" in settings:
             self.decoded_property = settings["decoded_property"]
         else:
             self.decoded_property = "payload_cooked"
 
+        # the field dispatch table, with the grideye encoding from settings
+        self.field_table = ELSYS_FIELD_TABLE
+        if settings is not None and "grideye_encoding" in settings:
+            if settings["grideye_encoding"] == "base64":
+                self.field_table = list(ELSYS_FIELD_TABLE)
+                self.field_table[TYPE_GRIDEYE] = (1 + GRIDEYE_SIZE, decode_grideye_base64)
+            elif settings["grideye_encoding"] != "list":
+                print("    Elsys grideye_encoding {} not recognized, using list".format(settings["grideye_encoding"]))
+
         return
 
     def test(self, topic, message_bytes):
@@ -87,19 +257,21 @@ class Decoder(object):
 
 
     def decode(self, topic, message_bytes):
+        return self.decode_json(topic, message_bytes, json.loads(message_bytes))
+
+    # Batch of decode_json(), called by DecoderManager.handle_input_batch()
+    def decode_many(self, items):
+        decode_json = self.decode_json
+        return [ decode_json(topic, message_bytes, msg_dict) for topic, message_bytes, msg_dict in items ]
+
+    # As decode(), but with message_bytes already parsed into msg_dict (by DecoderManager)
+    def decode_json(self, topic, message_bytes, msg_dict):
         # First lets set a flag for which version of TTN we're dealing with
         ttn_version = 3 if topic.startswith("v3/") else 2
 
         if DEBUG:
             print(f'\nElsys decode() V{ttn_version}\n{message_bytes}')
 
-        inc_msg=str(message_bytes,'utf-8')
-
-        if DEBUG:
-            print("Elsys decode str {}".format(inc_msg))
-
-        msg_dict = json.loads(inc_msg)
-
         # extract sensor id
         # add acp_id to original message
         if ttn_version==2:
@@ -107,10 +279,11 @@ class Decoder(object):
         else:
             msg_dict["acp_id"] = msg_dict["end_device_ids"]["device_id"]
 
-        type_array = msg_dict["acp_id"].split("-")
-
-        if len(type_array) >= 3:
-            msg_dict["acp_type_id"] = type_array[0]+"-"+type_array[1]
+        # acp_type_id is the acp_id up to its second "-", if it has at least two
+        acp_id = msg_dict["acp_id"]
+        type_end = acp_id.find("-", acp_id.find("-")+1)
+        if type_end > 0:
+            msg_dict["acp_type_id"] = acp_id[:type_end]
 
         if ttn_version==2:
             rawb64 = msg_dict["payload_raw"]
@@ -142,10 +315,7 @@ class Decoder(object):
             else:
                 datetime_string = msg_dict["uplink_message"]["received_at"]
 
-            date_format = '%Y-%m-%dT%H:%M:%S.%fZ'
-            epoch_start = datetime(1970, 1, 1)
-            # trim off the nanoseconds
-            acp_ts = str((datetime.strptime(datetime_string[:-4]+"Z", date_format) - epoch_start).total_seconds())
+            acp_ts = parse_acp_ts(datetime_string)
             # add acp_ts to original message
             msg_dict["acp_ts"] = acp_ts
         except Exception as e:
@@ -157,18 +327,6 @@ class Decoder(object):
 
         return msg_dict
 
-    def bin8dec(self, bin):
-        num=bin&0xFF;
-        if (0x80 & num):
-            num = - (0x0100 - num);
-        return num
-
-    def bin16dec(self, bin):
-        num=bin&0xFFFF;
-        if (0x8000 & num):
-            num = - (0x010000 - num);
-        return num
-
     def hexToBytes(self, hex):
         bytes = []
         for c in range(0,len(hex),2):
@@ -181,191 +339,30 @@ class Decoder(object):
     def b64toBytes(self,b64):
         if DEBUG:
             print("b64toBytes")
-        return base64.b64decode(b64)
+        # straight from the ASCII str, without base64.b64decode() first copying it to bytes
+        return binascii.a2b_base64(b64)
 
     def decodePayload(self, msg_dict, data):
         obj = {}
 
-        acp_type = ''
-        if "acp_type_id" in msg_dict:
-            acp_type = msg_dict["acp_type_id"]
-
         if DEBUG:
             print("data ",data," len ",len(data))
 
+        field_table = self.field_table
+        data_length = len(data)
         i = 0
-        while(i<len(data)):
-            #Temperature
-            if data[i] == TYPE_TEMP:
-                temp=(data[i+1]<<8)|(data[i+2])
-                temp=self.bin16dec(temp)
-                obj["temperature"]=temp/10
-                i=i+2
-
-            #Humidity
-            elif data[i] == TYPE_RH:
-                rh=(data[i+1])
-                obj["humidity"]=rh
-                i+=1
-
-            #Acceleration
-            elif data[i] == TYPE_ACC:
-                obj["x"]=self.bin8dec(data[i+1])
-                obj["y"]=self.bin8dec(data[i+2])
-                obj["z"]=self.bin8dec(data[i+3])
-                i+=3
-
-            #Light
-            elif data[i] == TYPE_LIGHT:
-                obj["light"]=(data[i+1]<<8)|(data[i+2])
-                i+=2
-
-            #Motion sensor(PIR)
-            elif data[i] == TYPE_MOTION:
-                obj["motion"]=(data[i+1])
-                i+=1
-
-            #CO2
-            elif data[i] == TYPE_CO2:
-                obj["co2"]=(data[i+1]<<8)|(data[i+2])
-                i+=2
-
-            #Battery level
-            elif data[i] == TYPE_VDD:
-                obj["vdd"]=(data[i+1]<<8)|(data[i+2])
-                i+=2
-
-            #Analog input 1
-            elif data[i] == TYPE_ANALOG1:
-                obj["analog1"]=(data[i+1]<<8)|(data[i+2])
-                i+=2
-
-            #gps
-            elif data[i] ==  TYPE_GPS:
-                obj["lat"]=(data[i+1]<<16)|(data[i+2]<<8)|(data[i+3])
-                obj["lng"]=(data[i+4]<<16)|(data[i+5]<<8)|(data[i+6])
-                i+=6
-
-            #Pulse input 1
-            elif data[i] == TYPE_PULSE1:
-                obj["pulse1"]=(data[i+1]<<8)|(data[i+2])
-                i+=2
-
-            #Pulse input 1 absolute value
-            elif data[i] ==  TYPE_PULSE1_ABS:
-                pulseAbs=(data[i+1]<<24)|(data[i+2]<<16)|(data[i+3]<<8)|(data[i+4])
-                obj["pulseAbs"]=pulseAbs
-                i+=4
-
-            #External temp
-            elif data[i] ==TYPE_EXT_TEMP1:
-                temp=(data[i+1]<<8)|(data[i+2])
-                temp=self.bin16dec(temp)
-                obj["externalTemperature"]=temp/10
-                i+=2
-
-            #Digital input
-            elif data[i] == TYPE_EXT_DIGITAL:
-                obj["digital"]=(data[i+1])
-                i+=1
-                if acp_type == "elsys-ems" and len(data) < 5 :
-                    msg_dict["acp_event"] = "openclose"
-                    msg_dict["acp_event_value"] = "open" if obj["digital"] == 0 else "close"
-
-            #Distance sensor input
-            elif data[i] == TYPE_EXT_DISTANCE:
-                obj["distance"]=(data[i+1]<<8)|(data[i+2])
-                obj["JBJB"]="my debug here"
-                i+=2
-
-            #Acc motion
-            elif data[i] == TYPE_ACC_MOTION:
-                obj["accMotion"]=(data[i+1])
-                i+=1
-
-            #IR temperature
-            elif data[i] == TYPE_IR_TEMP:
-                iTemp=(data[i+1]<<8)|(data[i+2])
-                iTemp=self.bin16dec(iTemp)
-                eTemp=(data[i+3]<<8)|(data[i+4])
-                eTemp=self.bin16dec(eTemp)
-                obj["irInternalTemperature"]=iTemp/10
-                obj["irExternalTemperature"]=eTemp/10
-                i+=4
-
-            #Body occupancy
-            elif data[i] == TYPE_OCCUPANCY:
-                obj["occupancy"]=(data[i+1])
-                i+=1
-
-            #Water leak
-            elif data[i] == TYPE_WATERLEAK:
-                obj["waterleak"]=(data[i+1])
-                i+=1
-
-            # 8x8 IR Grideye data
-            elif data[i] == TYPE_GRIDEYE:
-                # data[i] = the field 'type' i.e. TYPE_GRIDEYE pixel array
-                # data[i+1] is the reference 'temperature base' for the pixels
-                # data[i+2..i+65] = a list of the 64 IR pixels as (degrees C * 10) offset from base
-                GRIDEYE_SIZE=64
-                obj["grideye"]="8x8 missing"
-                grideye_ref = data[i+1]                # this is the 'base' temperature
-                obj["grideye_ref"] = grideye_ref
-                obj["grideye"] = [None] * GRIDEYE_SIZE # initialize fixed size array
-                # actual temperature of pixel is (base temp) + (pixel value)/10
-                for pixel in range(0,GRIDEYE_SIZE):
-                    obj["grideye"][pixel] = grideye_ref + (data[i+2+pixel]/10.0)
-                i += 1 + GRIDEYE_SIZE # skip forward from type id, ref byte, pixels
-
-            #External Pressure
-            elif data[i] == TYPE_PRESSURE:
-                temp=(data[i+1]<<24)|(data[i+2]<<16)|(data[i+3]<<8)|(data[i+4])
-                obj["pressure"]=temp/1000
-                i+=4
-
-            #Sound
-            elif data[i] == TYPE_SOUND:
-                obj["soundPeak"]=data[i+1]
-                obj["soundAvg"]=data[i+2]
-                i+=2
-
-            #Pulse 2
-            elif data[i] == TYPE_PULSE2:
-                obj["pulse2"]=(data[i+1]<<8)|(data[i+2])
-                i+=2
-
-            #Pulse input 2 absolute value
-            elif data[i] == TYPE_PULSE2_ABS:
-                obj["pulseAbs2"]=(data[i+1]<<24)|(data[i+2]<<16)|(data[i+3]<<8)|(data[i+4])
-                i+=4
-
-            #Analog input 2
-            elif data[i] ==  TYPE_ANALOG2:
-                obj["analog2"]=(data[i+1]<<8)|(data[i+2])
-                i+=2
-
-            #External temp 2
-            elif data[i] == TYPE_EXT_TEMP2:
-                temp=(data[i+1]<<8)|(data[i+2])
-                temp=self.bin16dec(temp)
-                obj["externalTemperature2"]=temp/10
-                i+=2
-
-            #Digital input 2
-            elif data[i] ==  TYPE_EXT_DIGITAL2:
-                obj["digital2"]=(data[i+1])
-                i+=1
-
-            #Load cell analog uV
-            elif data[i] == TYPE_EXT_ANALOG_UV:
-                obj["analogUv"] = (data[i + 1] << 24) | (data[i + 2] << 16) | (data[i + 3] << 8) | (data[i + 4])
-                i += 4
-
-            else:
+        while i < data_length:
+            field = field_table[data[i]]
+            if field is None:
                 print("Elsys decoder field not recognized {}".format(data[i]))
-                i=len(data)
-
-            i+=1
+                break
+            field_length, decode_field = field
+            if i + field_length >= data_length:
+                if data[i] == TYPE_DEBUG:
+                    break # sensors may send a short debug field last, keep the fields before it
+                raise ValueError("Elsys field {} truncated".format(data[i]))
+            if decode_field is not None:
+                decode_field(obj, msg_dict, data, i+1)
+            i += 1 + field_length
 
         return obj
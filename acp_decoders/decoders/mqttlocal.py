@@ -1,5 +1,5 @@
-import simplejson as json
-JSONDecodeError = json.errors.JSONDecodeError
+import acp_json as json
+JSONDecodeError = json.JSONDecodeError
 
 ## The mqtt local messages have the topic of the form csn/sensor-id/#
 
@@ -12,6 +12,9 @@ class Decoder:
         else:
             self.decoded_property = "payload_cooked"
 
+        # MQTT topic patterns routed to this decoder by DecoderManager
+        self.topics = [ "csn/#" ]
+
     def test(self, topic, msg_bytes):
         if topic.split('/')[0] == 'csn':
             return True
@@ -10,8 +10,11 @@
 #       e.g. settings["decoded_property"] = "payload_cooked" (default if settings=None)
 #
 # Implements:
+#    topics: list of MQTT topic patterns this decoder will handle
 #    test(topic, message_bytes): returns true|false whether this decoder will handle message
 #    decode(topic, message_bytes): returns Python dictionary of original message + decoded_property.
+#    decode_json(topic, message_bytes, msg_dict): as decode() with message_bytes already parsed as msg_dict
+#    decode_many(items): decode_json() of each (topic, message_bytes, msg_dict) in list items, returns list
 #
 
 # This Python update from Javascript original:
@@ -22,8 +25,10 @@
 DEBUG = False
 
 import base64
-import simplejson as json
-from datetime import datetime
+import binascii
+import acp_json as json
+from ttn_time import parse_acp_ts
+import payload_cache
 
 # General defines used in decode
 RESET_EVENT = 0x00
@@ -53,12 +58,44 @@ MAGNETOMETER_EVENT = 0x18
 VIBRATION_LB_EVENT = 0x19
 VIBRATION_HB_EVENT = 0x1A
 
+# Device types in the third byte of the reset event
+RADIOBRIDGE_DEVICE_TYPES = { 0x01: "Door/Window Sensor",
+                             0x02: "Door/Window High Security",
+                             0x03: "Contact Sensor",
+                             0x04: "No-Probe Temperature Sensor",
+                             0x05: "External-Probe Temperature Sensor",
+                             0x06: "Single Push Button",
+                             0x07: "Dual Push Button",
+                             0x08: "Acceleration-Based Movement Sensor",
+                             0x09: "Tilt Sensor",
+                             0x0A: "Water Sensor",
+                             0x0B: "Tank Level Float Sensor",
+                             0x0C: "Glass Break Sensor",
+                             0x0D: "Ambient Light Sensor",
+                             0x0E: "Air Temperature and Humidity Sensor",
+                             0x0F: "High-Precision Tilt Sensor",
+                             0x10: "Ultrasonic Level Sensor",
+                             0x11: "4-20mA Current Loop Sensor",
+                             0x12: "Ext-Probe Air Temp and Humidity Sensor",
+                             0x13: "Thermocouple Temperature Sensor",
+                             0x14: "Voltage Sensor",
+                             0x15: "Custom Sensor",
+                             0x16: "GPS",
+                             0x17: "Honeywell 5800 Bridge",
+                             0x18: "Magnetometer",
+                             0x19: "Vibration Sensor - Low Frequency",
+                             0x1A: "Vibration Sensor - High Frequency"
+                           }
+
 class Decoder(object):
     def __init__(self,settings=None):
         print("    RadioBridge init()")
 
         self.name = "radiobridge"
 
+        # MQTT topic patterns routed to this decoder by DecoderManager
+        self.topics = [ "v3/+/devices/rad-+/#" ]
+
         if settings is not None and "decoded_property" in settings:
             self.decoded_property = settings["decoded_property"]
         else:
@@ -84,19 +121,21 @@ class Decoder(object):
 
 
     def decode(self, topic, message_bytes):
+        return self.decode_json(topic, message_bytes, json.loads(message_bytes))
+
+    # Batch of decode_json(), called by DecoderManager.handle_input_batch()
+    def decode_many(self, items):
+        decode_json = self.decode_json
+        return [ decode_json(topic, message_bytes, msg_dict) for topic, message_bytes, msg_dict in items ]
+
+    # As decode(), but with message_bytes already parsed into msg_dict (by DecoderManager)
+    def decode_json(self, topic, message_bytes, msg_dict):
         # First lets set a flag for which version of TTN we're dealing with
         ttn_version = 3 if topic.startswith("v3/") else 2
 
         if DEBUG:
             print("RadioBridge decode() {}".format(message_bytes))
 
-        inc_msg=str(message_bytes,'utf-8')
-
-        if DEBUG:
-            print("RadioBridge decode str {}".format(inc_msg))
-
-        msg_dict = json.loads(inc_msg)
-
         # extract sensor id
         # add acp_id to original message
         if ttn_version==2:
@@ -104,10 +143,11 @@ class Decoder(object):
         else:
             msg_dict["acp_id"] = msg_dict["end_device_ids"]["device_id"]
 
-        type_array = msg_dict["acp_id"].split("-")
-
-        if len(type_array) >= 3:
-            msg_dict["acp_type_id"] = type_array[0]+"-"+type_array[1]
+        # acp_type_id is the acp_id up to its second "-", if it has at least two
+        acp_id = msg_dict["acp_id"]
+        type_end = acp_id.find("-", acp_id.find("-")+1)
+        if type_end > 0:
+            msg_dict["acp_type_id"] = acp_id[:type_end]
 
         if DEBUG:
             print("\nRadioBridge decode() DECODED:\n")
@@ -141,10 +181,7 @@ class Decoder(object):
                 datetime_string = msg_dict["metadata"]["time"]
             else:
                 datetime_string = msg_dict["uplink_message"]["received_at"]
-            date_format = '%Y-%m-%dT%H:%M:%S.%fZ'
-            epoch_start = datetime(1970, 1, 1)
-            # trim off the nanoseconds
-            acp_ts = str((datetime.strptime(datetime_string[:-4]+"Z", date_format) - epoch_start).total_seconds())
+            acp_ts = parse_acp_ts(datetime_string)
             # add acp_ts to original message
             msg_dict["acp_ts"] = acp_ts
         except Exception as e:
@@ -158,68 +195,21 @@ class Decoder(object):
 
     # Here we decode the original 'payload' from the RadioBridge sensor that was
     # provided in the "payload_raw" property of the message from TTN
+    @payload_cache.pure
     def decodePayload(self, msg_dict, payload_bytes):
 
         if DEBUG:
             print("data ",payload_bytes," len ",len(payload_bytes))
 
         # the event type is defined in the second byte
-        event = payload_bytes[1]
-
-        if event == RESET_EVENT:
-            decoded = self.handle_RESET(payload_bytes)
-        elif event == SUPERVISORY_EVENT:
-            decoded = self.handle_SUPERVISORY(payload_bytes)
-        elif event == TAMPER_EVENT:
-            decoded = self.handle_TAMPER(payload_bytes)
-        elif event == LINK_QUALITY_EVENT:
-            decoded = self.handle_LINK_QUALITY(payload_bytes)
-        elif event == RATE_LIMIT_EXCEEDED_EVENT:
-            decoded = self.handle_RATE_LIMIT_EXCEEDED(payload_bytes)
-        elif event == TEST_MESSAGE_EVENT:
-            decoded = self.handle_TEST_MESSAGE(payload_bytes)
-        elif event == DOWNLINK_ACK_EVENT:
-            decoded = self.handle_DOWNLINK_ACK(payload_bytes)
-        elif event == DOOR_WINDOW_EVENT:
-            decoded = self.handle_DOOR_WINDOW(payload_bytes)
-        elif event == PUSH_BUTTON_EVENT:
-            decoded = self.handle_PUSH_BUTTON(payload_bytes)
-        elif event == CONTACT_EVENT:
-            decoded = self.handle_CONTACT(payload_bytes)
-        elif event == WATER_EVENT:
-            decoded = self.handle_WATER(payload_bytes)
-        elif event == TEMPERATURE_EVENT:
-            decoded = self.handle_TEMPERATURE(payload_bytes)
-        elif event == TILT_EVENT:
-            decoded = self.handle_TILT(payload_bytes)
-        elif event == ATH_EVENT:
-            decoded = self.handle_ATH(payload_bytes)
-        elif event == ABM_EVENT:
-            decoded = self.handle_ABM(payload_bytes)
-        elif event == TILT_HP_EVENT:
-            decoded = self.handle_TILT_HP(payload_bytes)
-        elif event == ULTRASONIC_EVENT:
-            decoded = self.handle_ULTRASOVIBRATION_HBNIC(payload_bytes)
-        elif event == SENSOR420MA_EVIBRATION_HBVENT:
-            decoded = self.handle_SENSOR420MA(payload_bytes)
-        elif event == THERMOCOUPLE_EVENT:
-            decoded = self.handle_THERMOCOUPLE(payload_bytes)
-        elif event == VOLTMETER_EVENT:
-            decoded = self.handle_VOLTMETER(payload_bytes)
-        elif event == CUSTOM_SENSOR_EVENT:
-            decoded = self.handle_CUSTOM_SENSOR(payload_bytes)
-        elif event == GPS_EVENT:
-            decoded = self.handle_GPS(payload_bytes)
-        elif event == HONEYWELL5800_EVENT:
-            decoded = self.handle_HONEYWELL5800(payload_bytes)
-        elif event == MAGNETOMETER_EVENT:
-            decoded = self.handle_MAGNETOMETER(payload_bytes)
-        elif event == VIBRATION_LB_EVENT:
-            decoded = self.handle_VIBRATION_LB(payload_bytes)
-        elif event == VIBRATION_HB_EVENT:
-            decoded = self.handle_VIBRATION_HB(payload_bytes)
-        else:
+        handler = RADIOBRIDGE_EVENT_HANDLERS.get(payload_bytes[1])
+        if handler is None:
+            return None
+
+        decoded = handler(self, payload_bytes)
+        if decoded is None:
             return None
+
         # add packet counter and protocol version to the end of the decode
         # The first byte contains the protocol version (upper nibble) and packet counter (lower nibble)
         PacketCounter = payload_bytes[0] & 0x0f
@@ -236,64 +226,11 @@ class Decoder(object):
         decoded = {}
         decoded["event"] = "reset"
 
-        # third byte is device type, convert to hex format for case statement
+        # third byte is device type
         DeviceTypeByte = payload_bytes[2]
 
-        # device types are enumerated below
-        if DeviceTypeByte == 0x01 :
-                DeviceType = "Door/Window Sensor"
-        elif DeviceTypeByte == 0x02 :
-                DeviceType = "Door/Window High Security"
-        elif DeviceTypeByte == 0x03 :
-                DeviceType = "Contact Sensor"
-        elif DeviceTypeByte == 0x04 :
-                DeviceType = "No-Probe Temperature Sensor"
-        elif DeviceTypeByte == 0x05 :
-                DeviceType = "External-Probe Temperature Sensor"
-        elif DeviceTypeByte == 0x06 :
-                DeviceType = "Single Push Button"
-        elif DeviceTypeByte == 0x07 :
-                DeviceType = "Dual Push Button"
-        elif DeviceTypeByte == 0x08 :
-                DeviceType = "Acceleration-Based Movement Sensor"
-        elif DeviceTypeByte == 0x09 :
-                DeviceType = "Tilt Sensor"
-        elif DeviceTypeByte == 0x0A :
-                DeviceType = "Water Sensor"
-        elif DeviceTypeByte == 0x0B :
-                DeviceType = "Tank Level Float Sensor"
-        elif DeviceTypeByte == 0x0C :
-                DeviceType = "Glass Break Sensor"
-        elif DeviceTypeByte == 0x0D :
-                DeviceType = "Ambient Light Sensor"
-        elif DeviceTypeByte == 0x0E :
-                DeviceType = "Air Temperature and Humidity Sensor"
-        elif DeviceTypeByte == 0x0F :
-                DeviceType = "High-Precision Tilt Sensor"
-        elif DeviceTypeByte == 0x10 :
-                DeviceType = "Ultrasonic Level Sensor"
-        elif DeviceTypeByte == 0x11 :
-                DeviceType = "4-20mA Current Loop Sensor"
-        elif DeviceTypeByte == 0x12 :
-                DeviceType = "Ext-Probe Air Temp and Humidity Sensor"
-        elif DeviceTypeByte == 0x13 :
-                DeviceType = "Thermocouple Temperature Sensor"
-        elif DeviceTypeByte == 0x14 :
-                DeviceType = "Voltage Sensor"
-        elif DeviceTypeByte == 0x15 :
-                DeviceType = "Custom Sensor"
-        elif DeviceTypeByte == 0x16 :
-                DeviceType = "GPS"
-        elif DeviceTypeByte == 0x17 :
-                DeviceType = "Honeywell 5800 Bridge"
-        elif DeviceTypeByte == 0x18 :
-                DeviceType = "Magnetometer"
-        elif DeviceTypeByte == 0x19 :
-                DeviceType = "Vibration Sensor - Low Frequency"
-        elif DeviceTypeByte == 0x1A :
-                DeviceType = "Vibration Sensor - High Frequency"
-        else:
-                DeviceType = "Device Undefined"
+        # device types are enumerated in RADIOBRIDGE_DEVICE_TYPES
+        DeviceType = RADIOBRIDGE_DEVICE_TYPES.get(DeviceTypeByte, "Device Undefined")
 
         decoded["device_type"] = DeviceType
 
@@ -362,7 +299,7 @@ class Decoder(object):
         if (TamperState == 0):
             decoded["tamper_state"] = "open"
         else:
-            decoded["tamper_start"] = "closed"
+            decoded["tamper_state"] = "closed"
 
         return decoded
 
@@ -724,7 +661,7 @@ class Decoder(object):
         decoded["thermocouple_event"] = ThermocoupleEventDescription
 
         # decode is across 16-bits
-        Temperature = parseInt(((payload_bytes[3] * 256) + payload_bytes[4]) / 16)
+        Temperature = ((payload_bytes[3] * 256) + payload_bytes[4]) // 16
 
         decoded["temperature"] = Temperature # "°C"
 
@@ -830,9 +767,9 @@ class Decoder(object):
 
         decoded["gps_status"] = GPSValidFixDescription
 
-        # latitude and longitude calculated across 32 bits each, show 12 decimal places
-        Latitude = (((payload_bytes[3] * (2 ^ 24)) + (payload_bytes[4] * (2 ^ 16)) + (payload_bytes[5] * (2 ^ 8)) + payload_bytes[6]) / (10 ^ 7))
-        Latitude = (((payload_bytes[7] * (2 ^ 24)) + (payload_bytes[8] * (2 ^ 16)) + (payload_bytes[9] * (2 ^ 8)) + payload_bytes[10]) / (10 ^ 7))
+        # latitude and longitude are signed 32-bit values in units of 10^-7 degrees
+        Latitude = int.from_bytes(payload_bytes[3:7], "big", signed=True) / 10**7
+        Longitude = int.from_bytes(payload_bytes[7:11], "big", signed=True) / 10**7
 
         decoded["acp_lat"] = Latitude
         decoded["acp_lng"] = Longitude
@@ -847,7 +784,7 @@ class Decoder(object):
         decoded["event"] = "honeywell5800"
 
         # honeywell sensor ID, 24-bits
-        HWSensorID = (payload_bytes[2] * (2 ^ 16)) + (payload_bytes[3] * (2 ^ 8)) + payload_bytes[4]
+        HWSensorID = (payload_bytes[2] * 65536) + (payload_bytes[3] * 256) + payload_bytes[4]
 
         decoded["hw_sensor_id"] = HWSensorID
 
@@ -892,7 +829,7 @@ class Decoder(object):
         elif VibeEvent == 4:
             VibeEventDescription = "x_above_threshold"
         elif VibeEvent == 5:
-            VibeEventDescription = "x_above_threshold"
+            VibeEventDescription = "x_below_threshold"
         elif VibeEvent == 6:
             VibeEventDescription = "y_above_threshold"
         elif VibeEvent == 7:
@@ -900,7 +837,7 @@ class Decoder(object):
         elif VibeEvent == 8:
             VibeEventDescription = "z_above_threshold"
         elif VibeEvent == 9:
-            VibeEventDescription = "z_above_threshold"
+            VibeEventDescription = "z_below_threshold"
         elif VibeEvent == 11:
             VibeEventDescription = "excess_g_force"
         else:
@@ -998,10 +935,40 @@ class Decoder(object):
     def b64toBytes(self,b64):
         if DEBUG:
             print("b64toBytes")
-        return base64.b64decode(b64)
+        # straight from the ASCII str, without base64.b64decode() first copying it to bytes
+        return binascii.a2b_base64(b64)
 
     # used for some temperatures as 2's Compliment byte
     def byte_to_signed_int(self, number):
         if number > 127:
             return number - 256
         return number
+
+# Event handlers by the event type in the second byte of the payload
+RADIOBRIDGE_EVENT_HANDLERS = { RESET_EVENT: Decoder.handle_RESET,
+                               SUPERVISORY_EVENT: Decoder.handle_SUPERVISORY,
+                               TAMPER_EVENT: Decoder.handle_TAMPER,
+                               LINK_QUALITY_EVENT: Decoder.handle_LINK_QUALITY,
+                               RATE_LIMIT_EXCEEDED_EVENT: Decoder.handle_RATE_LIMIT_EXCEEDED,
+                               TEST_MESSAGE_EVENT: Decoder.handle_TEST_MESSAGE,
+                               DOWNLINK_ACK_EVENT: Decoder.handle_DOWNLINK_ACK,
+                               DOOR_WINDOW_EVENT: Decoder.handle_DOOR_WINDOW,
+                               PUSH_BUTTON_EVENT: Decoder.handle_PUSH_BUTTON,
+                               CONTACT_EVENT: Decoder.handle_CONTACT,
+                               WATER_EVENT: Decoder.handle_WATER,
+                               TEMPERATURE_EVENT: Decoder.handle_TEMPERATURE,
+                               TILT_EVENT: Decoder.handle_TILT,
+                               ATH_EVENT: Decoder.handle_ATH,
+                               ABM_EVENT: Decoder.handle_ABM,
+                               TILT_HP_EVENT: Decoder.handle_TILT_HP,
+                               ULTRASONIC_EVENT: Decoder.handle_ULTRASONIC,
+                               SENSOR420MA_EVENT: Decoder.handle_SENSOR420MA,
+                               THERMOCOUPLE_EVENT: Decoder.handle_THERMOCOUPLE,
+                               VOLTMETER_EVENT: Decoder.handle_VOLTMETER,
+                               CUSTOM_SENSOR_EVENT: Decoder.handle_CUSTOM_SENSOR,
+                               GPS_EVENT: Decoder.handle_GPS,
+                               HONEYWELL5800_EVENT: Decoder.handle_HONEYWELL5800,
+                               MAGNETOMETER_EVENT: Decoder.handle_MAGNETOMETER,
+                               VIBRATION_LB_EVENT: Decoder.handle_VIBRATION_LB,
+                               VIBRATION_HB_EVENT: Decoder.handle_VIBRATION_HB
+                             }
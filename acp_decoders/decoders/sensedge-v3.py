@@ -1,6 +1,8 @@
 import base64
-import simplejson as json
-from datetime import datetime
+import binascii
+import acp_json as json
+from ttn_time import parse_acp_ts
+import payload_cache
 
 DEBUG = False
 
@@ -10,6 +12,9 @@ class Decoder(object):
 
         self.name = "sensedge"
 
+        # MQTT topic patterns routed to this decoder by DecoderManager
+        self.topics = [ "v3/+/devices/snsedg-+/#" ]
+
         if settings is not None and "decoded_property" in settings:
             self.decoded_property = settings["decoded_property"]
         else:
@@ -34,16 +39,13 @@ class Decoder(object):
 
 
     def decode(self, topic, message_bytes):
+        return self.decode_json(topic, message_bytes, json.loads(message_bytes))
+
+    # As decode(), but with message_bytes already parsed into msg_dict (by DecoderManager)
+    def decode_json(self, topic, message_bytes, msg_dict):
         # First lets set a flag for which version of TTN we're dealing with
         ttn_version = 3 if topic.startswith("v3/") else 2
 
-        inc_msg = str(message_bytes,'utf-8')
-
-        if DEBUG:
-            print("sensedge decode str {}".format(inc_msg))
-
-        msg_dict = json.loads(inc_msg)
-
         # extract sensor id
         # add acp_id to original message
         if ttn_version==2:
@@ -51,10 +53,11 @@ class Decoder(object):
         else:
             msg_dict["acp_id"] = msg_dict["end_device_ids"]["device_id"]
 
-        type_array = msg_dict["acp_id"].split("-")
-
-        if len(type_array) >= 3:
-            msg_dict["acp_type_id"] = type_array[0]+"-"+type_array[1]
+        # acp_type_id is the acp_id up to its second "-", if it has at least two
+        acp_id = msg_dict["acp_id"]
+        type_end = acp_id.find("-", acp_id.find("-")+1)
+        if type_end > 0:
+            msg_dict["acp_type_id"] = acp_id[:type_end]
 
         if DEBUG:
             print("\nsensedge decode() DECODED:\n")
@@ -81,10 +84,7 @@ class Decoder(object):
                 datetime_string = msg_dict["metadata"]["time"]
             else:
                 datetime_string = msg_dict["uplink_message"]["received_at"]
-            date_format = '%Y-%m-%dT%H:%M:%S.%fZ'
-            epoch_start = datetime(1970, 1, 1)
-            # trim off the nanoseconds
-            acp_ts = str((datetime.strptime(datetime_string[:-4]+"Z", date_format) - epoch_start).total_seconds())
+            acp_ts = parse_acp_ts(datetime_string)
             # add acp_ts to original message
             msg_dict["acp_ts"] = acp_ts
         except Exception as e:
@@ -118,7 +118,8 @@ class Decoder(object):
     def b64toBytes(self,b64):
         if DEBUG:
             print("sensedge b64toBytes() {}".format(b64))
-        return base64.b64decode(b64)
+        # straight from the ASCII str, without base64.b64decode() first copying it to bytes
+        return binascii.a2b_base64(b64)
 
     def temp(self,T1,T01):
         if T1 != 0 or T01 > 0:
@@ -129,6 +130,7 @@ class Decoder(object):
         else:
             return 0 - (T1 + (256 - T01) / 100 )
 
+    @payload_cache.pure
     def decodePayload(self,bytes):
         if DEBUG:
             print("sensedge decodePayload() bytes[{}] {}".format(bytes,len(bytes)))
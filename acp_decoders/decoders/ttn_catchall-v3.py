@@ -1,5 +1,5 @@
-import simplejson as json
-from datetime import datetime
+import acp_json as json
+from ttn_time import parse_acp_ts
 
 DEBUG = False
 
@@ -11,6 +11,9 @@ class Decoder(object):
     def __init__(self, settings=None):
         print("   ttn_catchall  init()")
 
+        # MQTT topic patterns routed to this decoder by DecoderManager
+        self.topics = [ "v3/#" ]
+
         return
 
     def test(self, topic, message_bytes):
@@ -37,16 +40,13 @@ class Decoder(object):
 
 
     def decode(self, topic, message_bytes):
+        return self.decode_json(topic, message_bytes, json.loads(message_bytes))
+
+    # As decode(), but with message_bytes already parsed into msg_dict (by DecoderManager)
+    def decode_json(self, topic, message_bytes, msg_dict):
         # First lets set a flag for which version of TTN we're dealing with
         ttn_version = 3 if topic.startswith("v3/") else 2
 
-        inc_msg = str(message_bytes,'utf-8')
-
-        if DEBUG:
-            print("ttn_catchall decode str {}".format(inc_msg))
-
-        msg_dict = json.loads(inc_msg)
-
         # extract sensor id
         # add acp_id to original message
         if ttn_version==2:
@@ -54,10 +54,11 @@ class Decoder(object):
         else:
             msg_dict["acp_id"] = msg_dict["end_device_ids"]["device_id"]
 
-        type_array = msg_dict["acp_id"].split("-")
-
-        if len(type_array) >= 3:
-            msg_dict["acp_type_id"] = type_array[0]+"-"+type_array[1]
+        # acp_type_id is the acp_id up to its second "-", if it has at least two
+        acp_id = msg_dict["acp_id"]
+        type_end = acp_id.find("-", acp_id.find("-")+1)
+        if type_end > 0:
+            msg_dict["acp_type_id"] = acp_id[:type_end]
 
         # extract timestamp
         try:
@@ -65,10 +66,7 @@ class Decoder(object):
                 datetime_string = msg_dict["metadata"]["time"]
             else:
                 datetime_string = msg_dict["uplink_message"]["received_at"]
-            date_format = '%Y-%m-%dT%H:%M:%S.%fZ'
-            epoch_start = datetime(1970, 1, 1)
-            # trim off the nanoseconds
-            acp_ts = str((datetime.strptime(datetime_string[:-4]+"Z", date_format) - epoch_start).total_seconds())
+            acp_ts = parse_acp_ts(datetime_string)
             # add acp_ts to original message
             msg_dict["acp_ts"] = acp_ts
         except Exception as e:
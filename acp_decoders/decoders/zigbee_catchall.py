@@ -1,4 +1,4 @@
-import simplejson as json
+import acp_json as json
 from datetime import datetime
 
 DEBUG = False
@@ -10,6 +10,13 @@ class Decoder(object):
     def __init__(self, settings=None):
         print("   zigbee_catchall init()")
 
+        # topic patterns for the DecoderManager subscriptions, i.e. the
+        # deconz2acp "csn-zigbee/<acp_id>[/...]" topics. test() matches "csn-zigbee"
+        # at any level of the topic, which a pattern cannot express, so with
+        # .topics_need_test DecoderManager also calls test() for these topics.
+        self.topics = [ "csn-zigbee/#" ]
+        self.topics_need_test = True
+
         return
 
     def test(self, topic, message_bytes):
@@ -36,10 +43,12 @@ class Decoder(object):
 
 
     def decode(self, topic, message_bytes):
-        inc_msg = str(message_bytes,'utf-8')
+        return self.decode_json(topic, message_bytes, json.loads(message_bytes))
 
+    # As decode(), but with message_bytes already parsed into msg_dict (by DecoderManager)
+    def decode_json(self, topic, message_bytes, msg_dict):
         if DEBUG:
-            print("zigbee_catchall decode str {}".format(inc_msg))
+            print("zigbee_catchall decode {}".format(message_bytes))
 
         # Zigbee topic is "csn-zigbee/<acp_id>[/<other stuff>]"
         topic_parts = topic.split('/',2) # split into max 4 topic_parts
@@ -51,7 +60,6 @@ class Decoder(object):
 
         # For this version of the decoder the original message from
         # deconz2acp will be published unchanged.
-        msg_dict = json.loads(message_bytes)
         return msg_dict
 
     # end zigbee_catchall
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+####################################################################
+# json_parity_test.py
+#
+# Checks each available acp_json backend (see acp_json.py) produces
+# the same decoded messages and the same published JSON text for
+# numbers (e.g. "temperature": 20.1) as the simplejson backend, for
+# every message in decoder_tests/*.json.
+#
+# Usage: ./json_parity_test.py [--verbose]
+#
+# Exit status 0 if all backends match, 1 otherwise.
+####################################################################
+
+import argparse
+import glob
+import io
+import random
+import re
+import sys
+from contextlib import redirect_stdout, redirect_stderr
+
+import acp_json
+from acp_decoders import DecoderManager
+
+REFERENCE_BACKEND = "simplejson"
+
+# JSON string (skipped) or JSON number (captured)
+NUMBER_RE = re.compile(r'"(?:\\.|[^"\\])*"|(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)')
+
+####################################################################
+# Set up argument parsing
+####################################################################
+
+def parse_init():
+    parser = argparse.ArgumentParser(description='Check acp_json backends give identical results for decoder_tests/*.json.')
+    parser.add_argument('--verbose', action='store_true', help='Print the number tokens compared for each message.')
+    parser.add_argument('--random', type=int, default=10000, help='Number of random sensor-range floats to also compare (default 10000).')
+
+    return parser
+
+# Return the list of JSON number tokens (as text) in json_out
+def number_tokens(json_out):
+    if isinstance(json_out, bytes):
+        json_out = str(json_out, 'utf-8')
+    return [ match.group(1) for match in NUMBER_RE.finditer(json_out) if match.group(1) is not None ]
+
+# Decode the message in json_filename with DecoderManager, using the current backend
+def decode_file(dm, json_filename):
+    with open(json_filename, 'rb') as json_file:
+        msg_bytes = json_file.read()
+
+    msg_dict = acp_json.loads(msg_bytes)
+    topic = "v3/{}/devices/{}/up".format(
+        msg_dict["end_device_ids"]["application_ids"]["application_id"],
+        msg_dict["end_device_ids"]["device_id"])
+
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        return dm.handle_input_message(topic, msg_bytes, testing=True)
+
+# Compare the backend output for obj with the reference, returning list of error strings
+def compare_dumps(backend, obj, label, verbose):
+    errors = []
+
+    acp_json.set_backend(REFERENCE_BACKEND)
+    reference_out = acp_json.dumps(obj)
+    acp_json.set_backend(backend)
+    backend_out = acp_json.dumps(obj)
+
+    if acp_json.simplejson_loads(backend_out) != acp_json.simplejson_loads(reference_out):
+        errors.append("{} {}: dumps() output parses differently".format(backend, label))
+
+    reference_numbers = number_tokens(reference_out)
+    backend_numbers = number_tokens(backend_out)
+    if verbose:
+        print("{} {}: {}".format(backend, label, backend_numbers))
+    if backend_numbers != reference_numbers:
+        for reference_number, backend_number in zip(reference_numbers, backend_numbers):
+            if reference_number != backend_number:
+                errors.append("{} {}: number {} formatted as {}".format(backend, label, reference_number, backend_number))
+        if len(backend_numbers) != len(reference_numbers):
+            errors.append("{} {}: {} numbers, expected {}".format(backend, label, len(backend_numbers), len(reference_numbers)))
+
+    return errors
+
+####################################################################
+#
+# Main
+#
+####################################################################
+
+if __name__ == '__main__':
+
+    parser = parse_init()
+    args = parser.parse_args()
+
+    backends = [ backend for backend in acp_json.BACKENDS if backend != REFERENCE_BACKEND ]
+    if not backends:
+        print("Only {} backend available, nothing to compare".format(REFERENCE_BACKEND))
+        exit(0)
+
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        dm = DecoderManager()
+
+    errors = []
+    json_filenames = sorted(glob.glob('decoder_tests/*.json'))
+
+    for json_filename in json_filenames:
+        acp_json.set_backend(REFERENCE_BACKEND)
+        reference_decoded = decode_file(dm, json_filename)
+        if reference_decoded is None:
+            errors.append("{}: not decoded".format(json_filename))
+            continue
+
+        for backend in backends:
+            # decode using the backend loads()
+            acp_json.set_backend(backend)
+            decoded = decode_file(dm, json_filename)
+            if decoded != reference_decoded:
+                errors.append("{} {}: decoded message differs".format(backend, json_filename))
+            # and compare the published JSON
+            errors += compare_dumps(backend, reference_decoded, json_filename, args.verbose)
+
+    # Random values in the range of sensor readings and timestamps, with 0..6 decimal places
+    rand = random.Random(0)
+    values = [ round(rand.uniform(-1e4, 1e10) / 10**rand.randint(0, 6), rand.randint(0, 6)) for i in range(args.random) ]
+    for backend in backends:
+        errors += compare_dumps(backend, values, "random floats", False)
+
+    for error in errors:
+        print(error)
+
+    print("{} messages, {} random floats, backends {} vs {}: {}".format(
+        len(json_filenames),
+        len(values),
+        backends,
+        REFERENCE_BACKEND,
+        "FAIL" if errors else "OK"))
+
+    exit(1 if errors else 0)
@@ -0,0 +1,138 @@
+##################################################################
+##################################################################
+# MetricsServer
+#
+# Minimal local HTTP server for the DecoderManager metrics in the
+# Prometheus text format, served from a background thread so it
+# can be scraped (or curl'd) while acp_decoders is running.
+#
+#    metrics_server = MetricsServer(metrics, settings)
+#    metrics_server.start()
+#    ...
+#    metrics_server.stop()
+#
+# where metrics() returns a Metrics object (below) filled in with the
+# current values, called for each request of GET /metrics.
+#
+# Settings (settings["metrics"], all optional), e.g.
+#     "metrics": { "host": "127.0.0.1", "port": 9108 }
+##################################################################
+##################################################################
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import acp_log as log
+
+# default settings, override with settings["metrics"]
+METRICS_SETTINGS = { "host": "127.0.0.1",
+                     "port": 9108
+                   }
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+###############################################################
+# Metrics, builds the Prometheus text format
+###############################################################
+
+class Metrics():
+
+    def __init__(self):
+        self.lines = []
+
+    # Add a counter or gauge, samples is a list of (labels dict, value)
+    # or a single value for a metric without labels
+    def add(self, name, metric_type, help_text, samples):
+        self.header(name, metric_type, help_text)
+        if not isinstance(samples, list):
+            samples = [ ({}, samples) ]
+        for labels, value in samples:
+            self.sample(name, labels, value)
+
+    # Add a summary, samples is a list of (labels dict, { quantile: value }, sum, count)
+    def add_summary(self, name, help_text, samples):
+        self.header(name, "summary", help_text)
+        for labels, quantiles, total, count in samples:
+            for quantile, value in quantiles.items():
+                quantile_labels = dict(labels)
+                quantile_labels["quantile"] = quantile
+                self.sample(name, quantile_labels, value)
+            self.sample(name+"_sum", labels, total)
+            self.sample(name+"_count", labels, count)
+
+    def header(self, name, metric_type, help_text):
+        self.lines.append("# HELP {} {}".format(name, help_text))
+        self.lines.append("# TYPE {} {}".format(name, metric_type))
+
+    def sample(self, name, labels, value):
+        if value is None:
+            value = "NaN"
+        elif isinstance(value, bool):
+            value = int(value)
+        if labels:
+            name += "{"+",".join('{}="{}"'.format(key, escape_label(str(label_value)))
+                                 for key, label_value in labels.items())+"}"
+        self.lines.append("{} {}".format(name, value))
+
+    def text(self):
+        return "\n".join(self.lines)+"\n"
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+###############################################################
+# HTTP server
+###############################################################
+
+class MetricsServer():
+
+    def __init__(self, metrics, settings=None):
+        self.metrics = metrics
+
+        options = dict(METRICS_SETTINGS)
+        if settings is not None:
+            options.update(settings)
+        self.host = options["host"]
+        self.port = options["port"]
+
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                try:
+                    body = metrics().text().encode("utf-8")
+                except Exception as e:
+                    log.error(log.CONNECTION, "MetricsServer exception {}", repr(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # requests are logged at debug level rather than to stderr
+            def log_message(self, format_string, *args):
+                log.debug(log.CONNECTION, "MetricsServer {} {}", self.address_string(), format_string % args)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics_server", daemon=True)
+        self.thread.start()
+        log.notice(log.CONNECTION, "MetricsServer serving http://{}:{}/metrics", self.host, self.port, stderr=True)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+            self.thread = None
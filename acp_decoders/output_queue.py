@@ -0,0 +1,136 @@
+##################################################################
+##################################################################
+# OutputQueue
+#
+# Bounded queue of decoded messages waiting to be published, with a
+# background thread publishing them to the output broker, so the
+# publishes are not made on the MQTT input network thread.
+#
+#    output_queue = OutputQueue(publish, settings)
+#    output_queue.start()
+#    output_queue.put(topic, msg_bytes)
+#    ...
+#    output_queue.stop() # flushes remaining messages
+#
+# where publish(topic, msg_bytes) sends one message, returning False
+# if it was not sent (e.g. the MQTT client not connected), which is
+# counted as "failed" rather than "published".
+#
+# The flush thread publishes each message as soon as it is idle.
+# Messages put while it is publishing are taken as one batch of up to
+# "batch_size" messages, with one lock acquisition rather than one per
+# message (each message is still one publish() call, as the MQTT
+# client has no batch publish). If the queue holds "max_size" messages,
+# put() drops the message immediately (and counts it) rather than
+# blocking the caller, i.e. the input network thread.
+#
+# stats() returns the queue depth and counters, as a dictionary.
+##################################################################
+##################################################################
+
+import threading
+import time
+from collections import deque
+
+import acp_log as log
+
+# default settings, override with settings["output_queue"]
+OUTPUT_QUEUE_SETTINGS = { "max_size": 10000,
+                          "batch_size": 100
+                        }
+
+class OutputQueue():
+
+    def __init__(self, publish, settings=None):
+        self.publish = publish
+
+        self.settings = dict(OUTPUT_QUEUE_SETTINGS)
+        if settings is not None:
+            self.settings.update(settings)
+        self.max_size = self.settings["max_size"]
+        self.batch_size = self.settings["batch_size"]
+
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        # counters for stats()
+        self.max_depth = 0
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="OutputQueue", daemon=True)
+        self.thread.start()
+
+    # Stop the flush thread after publishing the waiting messages
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # Add message to queue, return False if it was dropped (queue full)
+    def put(self, topic, msg_bytes):
+        with self.condition:
+            depth = len(self.queue)
+            if depth >= self.max_size:
+                self.dropped += 1
+                return False
+            self.queue.append((topic, msg_bytes))
+            depth += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+            if depth == 1:
+                # wake flush thread, which only waits when the queue is empty
+                self.condition.notify()
+        return True
+
+    def depth(self):
+        return len(self.queue)
+
+    def stats(self):
+        return { "depth": len(self.queue),
+                 "max_depth": self.max_depth,
+                 "max_size": self.max_size,
+                 "published": self.published,
+                 "failed": self.failed,
+                 "dropped": self.dropped,
+                 "batches": self.batches,
+                 "errors": self.errors
+               }
+
+    ###############################################################
+    # Flush thread
+    ###############################################################
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    return # stopped and queue is empty
+                # everything waiting (up to batch_size) is published now, without waiting for more
+                batch = [ self.queue.popleft() for i in range(min(self.batch_size, len(self.queue))) ]
+
+            self.publish_batch(batch)
+
+    def publish_batch(self, batch):
+        for topic, msg_bytes in batch:
+            try:
+                if self.publish(topic, msg_bytes):
+                    self.published += 1
+                else:
+                    self.failed += 1
+            except Exception as e:
+                self.errors += 1
+                log.error(log.PUBLISH, "{:.6f} OutputQueue publish {} exception {}", time.time(), topic, e)
+        self.batches += 1
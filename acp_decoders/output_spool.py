@@ -0,0 +1,315 @@
+##################################################################
+##################################################################
+# OutputSpool
+#
+# Bounded on-disk spool of decoded messages, which DecoderManager
+# writes to instead of publishing while the output broker is not
+# connected (rather than letting the MQTT client buffer them in memory
+# without limit). A background thread drains the spool to the broker
+# at a limited rate once it is connected again.
+#
+#    output_spool = OutputSpool(publish, settings)
+#    output_spool.start()
+#    output_spool.put(topic, msg_bytes)
+#    ...
+#    output_spool.stop() # spooled messages stay on disk for the next start()
+#
+# where publish(topic, msg_bytes) sends one message, returning False
+# if it could not be sent (e.g. not connected), to be retried after
+# "retry_interval" seconds.
+#
+# Messages are appended to memory-mapped segment files of
+# "segment_size" bytes in "directory", and a segment file is deleted
+# once it has been drained. If "max_size" bytes of segments are in use
+# put() drops the message. The spool is drained in the order the
+# messages were put, at up to "drain_rate" messages per second, so that
+# a backlog does not flood the output broker. While messages are
+# waiting in the spool, later messages should be put behind them
+# (i.e. spooled while depth() > 0) to keep each sensor's messages in
+# order. The drain_rate must be above the normal input message rate,
+# otherwise the spool will not empty.
+#
+# Each segment starts with SEGMENT_HEADER (magic and read offset),
+# followed by records of RECORD_HEADER (topic and message lengths),
+# topic and message bytes, ended by a zero header. The read offset is
+# updated as messages are drained, so after a restart the spool resumes
+# from the first message not yet published.
+#
+# stats() returns the spool depth, size and counters, as a dictionary.
+#
+# Settings (settings["output_spool"], all optional), e.g.
+#     "output_spool": { "directory": "spool", "max_size": 268435456, "drain_rate": 1000 }
+##################################################################
+##################################################################
+
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+
+import acp_log as log
+
+# default settings, override with settings["output_spool"]
+OUTPUT_SPOOL_SETTINGS = { "directory": "spool",
+                          "segment_size": 16777216, # bytes
+                          "max_size": 268435456,    # bytes, of all segments
+                          "drain_rate": 1000,       # messages per second
+                          "retry_interval": 1.0     # seconds
+                        }
+
+SEGMENT_MAGIC = b"ACPSPOOL"
+SEGMENT_HEADER = struct.Struct("<8sQ") # magic, read offset
+RECORD_HEADER = struct.Struct("<II")   # topic length, message length
+SEGMENT_SUFFIX = ".spool"
+
+DRAIN_TICK = 0.1 # seconds, messages are drained in batches of drain_rate * DRAIN_TICK
+
+###############################################################
+# Segment, one memory-mapped spool file
+###############################################################
+
+class Segment():
+
+    # Open (or with size given, create) the segment file at path
+    def __init__(self, path, size=None):
+        self.path = path
+        if size is None:
+            self.file = open(path, "r+b")
+        else:
+            self.file = open(path, "w+b")
+            self.file.truncate(size) # zero filled, i.e. ended by a zero record header
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+
+        if size is None:
+            magic, self.read_offset = SEGMENT_HEADER.unpack_from(self.mm, 0)
+            if magic != SEGMENT_MAGIC:
+                self.close()
+                raise ValueError("{} is not a spool segment".format(path))
+        else:
+            self.read_offset = SEGMENT_HEADER.size
+            SEGMENT_HEADER.pack_into(self.mm, 0, SEGMENT_MAGIC, self.read_offset)
+
+        # find the end of the records, counting those not yet read
+        self.write_offset = SEGMENT_HEADER.size
+        self.count = 0
+        self.bytes = 0
+        while self.write_offset + RECORD_HEADER.size <= self.size:
+            topic_length, msg_length = RECORD_HEADER.unpack_from(self.mm, self.write_offset)
+            if topic_length == 0:
+                break
+            record_size = RECORD_HEADER.size + topic_length + msg_length
+            if self.write_offset >= self.read_offset:
+                self.count += 1
+                self.bytes += record_size
+            self.write_offset += record_size
+
+    # Append a record, returning False if it does not fit in this segment
+    def append(self, topic_bytes, msg_bytes):
+        offset = self.write_offset
+        record_size = RECORD_HEADER.size + len(topic_bytes) + len(msg_bytes)
+        if offset + record_size > self.size:
+            return False
+        data_offset = offset + RECORD_HEADER.size
+        self.mm[data_offset:data_offset+len(topic_bytes)] = topic_bytes
+        data_offset += len(topic_bytes)
+        self.mm[data_offset:data_offset+len(msg_bytes)] = msg_bytes
+        # header last, so a partly written record is never read
+        RECORD_HEADER.pack_into(self.mm, offset, len(topic_bytes), len(msg_bytes))
+        self.write_offset = offset + record_size
+        self.count += 1
+        self.bytes += record_size
+        return True
+
+    # Return (topic, msg_bytes, record_size) of the next unread record, or None
+    def peek(self):
+        if self.read_offset >= self.write_offset:
+            return None
+        topic_length, msg_length = RECORD_HEADER.unpack_from(self.mm, self.read_offset)
+        data_offset = self.read_offset + RECORD_HEADER.size
+        topic = self.mm[data_offset:data_offset+topic_length].decode("utf-8")
+        data_offset += topic_length
+        msg_bytes = self.mm[data_offset:data_offset+msg_length]
+        return topic, msg_bytes, RECORD_HEADER.size + topic_length + msg_length
+
+    # Mark the next record (of record_size bytes) as read
+    def advance(self, record_size):
+        self.read_offset += record_size
+        SEGMENT_HEADER.pack_into(self.mm, 0, SEGMENT_MAGIC, self.read_offset)
+        self.count -= 1
+        self.bytes -= record_size
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+###############################################################
+# OutputSpool
+###############################################################
+
+class OutputSpool():
+
+    def __init__(self, publish, settings=None):
+        self.publish = publish
+
+        self.settings = dict(OUTPUT_SPOOL_SETTINGS)
+        if settings is not None:
+            self.settings.update(settings)
+        self.directory = self.settings["directory"]
+        self.segment_size = self.settings["segment_size"]
+        self.max_segments = max(1, self.settings["max_size"] // self.segment_size)
+        self.drain_rate = self.settings["drain_rate"]
+        self.retry_interval = self.settings["retry_interval"]
+
+        self.segments = [] # oldest (being drained) first, last is being written
+        self.next_segment_number = 0
+        self.messages = 0  # messages in the spool, including one being drained
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        # counters for stats()
+        self.spooled = 0
+        self.drained = 0
+        self.dropped = 0
+
+    # Open any segments left by a previous run, and start the drain thread
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for path in sorted(glob.glob(os.path.join(self.directory, "*"+SEGMENT_SUFFIX))):
+            try:
+                segment = Segment(path)
+            except (OSError, ValueError, struct.error) as e:
+                log.error(log.PUBLISH, "{:.6f} OutputSpool ignoring {}: {}", time.time(), path, e)
+                continue
+            self.segments.append(segment)
+            self.messages += segment.count
+            self.next_segment_number = int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)]) + 1
+        if self.messages:
+            log.notice(log.PUBLISH, "{:.6f} OutputSpool {} messages spooled in {}",
+                time.time(), self.messages, self.directory, stderr=True)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="OutputSpool", daemon=True)
+        self.thread.start()
+
+    # Stop the drain thread, leaving the spooled messages on disk
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.condition:
+            for segment in self.segments:
+                segment.mm.flush()
+                segment.close()
+            self.segments = []
+
+    # Append message to the spool, return False if it was dropped
+    def put(self, topic, msg_bytes):
+        topic_bytes = topic.encode("utf-8")
+        if isinstance(msg_bytes, str):
+            msg_bytes = msg_bytes.encode("utf-8")
+        with self.condition:
+            if not self.segments or not self.segments[-1].append(topic_bytes, msg_bytes):
+                if (len(self.segments) >= self.max_segments or
+                    RECORD_HEADER.size + len(topic_bytes) + len(msg_bytes) > self.segment_size - SEGMENT_HEADER.size):
+                    self.dropped += 1
+                    return False
+                self.new_segment().append(topic_bytes, msg_bytes)
+            self.messages += 1
+            self.spooled += 1
+            if self.messages == 1:
+                self.condition.notify_all() # wake drain thread
+        return True
+
+    def new_segment(self):
+        path = os.path.join(self.directory, "{:010d}{}".format(self.next_segment_number, SEGMENT_SUFFIX))
+        self.next_segment_number += 1
+        segment = Segment(path, self.segment_size)
+        self.segments.append(segment)
+        return segment
+
+    # Number of messages in the spool (not yet published)
+    def depth(self):
+        return self.messages
+
+    def stats(self):
+        with self.condition:
+            spool_bytes = sum(segment.bytes for segment in self.segments)
+            segments = len(self.segments)
+        return { "depth": self.messages,
+                 "bytes": spool_bytes,
+                 "segments": segments,
+                 "max_size": self.max_segments * self.segment_size,
+                 "drain_rate": self.drain_rate,
+                 "spooled": self.spooled,
+                 "drained": self.drained,
+                 "dropped": self.dropped
+               }
+
+    ###############################################################
+    # Drain thread
+    ###############################################################
+
+    def run(self):
+        batch_size = max(1, int(self.drain_rate * DRAIN_TICK))
+        while True:
+            with self.condition:
+                while self.running and self.messages == 0:
+                    self.condition.wait()
+                if not self.running:
+                    return
+            tick_start = time.monotonic()
+
+            drained = self.drain(batch_size)
+
+            with self.condition:
+                if drained < batch_size and self.messages > 0:
+                    # publish failed, e.g. output broker still not connected
+                    self.condition.wait(self.retry_interval)
+                else:
+                    # limit the rate to drain_rate messages per second
+                    wait_time = tick_start + drained / self.drain_rate - time.monotonic()
+                    if wait_time > 0:
+                        self.condition.wait(wait_time)
+
+    # Publish up to batch_size messages, return the number published
+    def drain(self, batch_size):
+        drained = 0
+        while drained < batch_size:
+            with self.condition:
+                record = self.next_record()
+            if record is None:
+                break
+            topic, msg_bytes, record_size = record
+            try:
+                if not self.publish(topic, msg_bytes):
+                    break
+            except Exception as e:
+                log.error(log.PUBLISH, "{:.6f} OutputSpool publish {} exception {}", time.time(), topic, e)
+                break
+            # only now remove it, so messages put meanwhile stay behind it
+            with self.condition:
+                self.segments[0].advance(record_size)
+                self.messages -= 1
+                self.drained += 1
+            drained += 1
+        return drained
+
+    # Return the oldest record as (topic, msg_bytes, record_size), deleting drained segments, or None
+    def next_record(self):
+        while self.segments:
+            segment = self.segments[0]
+            record = segment.peek()
+            if record is not None:
+                return record
+            # drained, put() starts a new segment for any further messages
+            segment.close()
+            os.remove(segment.path)
+            del self.segments[0]
+        return None
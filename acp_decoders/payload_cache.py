@@ -0,0 +1,107 @@
+##################################################################
+##################################################################
+# PayloadCache
+#
+# Opt-in LRU memoisation of decoder payload decoding, for sensors
+# that send byte-identical payloads over and over (door contacts,
+# water leak, config and supervisory packets).
+#
+# A decoder marks its decodePayload method as pure, i.e. the result
+# depends only on its last argument, the payload bytes:
+#
+#    import payload_cache
+#    ...
+#        @payload_cache.pure
+#        def decodePayload(self, payload_bytes):
+#
+# and with settings["payload_cache"] given, DecoderManager calls
+#
+#    payload_cache.install(decoder, settings["payload_cache"])
+#
+# for each decoder it loads, which replaces the decoder's
+# decodePayload with PayloadCache.decode_payload. Each call then
+# returns a copy of the cached decoded dictionary, so the caller can
+# modify it without changing the cache. Exceptions are not cached.
+#
+# The cache belongs to the decoder instance, so it is discarded when
+# the decoders are reloaded, and decoder.payload_cache.stats()
+# returns the hit/miss counters.
+#
+# Settings (settings["payload_cache"]), e.g.
+#     "payload_cache": { "size": 1024 }
+##################################################################
+##################################################################
+
+import copy
+from collections import OrderedDict
+
+# default settings, override with settings["payload_cache"]
+PAYLOAD_CACHE_SETTINGS = { "size": 1024 }
+
+# decoded values which can be shared between copies of a decoded dictionary
+IMMUTABLE_TYPES = (str, int, float, bool, type(None))
+
+# Decorator marking a decoder decodePayload method as cacheable
+def pure(decode_payload):
+    decode_payload.pure_payload = True
+    return decode_payload
+
+# Return a PayloadCache for decoder, installed as its decodePayload,
+# or None if its decodePayload is not marked pure
+def install(decoder, settings=None):
+    decode_payload = getattr(decoder, "decodePayload", None)
+    if not getattr(decode_payload, "pure_payload", False):
+        return None
+    cache = PayloadCache(decode_payload, settings)
+    decoder.decodePayload = cache.decode_payload
+    decoder.payload_cache = cache
+    return cache
+
+# Return a copy of decoded (a dictionary or None), shallow if shallow is True
+def copy_decoded(decoded, shallow):
+    if decoded is None:
+        return None
+    if shallow:
+        return dict(decoded)
+    return copy.deepcopy(decoded)
+
+class PayloadCache():
+
+    def __init__(self, decode_payload, settings=None):
+        self.decode = decode_payload
+
+        options = dict(PAYLOAD_CACHE_SETTINGS)
+        if settings is not None:
+            options.update(settings)
+        self.max_size = options["size"]
+
+        self.cache = OrderedDict() # payload bytes -> (decoded, shallow copy is enough)
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    # As the decoder decodePayload(..., payload_bytes)
+    def decode_payload(self, *args):
+        payload = args[-1]
+        entry = self.cache.get(payload)
+        if entry is not None:
+            self.hits += 1
+            self.cache.move_to_end(payload)
+        else:
+            self.misses += 1
+            decoded = self.decode(*args)
+            shallow = decoded is None or all(type(value) in IMMUTABLE_TYPES for value in decoded.values())
+            entry = (decoded, shallow)
+            self.cache[payload] = entry
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False) # discard least recently used
+        return copy_decoded(*entry)
+
+    # Return the cache counters as a dictionary
+    def stats(self):
+        return { "hits": self.hits,
+                 "misses": self.misses,
+                 "size": len(self.cache),
+                 "max_size": self.max_size
+               }
@@ -20,7 +20,18 @@ then
     exit 1
 else
     source venv/bin/activate
-    python3 acp_decoders.py
+    # settings.json "workers" gives the number of processes sharing the input (default 1)
+    workers=$(python3 -c 'import json; print(json.load(open("settings.json")).get("workers", 1))')
+    if [ "$workers" -gt 1 ]
+    then
+        for ((worker=0; worker<workers; worker++))
+        do
+            python3 acp_decoders.py --worker $worker &
+        done
+        wait
+    else
+        python3 acp_decoders.py
+    fi
     exit 0
 fi
 
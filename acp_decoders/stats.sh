@@ -0,0 +1,15 @@
+#!/bin/bash
+
+pid=$(pgrep -f "python3 acp_decoders.py")
+
+if [ $? -eq 0 ]
+then
+  echo "Sending stats (SIGUSR1) signal to:"
+  ps --no-header $pid
+  kill -SIGUSR1 $pid
+  echo "Stats are written to the acp_decoders log (stdout)"
+  exit 0
+else
+  echo "ERROR: acp_decoders not running?"
+  exit 1
+fi
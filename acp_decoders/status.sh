@@ -1,13 +1,23 @@
 #!/bin/bash
 
+SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+
+# settings.json "workers" gives the number of processes expected (default 1)
+workers=$(cd $SCRIPT_DIR && python3 -c 'import json; print(json.load(open("settings.json")).get("workers", 1))' 2>/dev/null || echo 1)
+
 pid=$(pgrep -f "python3 acp_decoders.py")
 
 if [ $? -eq 0 ]
 then
+  running=$(echo $pid | wc -w)
+  if [ $running -lt $workers ]
+  then
+    echo -e "\e[33m●\e[0m" "WARNING: acp_decoders running as PID" $pid "($running of $workers workers)"
+    exit 1
+  fi
   echo -e "\e[32m●\e[0m" acp_decoders running as PID $pid
   exit 0
 else
   echo -e "\e[31m●\e[0m" "ERROR: acp_decoders not running?"
   exit 1
 fi
-
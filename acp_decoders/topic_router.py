@@ -0,0 +1,173 @@
+##################################################################
+##################################################################
+# TopicRouter
+#
+# Compiles the MQTT-style topic patterns declared by the loaded
+# decoders (e.g. 'v3/+/devices/elsys-+/#', 'csn/#') into a topic
+# trie, so finding the decoders for a message costs roughly
+# O(topic depth) however many decoders are loaded.
+#
+# Pattern levels:
+#     'abc'  : matches the topic level 'abc' exactly
+#     '+'    : matches any single topic level
+#     'abc-+': matches any single topic level starting 'abc-'
+#     '#'    : matches the rest of the topic (incl. the parent level),
+#              must be the last level of the pattern
+#
+# Decoders declaring no patterns (no .topics) are kept as 'legacy'
+# decoders and still have their .test(topic, msg_bytes) called.
+# A decoder can also set .topics_need_test = True, so its .test() is
+# called for the topics matching its patterns (which then only need
+# to cover the topics its .test() accepts, e.g. for the subscription
+# filters).
+#
+# route(topic) returns the decoders to try for a topic, in the
+# order they appear in decoders.json, as a list of
+#     (decoder, needs_test)
+# where decoder is the { "name":, "decoder": } entry and
+# needs_test is True for legacy decoders and those with
+# .topics_need_test.
+#
+# .cache is an (initially empty) OrderedDict for the DecoderManager
+# route cache, so the cache is discarded along with the router.
+##################################################################
+##################################################################
+
+from collections import OrderedDict
+
+class TopicNode():
+
+    def __init__(self):
+        self.children = {}       # exact level -> TopicNode
+        self.prefixes = {}       # level prefix (for 'abc-+') -> TopicNode
+        self.prefix_lengths = [] # distinct lengths of keys in self.prefixes
+        self.plus = None         # TopicNode for '+'
+        self.hash = []           # decoder indexes for '#' at this level
+        self.end = []            # decoder indexes for patterns ending here
+
+class TopicRouter():
+
+    # decoders is the DecoderManager list of { "name":, "decoder": }
+    def __init__(self, decoders):
+        self.decoders = decoders
+        self.root = TopicNode()
+        self.legacy = [] # indexes of decoders without declared topics
+        self.tested = [] # indexes of legacy decoders and those with .topics_need_test
+        self.cache = OrderedDict() # topic -> decoders, LRU cache for DecoderManager
+
+        for index, decoder in enumerate(decoders):
+            patterns = getattr(decoder["decoder"], "topics", None)
+            if patterns:
+                for pattern in patterns:
+                    self.add_pattern(pattern, index)
+                if getattr(decoder["decoder"], "topics_need_test", False):
+                    self.tested.append(index)
+            else:
+                self.legacy.append(index)
+                self.tested.append(index)
+
+    # Add topic pattern to the trie, for decoder self.decoders[index]
+    def add_pattern(self, pattern, index):
+        levels = pattern.split('/')
+        node = self.root
+        for level_index, level in enumerate(levels):
+            if level == '#':
+                if level_index != len(levels) - 1:
+                    raise ValueError("TopicRouter '#' not last level in pattern {}".format(pattern))
+                node.hash.append(index)
+                return
+            elif level == '+':
+                if node.plus is None:
+                    node.plus = TopicNode()
+                node = node.plus
+            elif level.endswith('+'):
+                prefix = level[:-1]
+                if not prefix in node.prefixes:
+                    node.prefixes[prefix] = TopicNode()
+                    if not len(prefix) in node.prefix_lengths:
+                        node.prefix_lengths.append(len(prefix))
+                node = node.prefixes[prefix]
+            else:
+                if not level in node.children:
+                    node.children[level] = TopicNode()
+                node = node.children[level]
+        node.end.append(index)
+
+    # Return the set of decoder indexes with a pattern matching topic
+    def match(self, topic):
+        matched = set()
+        levels = topic.split('/')
+        # Walk the trie breadth-first, one topic level at a time
+        nodes = [ self.root ]
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                if node.hash:
+                    matched.update(node.hash)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                if node.plus is not None:
+                    next_nodes.append(node.plus)
+                for prefix_length in node.prefix_lengths:
+                    child = node.prefixes.get(level[:prefix_length])
+                    if child is not None:
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                return matched
+        for node in nodes:
+            matched.update(node.end)
+            # 'a/#' also matches the parent level 'a'
+            matched.update(node.hash)
+        return matched
+
+    # Return list of (decoder, needs_test) to try for topic, in decoders.json order
+    def route(self, topic):
+        matched = self.match(topic)
+        matched.update(self.legacy)
+        return [ (self.decoders[index], index in self.tested) for index in sorted(matched) ]
+
+##################################################################
+# MQTT subscription filters for the decoder topic patterns
+##################################################################
+
+# Convert a decoder topic pattern to an MQTT subscription filter,
+# i.e. a prefix level such as 'elsys-+' becomes '+'
+def pattern_filter(pattern):
+    return '/'.join([ '+' if level.endswith('+') else level for level in pattern.split('/') ])
+
+# True if every topic matching MQTT filter b also matches filter a
+# (b can also be a topic, i.e. a filter with no wildcards)
+def filter_covers(a, b):
+    a_levels = a.split('/')
+    b_levels = b.split('/')
+    for index, level in enumerate(a_levels):
+        if level == '#':
+            return True
+        if index >= len(b_levels) or b_levels[index] == '#':
+            return False
+        if level != '+' and level != b_levels[index]:
+            return False
+    return len(a_levels) == len(b_levels)
+
+# Return the minimal list of MQTT filters to subscribe to for decoders,
+# with default_filter (e.g. '#') used for decoders without declared topics
+def subscription_filters(decoders, default_filter):
+    filters = []
+    for decoder in decoders:
+        patterns = getattr(decoder["decoder"], "topics", None)
+        if patterns:
+            filters += [ pattern_filter(pattern) for pattern in patterns ]
+        else:
+            filters.append(default_filter)
+
+    # remove duplicates and filters covered by another filter
+    minimal_filters = []
+    for topic_filter in filters:
+        if topic_filter in minimal_filters:
+            continue
+        if any([ filter_covers(other, topic_filter) for other in filters if other != topic_filter ]):
+            continue
+        minimal_filters.append(topic_filter)
+    return minimal_filters
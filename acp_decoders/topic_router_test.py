@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+####################################################################
+# topic_router_test.py
+#
+# Checks the input subscriptions (see topic_router.py) for the
+# decoders in decoders.json and the README.md example settings do not
+# include '#' or the output topic_prefix, and that example topics are
+# still routed to the expected decoders.
+#
+# Usage: ./topic_router_test.py
+#
+# Exit status 0 if the test passes, 1 otherwise.
+####################################################################
+
+import io
+import re
+from contextlib import redirect_stdout, redirect_stderr
+
+import acp_json
+from acp_decoders import DecoderManager
+from topic_router import filter_covers
+
+# The first JSON settings example in README.md
+SETTINGS_RE = re.compile(r'```\n(\{\n    "decoders_file".*?\n\})\n```', re.DOTALL)
+
+# topic -> name of the decoder it should be routed to first, or None
+ROUTE_TESTS = { "v3/cambridge-net-3@ttn/devices/elsys-co2-0460ec/up": "elsys-v3",
+                "v3/cambridge-net-3@ttn/devices/rad-ath-003cd2/up": "radiobridge-v3",
+                "v3/cambridge-net-3@ttn/devices/unknown-010203/up": "ttn_catchall-v3",
+                "csn/tas-power-12345/tele/SENSOR": "mqttlocal",
+                "csn-zigbee/zigbee-012345/state": "zigbee_catchall",
+                "acp/elsys-co2-0460ec/v3/cambridge-net-3@ttn/devices/elsys-co2-0460ec/up": None
+              }
+
+####################################################################
+#
+# Main
+#
+####################################################################
+
+if __name__ == '__main__':
+
+    with open("README.md", "r") as readme_file:
+        settings = acp_json.loads(SETTINGS_RE.search(readme_file.read()).group(1))
+
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        dm = DecoderManager()
+        dm.settings = settings
+        dm.load_decoders_file()
+
+    errors = []
+
+    filters = dm.subscription_filters()
+    output_topic = settings["output_mqtt"]["topic_prefix"]+"acp_id/topic"
+    for topic_filter in filters:
+        if topic_filter == "#":
+            errors.append("subscription filters {} include '#'".format(filters))
+        elif filter_covers(topic_filter, output_topic):
+            errors.append("subscription filter {} includes output topic {}".format(topic_filter, output_topic))
+
+    for topic, expected_name in ROUTE_TESTS.items():
+        subscribed = any([ filter_covers(topic_filter, topic) for topic_filter in filters ])
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            decoders = dm.route_decoders(topic, b'{}')
+        name = decoders[0]["name"] if decoders else None
+        if name != expected_name:
+            errors.append("{} routed to {}, expected {}".format(topic, name, expected_name))
+        if subscribed != (expected_name is not None):
+            errors.append("{} {}subscribed".format(topic, "" if subscribed else "not "))
+
+    for error in errors:
+        print(error)
+
+    print("subscription filters {}, {} routed topics: {}".format(
+        filters,
+        len(ROUTE_TESTS),
+        "FAIL" if errors else "OK"))
+
+    exit(1 if errors else 0)
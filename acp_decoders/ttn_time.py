@@ -0,0 +1,101 @@
+##################################################################
+##################################################################
+# ttn_time
+#
+# Fast parser for the fixed-format RFC3339 timestamps in TTN
+# messages (e.g. "received_at": "2021-03-14T15:05:56.943862548Z"),
+# shared by the LoRaWAN decoders:
+#
+#    from ttn_time import parse_acp_ts
+#    msg_dict["acp_ts"] = parse_acp_ts(msg_dict["uplink_message"]["received_at"])
+#
+# Returns the acp_ts string "<epoch seconds>.<fraction>", e.g.
+# "1615734356.943862548", keeping the full fractional precision of
+# the timestamp (no rounding via float or truncation to microseconds).
+#
+# Uses fixed string offsets and integer arithmetic rather than
+# datetime.strptime(). Timezone offsets ("+01:00") are supported as
+# well as "Z". Raises ValueError for a malformed timestamp.
+##################################################################
+##################################################################
+
+# cumulative days before each month (1..12) in a non-leap year
+DAYS_BEFORE_MONTH = [ 0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334 ]
+
+# days in each month (1..12) in a non-leap year
+DAYS_IN_MONTH = [ 0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31 ]
+
+# cache of "YYYY-MM-DD" -> epoch seconds at midnight, as most messages share a date
+DATE_CACHE_SIZE = 64
+
+date_cache = {}
+
+# Return epoch seconds for midnight UTC at the start of date "YYYY-MM-DD"
+def date_seconds(date_string):
+    year = int(date_string[0:4])
+    month = int(date_string[5:7])
+    day = int(date_string[8:10])
+    if month < 1 or month > 12:
+        raise ValueError("ttn_time bad date {}".format(date_string))
+    leap_year = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    if day < 1 or day > DAYS_IN_MONTH[month] + (1 if month == 2 and leap_year else 0):
+        raise ValueError("ttn_time bad date {}".format(date_string))
+
+    # days from 1970-01-01 to 1st January of year (proleptic Gregorian)
+    y = year - 1
+    days = 365 * (year - 1970) + (y // 4 - y // 100 + y // 400) - 477
+
+    days += DAYS_BEFORE_MONTH[month] + day - 1
+    if month > 2 and leap_year:
+        days += 1
+
+    return days * 86400
+
+# Parse RFC3339 timestamp, returning acp_ts string
+def parse_acp_ts(datetime_string):
+    if (len(datetime_string) < 20 or datetime_string[4] != '-' or datetime_string[7] != '-' or
+        datetime_string[10] not in 'Tt ' or datetime_string[13] != ':' or datetime_string[16] != ':'):
+        raise ValueError("ttn_time bad timestamp {}".format(datetime_string))
+
+    date_string = datetime_string[0:10]
+    seconds = date_cache.get(date_string)
+    if seconds is None:
+        seconds = date_seconds(date_string)
+        if len(date_cache) >= DATE_CACHE_SIZE:
+            date_cache.clear()
+        date_cache[date_string] = seconds
+
+    hours = int(datetime_string[11:13])
+    minutes = int(datetime_string[14:16])
+    secs = int(datetime_string[17:19])
+    seconds += hours * 3600 + minutes * 60 + secs
+
+    # timezone, 'Z' or +hh:mm / -hh:mm
+    if datetime_string[-1] in 'Zz':
+        index = len(datetime_string) - 1
+    else:
+        index = len(datetime_string) - 6
+
+    # fraction of a second, kept as given
+    if datetime_string[19] == '.':
+        fraction = datetime_string[20:index]
+        if not fraction.isdigit():
+            raise ValueError("ttn_time bad fraction {}".format(datetime_string))
+    elif index == 19:
+        fraction = None
+    else:
+        raise ValueError("ttn_time bad timestamp {}".format(datetime_string))
+
+    zone = datetime_string[index:]
+    if len(zone) != 1:
+        if len(zone) != 6 or zone[0] not in '+-' or zone[3] != ':':
+            raise ValueError("ttn_time bad timezone {}".format(datetime_string))
+        offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+        seconds += -offset if zone[0] == '+' else offset
+
+    if fraction is None:
+        return str(seconds)
+    if seconds < 0:
+        # "<seconds>.<fraction>" is only correct for non-negative seconds
+        raise ValueError("ttn_time timestamp before 1970 {}".format(datetime_string))
+    return str(seconds) + '.' + fraction
@@ -0,0 +1,114 @@
+##################################################################
+##################################################################
+# UplinkDedup
+#
+# Drops repeated copies of the same TTN v3 uplink, e.g. when it
+# reaches the input broker by both the TTN bridge and the cdbb.uk
+# bridge, before the message is parsed and decoded:
+#
+#    uplink_dedup = UplinkDedup(settings)
+#    ...
+#    if not uplink_dedup.is_duplicate(topic, msg_bytes):
+#        ... decode msg_bytes
+#
+# The key of an uplink is taken from the raw message bytes (without
+# parsing the JSON): its "as:up:<id>" correlation id, which is the
+# same for every copy the TTN Application Server sends of one uplink,
+# otherwise its ("dev_eui", "f_cnt"), with a missing "f_cnt" taken as
+# 0 (TTN omits fields with zero values, so the first uplink after a
+# device joins has none). Messages with neither an id nor a
+# "dev_eui" (e.g. not TTN v3 uplinks) are never duplicates. The key
+# includes the last level of the topic (e.g. "up"), so other messages about the same
+# uplink (e.g. ".../location/solved") are not taken as copies of it,
+# while copies on topics with different bridge prefixes are.
+#
+# Keys are remembered for "window" seconds, and at most "max_size"
+# keys are held (oldest first out), so memory use is bounded
+# whatever the message rate.
+#
+# stats() returns the duplicate counters, as a dictionary.
+#
+# Settings (settings["dedup"], all optional), e.g.
+#     "dedup": { "window": 300, "max_size": 100000 }
+##################################################################
+##################################################################
+
+import re
+import time
+from collections import OrderedDict
+
+# default settings, override with settings["dedup"]
+DEDUP_SETTINGS = { "window": 300,     # seconds
+                   "max_size": 100000 # keys
+                 }
+
+AS_UP_ID = b'"as:up:'
+DEV_EUI_RE = re.compile(rb'"dev_eui"\s*:\s*"([0-9A-Fa-f]+)"')
+F_CNT_RE = re.compile(rb'"f_cnt"\s*:\s*([0-9]+)')
+
+# Return the dedup key of the uplink in msg_bytes received on topic, or None
+def uplink_key(topic, msg_bytes):
+    message_type = topic[topic.rfind("/")+1:]
+    start = msg_bytes.find(AS_UP_ID)
+    if start >= 0:
+        start += 1 # after the opening quote
+        end = msg_bytes.find(b'"', start)
+        if end > start:
+            return (message_type, msg_bytes[start:end])
+    dev_eui = DEV_EUI_RE.search(msg_bytes)
+    if dev_eui is not None:
+        f_cnt = F_CNT_RE.search(msg_bytes)
+        f_cnt = 0 if f_cnt is None else int(f_cnt.group(1)) # TTN omits f_cnt 0
+        return (message_type, dev_eui.group(1).upper(), f_cnt)
+    return None
+
+class UplinkDedup():
+
+    def __init__(self, settings=None):
+        options = dict(DEDUP_SETTINGS)
+        if settings is not None:
+            options.update(settings)
+        self.window = options["window"]
+        self.max_size = options["max_size"]
+
+        self.keys = OrderedDict() # uplink key -> time first seen, oldest first
+
+        # counters
+        self.checked = 0
+        self.unkeyed = 0
+        self.duplicates = 0
+
+    # Return True if msg_bytes is a copy of an uplink seen within the window
+    def is_duplicate(self, topic, msg_bytes):
+        self.checked += 1
+        key = uplink_key(topic, msg_bytes)
+        if key is None:
+            self.unkeyed += 1
+            return False
+
+        now = time.monotonic()
+        keys = self.keys
+        # forget keys older than the window
+        expired = now - self.window
+        while keys:
+            oldest_key, oldest_time = next(iter(keys.items()))
+            if oldest_time >= expired:
+                break
+            del keys[oldest_key]
+
+        if key in keys:
+            self.duplicates += 1
+            return True
+        keys[key] = now
+        if len(keys) > self.max_size:
+            keys.popitem(last=False)
+        return False
+
+    # Return the dedup counters as a dictionary
+    def stats(self):
+        return { "checked": self.checked,
+                 "unkeyed": self.unkeyed,
+                 "duplicates": self.duplicates,
+                 "size": len(self.keys),
+                 "max_size": self.max_size
+               }
@@ -24,6 +24,18 @@ fi
 cd $SCRIPT_DIR/acp_decoders
 
 source venv/bin/activate
-nohup python3 acp_decoders.py >>/dev/null 2>>/var/log/acp_prod/acp_decoders.err & disown
+
+# settings.json "workers" gives the number of processes sharing the input (default 1)
+workers=$(python3 -c 'import json; print(json.load(open("settings.json")).get("workers", 1))')
+
+if [ "$workers" -gt 1 ]
+then
+    for ((worker=0; worker<workers; worker++))
+    do
+        nohup python3 acp_decoders.py --worker $worker >>/dev/null 2>>/var/log/acp_prod/acp_decoders.err & disown
+    done
+else
+    nohup python3 acp_decoders.py >>/dev/null 2>>/var/log/acp_prod/acp_decoders.err & disown
+fi
 exit 0
 